@@ -9,8 +9,10 @@ import tensorflow as tf
 import os
 import sys
 import re
+import glob
 import time
 import random
+import uuid
 import argparse
 import subprocess
 import multiprocessing
@@ -24,13 +26,19 @@ from tensorpack.tfutils.summary import add_moving_summary
 from tensorpack.RL import *
 
 import common
-from common import play_model, Evaluator, eval_model_multithread
+from expreplay import ExpReplay, PrioritizedExpReplay, ReplayMemorySaver
+from actors import ExpReplayActor, MultiActorExpReplay
+from common import play_model, Evaluator, EvalPool, EvalCache, eval_model_multiprocess, TimeBreakdown
 from atari import AtariPlayer
+from numpy_dqn import NumpyDQNPredictor, export_checkpoint, read_checkpoint
+from quantize import (QuantizedDQNPredictor, calibrate, greedy_agreement,
+                      record_states, load_predictor)
 
 BATCH_SIZE = 64
 IMAGE_SIZE = (84, 84)
 FRAME_HISTORY = 4
 ACTION_REPEAT = 4
+MAX_EPISODE_LENGTH = 30000
 
 CHANNEL = FRAME_HISTORY
 IMAGE_SHAPE3 = IMAGE_SIZE + (CHANNEL,)
@@ -43,38 +51,80 @@ END_EXPLORATION = 0.1
 MEMORY_SIZE = 1e6
 # NOTE: will consume at least 1e6 * 84 * 84 bytes == 6.6G memory.
 # Suggest using tcmalloc to manage memory space better.
+# Use --replay-compress to keep the frames compressed instead.
 INIT_MEMORY_SIZE = 5e4
 STEP_PER_EPOCH = 10000
 EVAL_EPISODE = 50
+# the k-th evaluation episode is played with seed EVAL_SEED + k
+EVAL_SEED = 0
+# number of recorded states to calibrate the int8 model with, and to validate it on
+QUANTIZE_STATES = 2000
 
 NUM_ACTIONS = None
 METHOD = None
+PRIORITIZED = False
+REPLAY_COMPRESS = None
+NR_ACTOR = 0
+NSTEP = 1
+# number of batches sampled ahead of time by a background thread
+PREFETCH = 3
+# actors and evaluators predict with NumPy instead of a TensorFlow session
+NUMPY_INFERENCE = False
+EVAL_CI_WIDTH = None
+EVAL_TIME_BUDGET = None
+# draw the game in flat colors without pygame, for training and evaluation alike:
+# a model trained on one kind of frames can't play on the other
+FLAT_RENDER = False
+# training episodes start from this many cached snapshots per level. needs FLAT_RENDER
+RESET_CACHE = 0
+# 'training' skips visual-only changes in the training players. see tanks.Game
+TRAIN_FIDELITY = 'full'
 
 
 def get_player(viz=False, train=False):
-    pl = AtariPlayer(viz=0.01)
+    pl = AtariPlayer(viz=0.01, frame_skip=ACTION_REPEAT, image_shape=IMAGE_SIZE,
+                     render=not FLAT_RENDER, reset_cache=RESET_CACHE if train else 0,
+                     fidelity=TRAIN_FIDELITY if train else 'full')
     global NUM_ACTIONS
     NUM_ACTIONS = pl.get_action_space().num_actions()
     if not train:
         pl = HistoryFramePlayer(pl, FRAME_HISTORY)
         pl = PreventStuckPlayer(pl, 30, 1)
-    pl = LimitLengthPlayer(pl, 30000)
+    pl = LimitLengthPlayer(pl, MAX_EPISODE_LENGTH)
     return pl
 
 
+def get_eval_env_config():
+    """ Everything in get_player(train=False) and its seeds that changes the evaluation scores. """
+    # episodes go through all the levels, which are loaded relative to the working directory
+    return {'levels': EvalCache.hash_files(glob.glob('levels/*')), 'seed': EVAL_SEED,
+            'frame_skip': ACTION_REPEAT, 'image_shape': list(IMAGE_SIZE),
+            'frame_history': FRAME_HISTORY, 'max_length': MAX_EPISODE_LENGTH,
+            'flat_render': FLAT_RENDER}
+
+
 common.get_player = get_player  # so that eval functions in common can use the player
 
 
+class MyActor(ExpReplayActor):
+    def _build_player(self):
+        return get_player(train=True)
+
+
 class Model(ModelDesc):
     def _get_inputs(self):
         if NUM_ACTIONS is None:
             p = get_player()
             del p
-        return [InputVar(tf.float32, (None,) + IMAGE_SHAPE3, 'state'),
-                InputVar(tf.int64, (None,), 'action'),
-                InputVar(tf.float32, (None,), 'reward'),
-                InputVar(tf.float32, (None,) + IMAGE_SHAPE3, 'next_state'),
-                InputVar(tf.bool, (None,), 'isOver')]
+        inputs = [InputVar(tf.float32, (None,) + IMAGE_SHAPE3, 'state'),
+                  InputVar(tf.int64, (None,), 'action'),
+                  InputVar(tf.float32, (None,), 'reward'),
+                  InputVar(tf.float32, (None,) + IMAGE_SHAPE3, 'next_state'),
+                  InputVar(tf.bool, (None,), 'isOver')]
+        if PRIORITIZED:
+            inputs.extend([InputVar(tf.float32, (None,), 'isweight'),
+                           InputVar(tf.int64, (None,), 'idx')])
+        return inputs
 
     def _get_DQN_prediction(self, image):
         """ image: [0,255]"""
@@ -105,7 +155,7 @@ class Model(ModelDesc):
         return tf.identity(Q, name='Qvalue')
 
     def _build_graph(self, inputs):
-        state, action, reward, next_state, isOver = inputs
+        state, action, reward, next_state, isOver = inputs[:5]
         self.predict_value = self._get_DQN_prediction(state)
         action_onehot = tf.one_hot(action, NUM_ACTIONS, 1.0, 0.0)
         pred_action_value = tf.reduce_sum(self.predict_value * action_onehot, 1)  # N,
@@ -128,10 +178,18 @@ class Model(ModelDesc):
             predict_onehot = tf.one_hot(self.greedy_choice, NUM_ACTIONS, 1.0, 0.0)
             best_v = tf.reduce_sum(targetQ_predict_value * predict_onehot, 1)
 
-        target = reward + (1.0 - tf.cast(isOver, tf.float32)) * GAMMA * tf.stop_gradient(best_v)
+        # reward is the discounted return of NSTEP steps, see ReplayMemory.sample
+        target = reward + (1.0 - tf.cast(isOver, tf.float32)) * (GAMMA ** NSTEP) * tf.stop_gradient(best_v)
 
-        self.cost = tf.reduce_mean(symbf.huber_loss(
-                                   target - pred_action_value), name='cost')
+        td_error = target - pred_action_value
+        if not PRIORITIZED:
+            self.cost = tf.reduce_mean(symbf.huber_loss(td_error), name='cost')
+        else:
+            isweight, idx = inputs[5:]
+            # fetched by PrioritizedExpReplay to update the priorities
+            tf.abs(td_error, name='td_error')
+            tf.identity(idx, name='sample_idx')
+            self.cost = tf.reduce_mean(isweight * symbf.huber_loss(td_error), name='cost')
         summary.add_param_summary(('conv.*/W', ['histogram', 'rms']),
                                   ('fc.*/W', ['histogram', 'rms']))   # monitor all W
         add_moving_summary(self.cost)
@@ -159,12 +217,38 @@ class Model(ModelDesc):
 
 
 
-def get_config():
-    logger.auto_set_dir()
-    M = Model()
-    dataset_train = ExpReplay(
+def get_predictor_config():
+    """ The predictor of the processes which get their weights from the trainer. """
+    if NUMPY_INFERENCE:
+        return NumpyDQNPredictor()
+    return PredictConfig(
+        model=Model(),
+        input_names=['state'],
+        output_names=['Qvalue'])
+
+
+def quantize_model(load, output):
+    if load.endswith('.npz'):
+        float_pred = NumpyDQNPredictor.load(load)
+    else:
+        float_pred = NumpyDQNPredictor(read_checkpoint(load))
+    logger.info("Recording {} states...".format(2 * QUANTIZE_STATES))
+    states = record_states(get_player(train=False), float_pred, 2 * QUANTIZE_STATES)
+    calib, val = states[:QUANTIZE_STATES], states[QUANTIZE_STATES:]
+    pred = QuantizedDQNPredictor(float_pred.params, calibrate(float_pred, calib))
+    agreement, max_diff = greedy_agreement(float_pred, pred, val)
+    logger.info("Greedy actions of the int8 model agree with the float model on {:.2%} "
+                "of {} states. Max Q value difference: {:.4f}".format(agreement, len(val), max_diff))
+    pred.save(output)
+    logger.info("int8 model saved to " + output)
+
+
+def get_expreplay(replay_dir, timer=None):
+    expreplay_cls = PrioritizedExpReplay if PRIORITIZED else ExpReplay
+    return expreplay_cls(
         predictor_io_names=(['state'], ['Qvalue']),
         player=get_player(train=True),
+        state_shape=IMAGE_SIZE + (1,),
         batch_size=BATCH_SIZE,
         memory_size=MEMORY_SIZE,
         init_memory_size=INIT_MEMORY_SIZE,
@@ -173,7 +257,62 @@ def get_config():
         exploration_epoch_anneal=EXPLORATION_EPOCH_ANNEAL,
         update_frequency=4,
         reward_clip=(-1, 1),
-        history_len=FRAME_HISTORY)
+        history_len=FRAME_HISTORY,
+        resume_dir=replay_dir,
+        compress=REPLAY_COMPRESS,
+        nstep=NSTEP,
+        gamma=GAMMA,
+        prefetch=PREFETCH,
+        timer=timer)
+
+
+def get_multi_actor_expreplay(replay_dir, timer=None):
+    assert not PRIORITIZED, "Prioritized replay doesn't work with multiple actors yet!"
+    name_base = str(uuid.uuid1())[:6]
+    PIPE_DIR = os.environ.get('TENSORPACK_PIPEDIR', '.').rstrip('/')
+    namec2s = 'ipc://{}/actor-c2s-{}'.format(PIPE_DIR, name_base)
+    dataset_train = MultiActorExpReplay(
+        namec2s, NR_ACTOR,
+        state_shape=IMAGE_SIZE + (1,),
+        batch_size=BATCH_SIZE,
+        memory_size=MEMORY_SIZE,
+        init_memory_size=INIT_MEMORY_SIZE,
+        exploration=INIT_EXPLORATION,
+        end_exploration=END_EXPLORATION,
+        exploration_epoch_anneal=EXPLORATION_EPOCH_ANNEAL,
+        history_len=FRAME_HISTORY,
+        resume_dir=replay_dir,
+        compress=REPLAY_COMPRESS,
+        nstep=NSTEP,
+        gamma=GAMMA,
+        prefetch=PREFETCH,
+        timer=timer)
+
+    pred_config = get_predictor_config()
+    # the i-th actor uses exploration ** (1 + 7i/(N-1)), as in Ape-X
+    procs = [MyActor(k, namec2s, dataset_train.shared_dic, dataset_train.weights,
+                     pred_config, FRAME_HISTORY,
+                     exploration_exponent=7. * k / max(NR_ACTOR - 1, 1),
+                     reward_clip=(-1, 1))
+             for k in range(NR_ACTOR)]
+    ensure_proc_terminate(procs)
+    # actors predict on CPU
+    with change_env('CUDA_VISIBLE_DEVICES', ''):
+        start_proc_mask_signal(procs)
+    return dataset_train
+
+
+def get_config(replay_dir=None):
+    logger.auto_set_dir()
+    M = Model()
+    timer = TimeBreakdown()
+    if NR_ACTOR > 0:
+        dataset_train = get_multi_actor_expreplay(replay_dir, timer)
+    else:
+        dataset_train = get_expreplay(replay_dir, timer)
+
+    # every evaluation process has its own game, unlike threads
+    eval_pool = EvalPool(get_predictor_config())
 
     lr = symbf.get_scalar_var('learning_rate', 1e-3, summary=True)
 
@@ -182,11 +321,14 @@ def get_config():
         optimizer=tf.train.AdamOptimizer(lr, epsilon=1e-3),
         callbacks=[
             ModelSaver(),
+            ReplayMemorySaver(dataset_train),
             ScheduledHyperParamSetter('learning_rate',
                                       [(150, 4e-4), (250, 1e-4), (350, 5e-5)]),
             RunOp(lambda: M.update_target_param()),
             dataset_train,
-            PeriodicCallback(Evaluator(EVAL_EPISODE, ['state'], ['Qvalue']), 3),
+            PeriodicCallback(Evaluator(EVAL_EPISODE, ['state'], ['Qvalue'], pool=eval_pool,
+                                       ci_width=EVAL_CI_WIDTH, time_budget=EVAL_TIME_BUDGET), 3),
+            timer,
             # HumanHyperParamSetter('learning_rate', 'hyper.txt'),
             # HumanHyperParamSetter(ObjAttrParam(dataset_train, 'exploration'), 'hyper.txt'),
         ],
@@ -200,11 +342,37 @@ def get_config():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
-    parser.add_argument('--load', help='load model')
+    parser.add_argument('--load', help='load model. For play and eval, it can also be '
+                        'an .npz written by the export or quantize task')
     parser.add_argument('--task', help='task to perform',
-                        choices=['play', 'eval', 'train'], default='train')
+                        choices=['play', 'eval', 'train', 'export', 'quantize'], default='train')
+    parser.add_argument('--output', help='the .npz written by the export or quantize task. '
+                        'Defaults to the checkpoint name + .npz or .int8.npz')
+    parser.add_argument('--numpy-inference', help='actors and evaluators predict with NumPy, '
+                        'without a TensorFlow session', action='store_true')
     parser.add_argument('--algo', help='algorithm',
                         choices=['DQN', 'Double', 'Dueling'], default='Double')
+    parser.add_argument('--prioritized', help='use prioritized experience replay',
+                        action='store_true')
+    parser.add_argument('--replay-compress', help='compress the frames in replay memory',
+                        choices=['zlib', 'lz4'])
+    parser.add_argument('--actors', help='number of actor processes to collect experience. '
+                        '0 to play in the training process', type=int, default=0)
+    parser.add_argument('--nstep', help='number of steps of the returns to learn from',
+                        type=int, default=1)
+    parser.add_argument('--prefetch', help='number of batches to sample from the replay memory '
+                        'ahead of time. 0 to sample in the training loop', type=int, default=PREFETCH)
+    parser.add_argument('--eval-ci-width', help='stop evaluation early when the 95%% confidence '
+                        'interval of the mean score is narrower than this', type=float)
+    parser.add_argument('--eval-time', help='stop evaluation early after this many seconds', type=float)
+    parser.add_argument('--flat-render', help='draw the game in flat colors without pygame. '
+                        'Models must be played and evaluated with the rendering they were trained on',
+                        action='store_true')
+    parser.add_argument('--reset-cache', help='start training episodes from this many cached '
+                        'snapshots of each level. Needs --flat-render', type=int, default=0)
+    parser.add_argument('--fidelity', help='"training" skips the changes which are only visual, '
+                        'e.g. animations, in training. Needs --flat-render, whose frames don\'t show them',
+                        choices=['full', 'training'], default='full')
     args = parser.parse_args()
 
     if args.gpu:
@@ -212,20 +380,48 @@ if __name__ == '__main__':
     if args.task != 'train':
         assert args.load is not None
     METHOD = args.algo
-
-    if args.task != 'train':
+    PRIORITIZED = args.prioritized
+    REPLAY_COMPRESS = args.replay_compress
+    NR_ACTOR = args.actors
+    NSTEP = args.nstep
+    PREFETCH = args.prefetch
+    NUMPY_INFERENCE = args.numpy_inference
+    EVAL_CI_WIDTH = args.eval_ci_width
+    EVAL_TIME_BUDGET = args.eval_time
+    FLAT_RENDER = args.flat_render
+    RESET_CACHE = args.reset_cache
+    assert FLAT_RENDER or not RESET_CACHE, "--reset-cache needs --flat-render"
+    TRAIN_FIDELITY = args.fidelity
+    assert FLAT_RENDER or TRAIN_FIDELITY == 'full', "--fidelity training needs --flat-render"
+
+    if args.task == 'export':
+        output = args.output or args.load + '.npz'
+        export_checkpoint(args.load, output)
+        logger.info("Q-network exported to " + output)
+    elif args.task == 'quantize':
+        base = args.load[:-len('.npz')] if args.load.endswith('.npz') else args.load
+        quantize_model(args.load, args.output or base + '.int8.npz')
+    elif args.task != 'train':
         print('!!!!!!!!!!!!resume!!!')
-        cfg = PredictConfig(
-            model=Model(),
-            session_init=SaverRestore(args.load),
-            input_names=['state'],
-            output_names=['Qvalue'])
+        if args.load.endswith('.npz'):
+            cfg = load_predictor(args.load)
+        else:
+            cfg = PredictConfig(
+                model=Model(),
+                session_init=SaverRestore(args.load),
+                input_names=['state'],
+                output_names=['Qvalue'])
         if args.task == 'play':
             play_model(cfg)
         elif args.task == 'eval':
-            eval_model_multithread(cfg, EVAL_EPISODE)
+            # scores are cached next to the checkpoints
+            cache = EvalCache(os.path.join(os.path.dirname(args.load), 'eval-cache.json'))
+            key = EvalCache.key(EvalCache.hash_checkpoint(args.load), get_eval_env_config())
+            eval_model_multiprocess(cfg, EVAL_EPISODE, cache=cache, cache_key=key, seed=EVAL_SEED)
     else:
-        config = get_config()
+        # resume the replay memory saved next to the checkpoint, if any
+        replay_dir = os.path.join(os.path.dirname(args.load), 'replay') if args.load else None
+        config = get_config(replay_dir)
         if args.load:
             config.session_init = SaverRestore(args.load)
         QueueInputTrainer(config).train()
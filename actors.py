@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: actors.py
+
+import numpy as np
+import tensorflow as tf
+import os
+import json
+import time
+import threading
+import multiprocessing as mp
+from abc import abstractmethod, ABCMeta
+from collections import deque
+import six
+from six.moves import range
+import zmq
+
+from tensorpack.dataflow import DataFlow
+from tensorpack.callbacks.base import Callback
+from tensorpack.models.common import disable_layer_logging
+from tensorpack.predict import OfflinePredictor, PredictConfig
+from tensorpack.tfutils.varmanip import SessionUpdate
+from tensorpack.utils import logger, get_tqdm, get_rng
+from tensorpack.utils.serialize import loads, dumps
+
+from expreplay import ExpReplay, ReplayMemory, CompressedReplayMemory, BatchPrefetcher, _timed
+from common import SharedWeights
+
+__all__ = ['ExpReplayActor', 'MultiActorExpReplay']
+
+
+@six.add_metaclass(ABCMeta)
+class ExpReplayActor(mp.Process):
+    """
+    A process which plays with its own player and an epsilon-greedy policy,
+    and streams batches of consecutive transitions to a :class:`MultiActorExpReplay`.
+
+    The weights are read from a :class:`SharedWeights`, and the base
+    exploration from a shared dict, both written by the learner.
+    Start me under some CUDA_VISIBLE_DEVICES set!
+    """
+
+    def __init__(self, idx, pipe_c2s, shared_dic, weights, pred_config, history_len,
+                 exploration_exponent=0., reward_clip=None,
+                 send_batch_size=100, refresh_interval=1000):
+        """
+        Args:
+            idx (int): index of this actor, in ``[0, nr_actor)``.
+            pipe_c2s (str): the ZMQ address of the learner.
+            shared_dic: a ``multiprocessing.Manager().dict()`` written by the learner.
+            weights (SharedWeights): written by the learner.
+            pred_config (PredictConfig): config to predict Q values from a state.
+                It can also be a predictor with an ``update(params)`` method,
+                e.g. :class:`NumpyDQNPredictor`, which then needs no session.
+            history_len (int): number of frames to concat into one state.
+            exploration_exponent (float): the epsilon of this actor is
+                ``exploration ** (1 + exploration_exponent)``, so that
+                actors explore differently.
+            send_batch_size (int): number of transitions sent in one message.
+            refresh_interval (int): check for new weights every this many steps.
+        """
+        super(ExpReplayActor, self).__init__()
+        self.idx = int(idx)
+        self.name = u'actor-{}'.format(self.idx)
+        self.pipe_c2s = pipe_c2s
+        self.shared_dic = shared_dic
+        self.weights = weights
+        self.pred_config = pred_config
+        self.history_len = history_len
+        self.exploration_exponent = exploration_exponent
+        self.reward_clip = reward_clip
+        self.send_batch_size = send_batch_size
+        self.refresh_interval = refresh_interval
+
+    @abstractmethod
+    def _build_player(self):
+        pass
+
+    def _refresh(self):
+        while 'version' not in self.shared_dic:
+            time.sleep(1)   # the learner has not started yet
+        if self.weights.version != self._version:
+            self._version = self.weights.apply(self._update_params)
+        self.exploration = self.shared_dic['exploration'] ** (1 + self.exploration_exponent)
+
+    def run(self):
+        player = self._build_player()
+        num_actions = player.get_action_space().num_actions()
+        rng = get_rng(self)
+
+        if isinstance(self.pred_config, PredictConfig):
+            disable_layer_logging()
+            self.predictor = OfflinePredictor(self.pred_config)
+            with self.predictor.graph.as_default():
+                self._update_params = SessionUpdate(
+                    self.predictor.session, tf.trainable_variables()).update
+            self.predictor.graph.finalize()
+        else:
+            self.predictor = self.pred_config
+            self._update_params = self.predictor.update
+        self._version = 0
+
+        context = zmq.Context()
+        c2s_socket = context.socket(zmq.PUSH)
+        c2s_socket.set_hwm(5)
+        c2s_socket.connect(self.pipe_c2s)
+
+        hist = deque(maxlen=self.history_len - 1)
+        buf = [[] for _ in range(4)]
+        step = 0
+        while True:
+            if step % self.refresh_interval == 0:
+                self._refresh()
+            step += 1
+
+            s = player.current_state()
+            if rng.rand() <= self.exploration:
+                act = rng.choice(num_actions)
+            else:
+                ss = [np.zeros_like(s)] * (hist.maxlen - len(hist))
+                ss.extend(hist)
+                ss.append(s)
+                q_values = self.predictor([[np.concatenate(ss, axis=2)]])[0][0]
+                act = np.argmax(q_values)
+            reward, isOver = player.action(act)
+            if self.reward_clip:
+                reward = np.clip(reward, self.reward_clip[0], self.reward_clip[1])
+            if isOver:
+                hist.clear()
+            else:
+                hist.append(s)
+
+            for lst, v in zip(buf, [s, act, reward, isOver]):
+                lst.append(v)
+            if len(buf[0]) == self.send_batch_size:
+                scores = player.stats['score']
+                c2s_socket.send(dumps([
+                    self.idx, np.stack(buf[0]),
+                    np.asarray(buf[1], dtype='int32'),
+                    np.asarray(buf[2], dtype='float32'),
+                    np.asarray(buf[3], dtype='bool'),
+                    list(scores)]), copy=False)
+                player.reset_stat()
+                buf = [[] for _ in range(4)]
+
+
+class MultiActorExpReplay(DataFlow, Callback):
+    """
+    An experience replay filled by several :class:`ExpReplayActor` processes,
+    so that environment stepping does not block the training.
+
+    Each actor writes to its own shard of the memory, because transitions of
+    different actors cannot be interleaved in one frame sequence.
+    Shards are sampled in proportion to their size, and every shard has its
+    own lock, so that a batch is never read while it is being written.
+    The weights are sent to the actors through a :class:`SharedWeights`.
+    It produces datapoints in the same format as :class:`ExpReplay`.
+    """
+
+    def __init__(self,
+                 pipe_c2s,
+                 nr_actor,
+                 state_shape,
+                 batch_size=32,
+                 memory_size=1e6,
+                 init_memory_size=50000,
+                 exploration=1,
+                 end_exploration=0.1,
+                 exploration_epoch_anneal=0.002,
+                 history_len=1,
+                 sync_interval=1000,
+                 resume_dir=None,
+                 compress=None,
+                 nstep=1,
+                 gamma=0.99,
+                 prefetch=0,
+                 nr_sampler=1,
+                 timer=None):
+        """
+        Args:
+            pipe_c2s (str): the ZMQ address to receive transitions from.
+            nr_actor (int): number of actors.
+            sync_interval (int): send the weights to actors every this many steps.
+
+            Other arguments are the same as :class:`ExpReplay`.
+        """
+        init_memory_size = int(init_memory_size)
+        for k, v in locals().items():
+            if k != 'self':
+                setattr(self, k, v)
+        shard_size = int(memory_size) // nr_actor
+        if compress is None:
+            self.mems = [ReplayMemory(shard_size, state_shape, history_len)
+                         for _ in range(nr_actor)]
+        else:
+            self.mems = [CompressedReplayMemory(shard_size, state_shape, history_len, compress)
+                         for _ in range(nr_actor)]
+        self.rng = get_rng(self)
+        # held to access the scores, or to save all the shards
+        self.mem_lock = threading.Lock()
+        self.shard_locks = [threading.Lock() for _ in range(nr_actor)]
+        self._init_memory_flag = threading.Event()
+        self._scores = []
+        self._prefetcher = None
+
+        # the dict only holds the exploration and the version, and the
+        # weights are shared without pickling them for every actor
+        self.manager = mp.Manager()
+        self.shared_dic = self.manager.dict()
+        self.weights = SharedWeights()
+
+        self.context = zmq.Context()
+        self.c2s_socket = self.context.socket(zmq.PULL)
+        self.c2s_socket.bind(pipe_c2s)
+        self.c2s_socket.set_hwm(2 * nr_actor)
+
+    def __len__(self):
+        return sum(len(m) for m in self.mems)
+
+    def _recv_loop(self):
+        try:
+            while True:
+                idx, state, action, reward, isOver, scores = loads(
+                    self.c2s_socket.recv(copy=False).bytes)
+                with self.shard_locks[idx]:
+                    self.mems[idx].append_batch(state, action, reward, isOver)
+                with self.mem_lock:
+                    self._scores.extend(scores)
+                if self.timer is not None:
+                    self.timer.add_env_steps(len(action))
+        except zmq.ContextTerminated:
+            logger.info("[MultiActorExpReplay] Context was terminated.")
+
+    def get_data(self):
+        self._init_memory_flag.wait()
+        while True:
+            if self._prefetcher is None:
+                with _timed(self.timer, 'sample'):
+                    batch = self._sample_batch(self.rng)
+            else:
+                with _timed(self.timer, 'sample_wait'):
+                    batch = self._prefetcher.get()
+            yield batch
+
+    def _prefetch_batch(self, rng, out):
+        with _timed(self.timer, 'sample'):
+            return self._sample_batch(rng, out)
+
+    def _sample_sizes(self):
+        """ number of transitions which can be sampled from every shard """
+        h = self.history_len
+        return np.array([max(len(m) - h - self.nstep, 0) for m in self.mems], dtype='float64')
+
+    def _sample_batch(self, rng, out=None):
+        sizes = self._sample_sizes()
+        if sizes.sum() == 0:
+            raise ValueError("No shard of the replay memory has more than history_len + nstep = {} "
+                             "transitions to sample from!".format(self.history_len + self.nstep))
+        shard = rng.choice(self.nr_actor, size=self.batch_size, p=sizes / sizes.sum())
+        # the sizes only grow, so the indices are still valid under the lock
+        if out is not None:
+            # every shard fills a slice of the buffers
+            start = 0
+            for k in np.unique(shard):
+                n = (shard == k).sum()
+                idx = rng.randint(int(sizes[k]), size=n)
+                with self.shard_locks[k]:
+                    self.mems[k].sample(idx, self.nstep, self.gamma,
+                                        [o[start:start + n] for o in out])
+                start += n
+            return out
+        parts = []
+        for k in np.unique(shard):
+            idx = rng.randint(int(sizes[k]), size=(shard == k).sum())
+            with self.shard_locks[k]:
+                parts.append(self.mems[k].sample(idx, self.nstep, self.gamma))
+        state, action, reward, next_state, isOver = [
+            np.concatenate(x, axis=0) for x in zip(*parts)]
+        return [state, action.astype('int8'), reward, next_state, isOver]
+
+    def _sync(self):
+        # vars are written by name so that actors can load them with SessionUpdate
+        values = self.trainer.sess.run(self.vars)
+        self.weights.write({v.name: val for v, val in zip(self.vars, values)})
+        self.shared_dic['exploration'] = self.exploration
+        self.shared_dic['version'] = self.shared_dic.get('version', -1) + 1
+
+    # Callback-related:
+    def _setup_graph(self):
+        self.vars = tf.trainable_variables()
+
+    def _before_train(self):
+        self._sync()
+        self._recv_th = threading.Thread(target=self._recv_loop)
+        self._recv_th.daemon = True
+        self._recv_th.start()
+
+        if self.resume_dir is not None and \
+                ReplayMemory._read_meta(self._shard_dir(self.resume_dir, 0)) is not None:
+            for k, m in enumerate(self.mems):
+                with self.shard_locks[k]:
+                    m.load(self._shard_dir(self.resume_dir, k))
+            fname = os.path.join(self.resume_dir, ExpReplay.EXTRA_STATE_FILE)
+            if os.path.isfile(fname):
+                with open(fname) as f:
+                    self.exploration = json.load(f)['exploration']
+            self._sync()
+        else:
+            logger.info("Populating replay memory with {} actors...".format(self.nr_actor))
+            with get_tqdm(total=self.init_memory_size) as pbar:
+                while len(self) < self.init_memory_size:
+                    n = len(self)
+                    time.sleep(0.5)
+                    pbar.update(len(self) - n)
+        # e.g. a small init_memory_size split into many shards
+        while not self._sample_sizes().any():
+            time.sleep(0.5)
+        if self.prefetch > 0:
+            spec = self.mems[0].batch_spec(self.batch_size)
+            spec[1] = (spec[1][0], 'int8')
+            rngs = [np.random.RandomState(self.rng.randint(2**31)) for _ in range(self.nr_sampler)]
+            self._prefetcher = BatchPrefetcher(self._prefetch_batch, spec, self.prefetch, rngs)
+            self._prefetcher.start()
+        self._init_memory_flag.set()
+
+    def _trigger_step(self):
+        if self.local_step % self.sync_interval == 0:
+            self._sync()
+
+    def _trigger_epoch(self):
+        if self.exploration > self.end_exploration:
+            self.exploration -= self.exploration_epoch_anneal
+            logger.info("Exploration changed to {}".format(self.exploration))
+        self._sync()
+        with self.mem_lock:
+            scores, self._scores = self._scores, []
+        if len(scores):
+            self.trainer.add_scalar_summary('expreplay/mean_score', np.mean(scores))
+            self.trainer.add_scalar_summary('expreplay/max_score', np.max(scores))
+        if self._prefetcher is not None and self._prefetcher.nr_get:
+            p = self._prefetcher
+            self.trainer.add_scalar_summary('expreplay/prefetch_wait', float(p.nr_wait) / p.nr_get)
+            p.nr_get = p.nr_wait = 0
+
+    # Checkpoint-related, see ReplayMemorySaver:
+    @staticmethod
+    def _shard_dir(dirname, k):
+        return os.path.join(dirname, 'shard-{}'.format(k))
+
+    def save(self, dirname):
+        with self.mem_lock:
+            for k, m in enumerate(self.mems):
+                with self.shard_locks[k]:
+                    m.save(self._shard_dir(dirname, k))
+            with open(os.path.join(dirname, ExpReplay.EXTRA_STATE_FILE), 'w') as f:
+                json.dump({'exploration': self.exploration}, f)
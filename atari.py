@@ -34,7 +34,8 @@ class AtariPlayer(RLEnvironment):
     """
 
     def __init__(self, viz=0, height_range=(None, None),
-                 frame_skip=4, image_shape=(84,84), nullop_start=30):
+                 frame_skip=4, image_shape=(84,84), nullop_start=30, render=True,
+                 reset_cache=0, fidelity='full'):
         """
         :param frame_skip: skip every k frames and repeat the action
         :param image_shape: (w, h)
@@ -45,10 +46,16 @@ class AtariPlayer(RLEnvironment):
             Set to a string to be a directory to store frames.
         :param nullop_start: start with random number of null ops
         :param live_losts_as_eoe: consider lost of lives as end of episode.  useful for training.
+        :param render: draw the game with pygame. If False, the game runs without
+            pygame and the screen is drawn in flat colors by tanks.ArrayRenderer.
+        :param reset_cache: number of snapshots per level to start episodes from,
+            after the first enemies have spawned. Needs render=False.
+        :param fidelity: 'full', or 'training' to skip animations and other
+            changes which are only visual. The game rules and timing are the same.
         """
         super(AtariPlayer, self).__init__()
         
-        self.game = Game()
+        self.game = Game(render=render, reset_cache=reset_cache, fidelity=fidelity)
 
         # viz setup
         if isinstance(viz, six.string_types):
@@ -64,6 +71,9 @@ class AtariPlayer(RLEnvironment):
         
         self.width, self.height = 416,416
         self.actions = [0,1,2,3,4,5,6,7,8]
+        self.rng = get_rng(self)
+        self.action_space = DiscreteActionSpace(len(self.actions))
+        self.action_space.rng = self.rng
         
         self.frame_skip = frame_skip
         self.nullop_start = nullop_start
@@ -100,7 +110,15 @@ class AtariPlayer(RLEnvironment):
         return ret.astype('uint8')  # to save some memory
 
     def get_action_space(self):
-        return DiscreteActionSpace(len(self.actions))
+        return self.action_space
+
+    def seed(self, seed):
+        """
+        Seed the game and the action space, to make the next episodes reproducible.
+        The game draws from the global generator of the random module.
+        """
+        random.seed(seed)
+        self.rng.seed(seed)
 
     def finish_episode(self):
         self.stats['score'].append(self.current_episode_score)
@@ -3,9 +3,12 @@
 # File: simulator.py
 # Author: Yuxin Wu <ppwwyyxxc@gmail.com>
 
+import numpy as np
 import tensorflow as tf
 import multiprocessing as mp
+import os
 import time
+import struct
 import threading
 from abc import abstractmethod, ABCMeta
 from collections import defaultdict
@@ -16,15 +19,168 @@ import zmq
 
 from tensorpack.models.common import disable_layer_logging
 from tensorpack.callbacks import Callback
+from tensorpack.dataflow import DataFlow
 from tensorpack.tfutils.varmanip import SessionUpdate
 from tensorpack.predict import OfflinePredictor
+from tensorpack.predict.concurrency import MultiThreadAsyncPredictor, PredictorWorkerThread, Future
 from tensorpack.utils import logger
-from tensorpack.utils.serialize import loads, dumps
-from tensorpack.utils.concurrency import LoopThread, ensure_proc_terminate
+from tensorpack.utils.serialize import dumps
+from tensorpack.utils.concurrency import LoopThread, ensure_proc_terminate, start_proc_mask_signal
 
-__all__ = ['SimulatorProcess', 'SimulatorMaster',
+__all__ = ['SimulatorProcess', 'SimulatorMaster', 'pack_state', 'unpack_state',
            'SimulatorProcessStateExchange', 'SimulatorProcessSharedWeight',
-           'TransitionExperience', 'WeightSync']
+           'TransitionExperience', 'TrajectoryBuffer', 'SegmentBatchData',
+           'WeightSync', 'AdaptiveBatchPredictor', 'SimulatorPool', 'FrameHistory',
+           'DeltaEncoder', 'DeltaDecoder']
+
+
+# A state message is [identity, header, payload...]. header: reward, isOver,
+# step id, kind of payload, ndim, dtype, shape (up to 4 dims), tile size.
+# The payload of a RAW or KEY state is the state buffer, and the payload of a
+# DELTA state is the indices and contents of the tiles changed since the last state.
+_STATE_HEADER = struct.Struct('<d?qBB8s4iH')
+STATE_RAW, STATE_KEY, STATE_DELTA = 0, 1, 2
+# an action, and whether the master needs a keyframe
+_ACTION = struct.Struct('<i?')
+
+
+def _to_tiles(frame, tile):
+    """ H x W x ... -> nr_tile x tile x tile x ..., row-major over tiles. A copy. """
+    h, w = frame.shape[:2]
+    x = frame.reshape((h // tile, tile, w // tile, tile) + frame.shape[2:])
+    x = np.swapaxes(x, 1, 2)
+    return x.reshape((-1, tile, tile) + frame.shape[2:])
+
+
+class DeltaEncoder(object):
+    """
+    Encode the states of one simulator as the tiles changed since its previous
+    state, with a keyframe every keyframe_interval states or when requested.
+    """
+
+    def __init__(self, tile=12, keyframe_interval=100):
+        """
+        Args:
+            tile (int): size of the square tiles. States whose height or width
+                is not a multiple of it are always sent as keyframes.
+        """
+        self.tile = tile
+        self.keyframe_interval = keyframe_interval
+        self.prev = None
+        self._cnt = 0
+
+    def encode(self, state, force_key=False):
+        """
+        Returns:
+            (kind, tile, payload): kind is STATE_KEY or STATE_DELTA, payload is a list of arrays.
+        """
+        t = self.tile
+        key = self.prev is None or force_key or self._cnt % self.keyframe_interval == 0 or \
+            state.shape != self.prev.shape or state.shape[0] % t or state.shape[1] % t
+        self._cnt += 1
+        if key:
+            self.prev = state.copy()
+            return STATE_KEY, t, [state]
+        tiles = _to_tiles(state, t)
+        diff = (tiles != _to_tiles(self.prev, t)).reshape(len(tiles), -1).any(axis=1)
+        changed = np.nonzero(diff)[0].astype('uint16')
+        self.prev[...] = state
+        return STATE_DELTA, t, [changed, np.ascontiguousarray(tiles[changed])]
+
+
+class DeltaDecoder(object):
+    """
+    Rebuild the states of one simulator from :class:`DeltaEncoder` messages
+    into a preallocated buffer. When a state is missing in the sequence, no
+    state can be decoded until the next keyframe, which is then requested.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.last_step = None
+        self.need_keyframe = False
+
+    def decode(self, kind, step, tile, dtype, shape, payload):
+        """
+        Returns:
+            a copy of the state, or None if it cannot be decoded until the next keyframe.
+        """
+        self.last_step, last_step = step, self.last_step
+        if kind == STATE_KEY:
+            if self.buffer is None or self.buffer.shape != shape or self.buffer.dtype != dtype:
+                self.buffer = np.zeros(shape, dtype=dtype)
+            self.buffer[...] = np.frombuffer(payload[0].buffer, dtype=dtype).reshape(shape)
+            self.need_keyframe = False
+            return self.buffer.copy()
+        if self.need_keyframe:
+            return None
+        if self.buffer is None or step != last_step + 1:
+            logger.warn("[Simulator] State {} cannot be decoded. Requesting a keyframe.".format(step))
+            self.need_keyframe = True
+            return None
+        changed = np.frombuffer(payload[0].buffer, dtype='uint16')
+        nr_tile_col = shape[1] // tile
+        tiles = np.frombuffer(payload[1].buffer, dtype=dtype).reshape(
+            (len(changed), tile, tile) + shape[2:])
+        view = self.buffer.reshape((shape[0] // tile, tile, nr_tile_col, tile) + shape[2:])
+        view[changed // nr_tile_col, :, changed % nr_tile_col] = tiles
+        return self.buffer.copy()
+
+
+def pack_state(identity, state, reward, isOver, step, encoder=None, force_key=False):
+    """
+    Args:
+        encoder (DeltaEncoder): if None, send the whole state.
+        force_key (bool): send a keyframe with the encoder.
+
+    Returns:
+        the frames of a state message. The state is not copied if contiguous.
+    """
+    state = np.ascontiguousarray(state)
+    assert state.ndim <= 4, state.shape
+    if encoder is None:
+        kind, tile, payload = STATE_RAW, 0, [state]
+    else:
+        kind, tile, payload = encoder.encode(state, force_key)
+    shape = list(state.shape) + [0] * (4 - state.ndim)
+    header = _STATE_HEADER.pack(reward, isOver, step, kind, state.ndim,
+                                state.dtype.str.encode('ascii'), *(shape + [tile]))
+    return [identity, header] + payload
+
+
+def unpack_state(frames, decoders=None):
+    """
+    Args:
+        frames (list): zmq.Frame of a state message, received with ``copy=False``.
+        decoders (dict): {identity: DeltaDecoder}, to decode keyframes and deltas.
+            A decoder is created for every new identity.
+
+    Returns:
+        identity, state, reward, isOver, step. A RAW state is a read-only view
+        of the last frame, and other states are copies. The state is None if
+        its decoder cannot decode it, see :class:`DeltaDecoder`.
+    """
+    reward, isOver, step, kind, ndim, dtype, d0, d1, d2, d3, tile = _STATE_HEADER.unpack(frames[1].bytes)
+    ident = frames[0].bytes
+    shape = (d0, d1, d2, d3)[:ndim]
+    dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+    if kind == STATE_RAW:
+        state = np.frombuffer(frames[2].buffer, dtype=dtype).reshape(shape)
+    else:
+        decoder = decoders.get(ident)
+        if decoder is None:
+            decoder = decoders[ident] = DeltaDecoder()
+        state = decoder.decode(kind, step, tile, dtype, shape, frames[2:])
+    return ident, state, reward, isOver, step
+
+
+def pack_action(action, need_keyframe=False):
+    return _ACTION.pack(int(action), need_keyframe)
+
+
+def unpack_action(buf):
+    """ Returns: (action, need_keyframe) """
+    return _ACTION.unpack(buf)
 
 
 class TransitionExperience(object):
@@ -39,6 +195,121 @@ class TransitionExperience(object):
             setattr(self, k, v)
 
 
+class TrajectoryBuffer(object):
+    """
+    Transitions of one client in preallocated columns of
+    state, action, reward and value, up to a fixed capacity.
+    The state column is allocated with the shape and dtype of the first state.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.state = None
+        self.action = np.zeros((capacity,), dtype='int32')
+        self.reward = np.zeros((capacity,), dtype='float32')
+        self.value = np.zeros((capacity,), dtype='float32')
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, state, action, value):
+        """ append a transition, whose reward will be set later """
+        assert self.size < self.capacity
+        if self.state is None:
+            self.state = np.zeros((self.capacity,) + state.shape, dtype=state.dtype)
+        k = self.size
+        self.state[k] = state
+        self.action[k] = action
+        self.value[k] = value
+        self.size += 1
+
+    def set_last_reward(self, reward):
+        self.reward[self.size - 1] = reward
+
+    def keep_last(self):
+        """ remove all but the last transition """
+        for col in [self.state, self.action, self.reward, self.value]:
+            col[0] = col[self.size - 1]
+        self.size = 1
+
+    def clear(self):
+        self.size = 0
+
+
+class FrameHistory(object):
+    """
+    The last frames of one client in a ring buffer, to build the same
+    stacked state as :class:`HistoryFramePlayer` from single frames.
+    """
+
+    def __init__(self, hist_len, frame):
+        """
+        Args:
+            hist_len (int): number of frames in a state.
+            frame (np.ndarray): a H x W x C frame, to know the shape and dtype.
+        """
+        self.frames = np.zeros((hist_len,) + frame.shape, dtype=frame.dtype)
+        self.hist_len = hist_len
+        self.pos = 0    # where the next frame goes
+        self.size = 0
+
+    def push(self, frame, isOver):
+        """
+        Args:
+            frame: the newest frame.
+            isOver: whether an episode ended before this frame.
+
+        Returns:
+            the H x W x (hist_len*C) state ending with this frame, zero-filled
+            before the beginning of the episode.
+        """
+        if isOver:
+            self.size = 0
+        self.frames[self.pos] = frame
+        self.pos = (self.pos + 1) % self.hist_len
+        self.size = min(self.size + 1, self.hist_len)
+
+        order = (self.pos + np.arange(self.hist_len)) % self.hist_len
+        frames = self.frames[order]     # oldest to newest, a copy
+        frames[:self.hist_len - self.size] = 0
+        # hist_len x H x W x C -> H x W x (hist_len*C)
+        frames = np.moveaxis(frames, 0, -2)
+        return frames.reshape(frames.shape[:-2] + (-1,))
+
+
+class SegmentBatchData(DataFlow):
+    """
+    Produce batches of exactly batch_size datapoints from a queue of
+    segments, each a list of arrays with the same length.
+    """
+
+    def __init__(self, queue, batch_size, timer=None):
+        """
+        Args:
+            timer (TimeBreakdown): if given, time the waits for segments with it.
+        """
+        self.queue = queue
+        self.batch_size = batch_size
+        self.timer = timer
+
+    def get_data(self):
+        bs = self.batch_size
+        parts, cnt = [], 0
+        while True:
+            start = time.time()
+            seg = self.queue.get()
+            if self.timer is not None:
+                self.timer.add('queue_wait', time.time() - start)
+            parts.append(seg)
+            cnt += len(seg[0])
+            while cnt >= bs:
+                cat = [np.concatenate(x) for x in zip(*parts)] if len(parts) > 1 else parts[0]
+                yield [x[:bs] for x in cat]
+                cnt -= bs
+                parts = [[x[bs:] for x in cat]] if cnt else []
+
+
 @six.add_metaclass(ABCMeta)
 class SimulatorProcessBase(mp.Process):
     def __init__(self, idx):
@@ -46,6 +317,9 @@ class SimulatorProcessBase(mp.Process):
         self.idx = int(idx)
         self.name = u'simulator-{}'.format(self.idx)
         self.identity = self.name.encode('utf-8')
+        # cleared to pause the simulator, see SimulatorPool
+        self.running = mp.Event()
+        self.running.set()
 
     @abstractmethod
     def _build_player(self):
@@ -58,13 +332,17 @@ class SimulatorProcessStateExchange(SimulatorProcessBase):
     send states and receive the next action
     """
 
-    def __init__(self, idx, pipe_c2s, pipe_s2c):
+    def __init__(self, idx, pipe_c2s, pipe_s2c, delta_tile=None, keyframe_interval=100):
         """
         :param idx: idx of this process
+        :param delta_tile: if not None, send states as the changed tiles of
+            this size, see :class:`DeltaEncoder`.
         """
         super(SimulatorProcessStateExchange, self).__init__(idx)
         self.c2s = pipe_c2s
         self.s2c = pipe_s2c
+        self.delta_tile = delta_tile
+        self.keyframe_interval = keyframe_interval
 
     def run(self):
         player = self._build_player()
@@ -79,15 +357,23 @@ class SimulatorProcessStateExchange(SimulatorProcessBase):
         # s2c_socket.set_hwm(5)
         s2c_socket.connect(self.s2c)
 
+        encoder = None
+        if self.delta_tile is not None:
+            encoder = DeltaEncoder(self.delta_tile, self.keyframe_interval)
+
         state = player.current_state()
         reward, isOver = 0, False
+        step = 0
+        need_keyframe = False
         while True:
-            c2s_socket.send(dumps(
-                (self.identity, state, reward, isOver)),
+            self.running.wait()
+            c2s_socket.send_multipart(
+                pack_state(self.identity, state, reward, isOver, step, encoder, need_keyframe),
                 copy=False)
-            action = loads(s2c_socket.recv(copy=False).bytes)
+            action, need_keyframe = unpack_action(s2c_socket.recv(copy=False).bytes)
             reward, isOver = player.action(action)
             state = player.current_state()
+            step += 1
 
 
 # compatibility
@@ -104,10 +390,39 @@ class SimulatorMaster(threading.Thread):
         def __init__(self):
             self.memory = []    # list of Experience
 
-    def __init__(self, pipe_c2s, pipe_s2c):
+    class ClientStats(object):
+        """ counters of one client, since the last :meth:`SimulatorMaster.telemetry` """
+
+        def __init__(self):
+            self.last_seen = time.time()
+            self.last_step = -1
+            self.episode_len = 0
+            self.reset()
+
+        def reset(self):
+            self.nr_step = 0
+            self.nr_episode = 0
+            self.sum_episode_len = 0
+            self.nr_action = 0
+            self.sum_latency = 0.
+
+    def __init__(self, pipe_c2s, pipe_s2c, stall_timeout=60, frame_history=None):
+        """
+        Args:
+            stall_timeout (float): warn about a client which sent nothing for this many seconds.
+            frame_history (int): if not None, clients send single frames, and
+                the master stacks this many of them into a state.
+        """
         super(SimulatorMaster, self).__init__()
         self.daemon = True
         self.name = 'SimulatorMaster'
+        self.stall_timeout = stall_timeout
+        self.frame_history = frame_history
+        self.frame_histories = {}
+        self.frame_decoders = {}
+        self.client_stats = {}
+        self.paused = set()
+        self._telemetry_start = time.time()
 
         self.context = zmq.Context()
 
@@ -137,18 +452,32 @@ class SimulatorMaster(threading.Thread):
         atexit.register(clean_context, [self.c2s_socket, self.s2c_socket], self.context)
 
     def run(self):
-        self.clients = defaultdict(self.ClientState)
+        self.clients = {}
         try:
             while True:
-                msg = loads(self.c2s_socket.recv(copy=False).bytes)
-                ident, state, reward, isOver = msg
-                # TODO check history and warn about dead client
-                client = self.clients[ident]
+                frames = self.c2s_socket.recv_multipart(copy=False)
+                ident, state, reward, isOver, step = unpack_state(frames, self.frame_decoders)
+                self._update_stats(ident, isOver, step)
+                if state is None:
+                    # lost until the next keyframe: drop the unfinished
+                    # transitions of the client, and let it act blindly
+                    self.clients.pop(ident, None)
+                    self.frame_histories.pop(ident, None)
+                    self.send_action(ident, 0)
+                    continue
+                if self.frame_history is not None:
+                    hist = self.frame_histories.get(ident)
+                    if hist is None:
+                        hist = self.frame_histories[ident] = FrameHistory(self.frame_history, state)
+                    state = hist.push(state, isOver)
+                client = self.clients.get(ident)
+                if client is None:
+                    client = self.clients[ident] = self.ClientState()
 
                 # check if reward&isOver is valid
                 # in the first message, only state is valid
                 if len(client.memory) > 0:
-                    client.memory[-1].reward = reward
+                    self._set_last_reward(client, reward)
                     if isOver:
                         self._on_episode_over(ident)
                     else:
@@ -158,6 +487,78 @@ class SimulatorMaster(threading.Thread):
         except zmq.ContextTerminated:
             logger.info("[Simulator] Context was terminated.")
 
+    def _update_stats(self, ident, isOver, step):
+        stats = self.client_stats.get(ident)
+        if stats is None:
+            stats = self.client_stats[ident] = self.ClientStats()
+        stats.last_seen = time.time()
+        if step < stats.last_step:
+            logger.warn("[Simulator] {} was restarted.".format(ident.decode('utf-8')))
+            stats.episode_len = 0
+        stats.last_step = step
+        stats.nr_step += 1
+        stats.episode_len += 1
+        if isOver:
+            stats.nr_episode += 1
+            stats.sum_episode_len += stats.episode_len
+            stats.episode_len = 0
+
+    def _set_last_reward(self, client, reward):
+        """ the reward of the last transition of client has arrived """
+        client.memory[-1].reward = reward
+
+    def send_action(self, ident, action):
+        """ queue the action for the client ident """
+        stats = self.client_stats[ident]
+        stats.nr_action += 1
+        stats.sum_latency += time.time() - stats.last_seen
+        decoder = self.frame_decoders.get(ident)
+        need_keyframe = decoder is not None and decoder.need_keyframe
+        self.send_queue.put([ident, pack_action(action, need_keyframe)])
+
+    def pause_client(self, ident):
+        """ a client stops sending states, but keeps its episode, e.g. paused by :class:`SimulatorPool` """
+        self.paused.add(ident)
+
+    def resume_client(self, ident):
+        self.paused.discard(ident)
+        stats = self.client_stats.get(ident)
+        if stats is not None:
+            stats.last_seen = time.time()
+
+    def telemetry(self):
+        """
+        Warn about stalled clients, and reset the counters.
+
+        Returns:
+            dict: aggregated statistics of all clients since the last call:
+            number of clients and stalled clients, total and slowest steps/sec,
+            episodes, mean episode length and mean latency from a state to its action in ms.
+        """
+        now = time.time()
+        duration = max(now - self._telemetry_start, 1e-6)
+        self._telemetry_start = now
+        stats = [(ident, st) for ident, st in list(self.client_stats.items())
+                 if ident not in self.paused]
+        stalled = [(ident, now - st.last_seen) for ident, st in stats
+                   if now - st.last_seen > self.stall_timeout]
+        for ident, t in stalled:
+            logger.warn("[Simulator] {} sent nothing for {:.0f} seconds!".format(ident.decode('utf-8'), t))
+
+        nr_step = [st.nr_step for _, st in stats]
+        nr_episode = sum(st.nr_episode for _, st in stats)
+        nr_action = sum(st.nr_action for _, st in stats)
+        ret = {'nr_client': len(stats),
+               'nr_stalled': len(stalled),
+               'steps_per_sec': sum(nr_step) / duration,
+               'min_steps_per_sec': min(nr_step) / duration if nr_step else 0.,
+               'episodes': nr_episode,
+               'mean_episode_len': float(sum(st.sum_episode_len for _, st in stats)) / max(nr_episode, 1),
+               'action_latency_ms': 1000. * sum(st.sum_latency for _, st in stats) / max(nr_action, 1)}
+        for _, st in stats:
+            st.reset()
+        return ret
+
     @abstractmethod
     def _on_state(self, state, ident):
         """response to state sent by ident. Preferrably an async call"""
@@ -176,6 +577,205 @@ class SimulatorMaster(threading.Thread):
         self.context.destroy(linger=0)
 
 
+class AdaptiveBatchPredictorThread(PredictorWorkerThread):
+    def __init__(self, queue, pred_func, id, owner):
+        super(AdaptiveBatchPredictorThread, self).__init__(
+            queue, self._timed_func, id, batch_size=owner.max_batch_size)
+        self._pred_func = pred_func
+        self.owner = owner
+
+    def _timed_func(self, batched):
+        start = time.time()
+        ret = self._pred_func(batched)
+        self.owner._on_latency(time.time() - start)
+        return ret
+
+    def fetch_batch(self):
+        """ Fetch a batch of the size suggested by the owner, waiting at most
+            max_delay after the first task was put. """
+        tasks = [self.queue.get()]
+        target = self.owner.target_batch_size()
+        deadline = tasks[0][2] + self.owner.max_delay
+        while len(tasks) < target:
+            timeout = deadline - time.time()
+            try:
+                tasks.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        self.owner._on_batch([t for _, _, t in tasks])
+        batched = [list(x) for x in zip(*[inp for inp, _, _ in tasks])]
+        return batched, [f for _, f, _ in tasks]
+
+
+class AdaptiveBatchPredictor(MultiThreadAsyncPredictor):
+    """
+    A :class:`MultiThreadAsyncPredictor` whose batch size follows the load.
+    A worker takes all queued tasks, and waits for about as many tasks as
+    arrive during one forward pass, but never longer than ``max_delay``
+    after the first task of the batch was put.
+    """
+
+    def __init__(self, predictors, max_batch_size=64, max_delay=0.01, timer=None):
+        """
+        Args:
+            predictors (list): a list of OnlinePredictor avaiable to use.
+            max_batch_size (int): the maximum of a batch.
+            max_delay (float): the deadline of a task in the queue, in seconds.
+            timer (TimeBreakdown): if given, time the forward passes with it.
+        """
+        super(AdaptiveBatchPredictor, self).__init__(predictors, batch_size=max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.timer = timer
+        self.threads = [AdaptiveBatchPredictorThread(self.input_queue, f, id, self)
+                        for id, f in enumerate(predictors)]
+        self._lock = threading.Lock()
+        self._latency = 0.    # moving average of a forward pass
+        self._rate = 0.       # moving average of tasks per second
+        self._rate_start, self._rate_cnt = time.time(), 0
+        self._reset_stats()
+
+    def put_task(self, dp, callback=None):
+        f = Future()
+        if callback is not None:
+            f.add_done_callback(callback)
+        self.input_queue.put((dp, f, time.time()))
+        return f
+
+    def target_batch_size(self):
+        # the tasks which will arrive during one forward pass of each thread
+        expected = int(self._rate * self._latency / len(self.threads))
+        return min(self.max_batch_size, max(expected, self.input_queue.qsize() + 1))
+
+    def _on_latency(self, latency):
+        with self._lock:
+            self._latency = 0.9 * self._latency + 0.1 * latency
+        if self.timer is not None:
+            self.timer.add('predict', latency)
+
+    def _on_batch(self, put_times):
+        now = time.time()
+        with self._lock:
+            self._batch_sizes[len(put_times)] += 1
+            self._delay_sum += sum(now - t for t in put_times)
+            self._nr_task += len(put_times)
+            self._rate_cnt += len(put_times)
+            if now - self._rate_start > 0.5:
+                rate = self._rate_cnt / (now - self._rate_start)
+                self._rate = 0.8 * self._rate + 0.2 * rate
+                self._rate_start, self._rate_cnt = now, 0
+
+    def _reset_stats(self):
+        self._batch_sizes = defaultdict(int)
+        self._delay_sum = 0.
+        self._nr_task = 0
+        self._stats_start = time.time()
+
+    def stats(self):
+        """
+        Returns:
+            dict: statistics since the last call: histogram of batch sizes
+            ({size: count}), mean batch size, mean queueing delay and forward
+            latency in ms, and tasks per second.
+        """
+        with self._lock:
+            hist = dict(self._batch_sizes)
+            nr_batch = sum(hist.values())
+            ret = {'batch_size_hist': hist,
+                   'mean_batch_size': float(self._nr_task) / max(nr_batch, 1),
+                   'queue_delay_ms': 1000. * self._delay_sum / max(self._nr_task, 1),
+                   'latency_ms': 1000. * self._latency,
+                   'actions_per_sec': self._nr_task / (time.time() - self._stats_start)}
+            self._reset_stats()
+        return ret
+
+
+class SimulatorPool(Callback):
+    """
+    Simulator processes of a :class:`SimulatorMaster`, whose number of running
+    ones follows the load within ``[min_proc, max_proc]``.
+
+    All ``max_proc`` processes are started when the pool is constructed,
+    which has to be before the session is created: forking a process with
+    CUDA and zmq threads may deadlock. The ones not needed are paused, in
+    the middle of their episodes, with their ``running`` event. Paused
+    simulators keep their memory, so choose ``max_proc`` to fit in it.
+
+    Every ``interval`` seconds, a simulator is paused if the CPUs are
+    oversubscribed, the training queue is almost full, or many states wait
+    for the predictor. Simulators are resumed if none of them is the case and
+    the training queue is less than half full.
+    """
+
+    def __init__(self, proc_fn, master, min_proc, max_proc, interval=10, step=2):
+        """
+        Args:
+            proc_fn: a function which takes an index and returns a
+                :class:`SimulatorProcessStateExchange`.
+            master (SimulatorMaster): the master which the simulators talk to.
+                Its ``queue`` is the training queue, and its optional
+                ``async_predictor`` gives the number of states waiting for prediction.
+            step (int): number of simulators to resume at a time.
+        """
+        assert 0 < min_proc <= max_proc
+        self.master = master
+        self.min_proc = min_proc
+        self.max_proc = max_proc
+        self.interval = interval
+        self.step = step
+        self.procs = [proc_fn(k) for k in range(max_proc)]
+        for proc in self.procs[min_proc:]:
+            proc.running.clear()
+            master.pause_client(proc.identity)
+        self.nr_running = min_proc
+        ensure_proc_terminate(self.procs)
+        start_proc_mask_signal(self.procs)
+
+    def _resume(self, n):
+        for proc in self.procs[self.nr_running:self.nr_running + n]:
+            self.master.resume_client(proc.identity)
+            proc.running.set()
+        self.nr_running += n
+
+    def _pause(self):
+        self.nr_running -= 1
+        proc = self.procs[self.nr_running]
+        proc.running.clear()
+        self.master.pause_client(proc.identity)
+
+    def _decide(self):
+        """ Returns: number of simulators to resume, negative to pause. """
+        nr = self.nr_running
+        q = self.master.queue
+        fill = float(q.qsize()) / q.maxsize if q.maxsize > 0 else 0.
+        predictor = getattr(self.master, 'async_predictor', None)
+        waiting = predictor.input_queue.qsize() if predictor is not None else 0
+        load = os.getloadavg()[0] / mp.cpu_count()
+        if nr > self.min_proc and (load > 1. or fill > 0.9 or waiting > nr / 2):
+            return -1
+        if nr < self.max_proc and load < 0.8 and fill < 0.5 and waiting < nr / 4:
+            return min(self.step, self.max_proc - nr)
+        return 0
+
+    def _before_train(self):
+        self._last_check = time.time()
+
+    def _trigger_step(self):
+        if time.time() - self._last_check < self.interval:
+            return
+        self._last_check = time.time()
+        n = self._decide()
+        if n > 0:
+            self._resume(n)
+        elif n < 0:
+            self._pause()
+        if n != 0:
+            logger.info("[SimulatorPool] Number of running simulators changed to {}.".format(self.nr_running))
+
+    def _trigger_epoch(self):
+        self.trainer.add_scalar_summary('simulator/nr_proc', self.nr_running)
+
+
 class SimulatorProcessDF(SimulatorProcessBase):
     """ A simulator which contains a forward model itself, allowing
     it to produce data points directly """
@@ -213,10 +813,15 @@ class SimulatorProcessSharedWeight(SimulatorProcessDF):
     Start me under some CUDA_VISIBLE_DEVICES set!
     """
 
-    def __init__(self, idx, pipe_c2s, condvar, shared_dic, pred_config):
+    def __init__(self, idx, pipe_c2s, condvar, weights, pred_config):
+        """
+        Args:
+            weights (common.SharedWeights): written by :class:`WeightSync`.
+                Construct it before starting this process.
+        """
         super(SimulatorProcessSharedWeight, self).__init__(idx, pipe_c2s)
         self.condvar = condvar
-        self.shared_dic = shared_dic
+        self.weights = weights
         self.pred_config = pred_config
 
     def _prepare(self):
@@ -243,8 +848,9 @@ class SimulatorProcessSharedWeight(SimulatorProcessDF):
 
     def _trigger_evt(self):
         with self.weight_lock:
-            self.sess_updater.update(self.shared_dic['params'])
-            logger.info("Updated.")
+            # loaded directly from the shared memory
+            version = self.weights.apply(self.sess_updater.update)
+            logger.info("Updated to version {}.".format(version))
 
     def _params_to_update(self):
         # can be overwritten to update more params
@@ -252,11 +858,11 @@ class SimulatorProcessSharedWeight(SimulatorProcessDF):
 
 
 class WeightSync(Callback):
-    """ Sync weight from main process to shared_dic and notify"""
+    """ Sync weight from main process to a :class:`SharedWeights` and notify"""
 
-    def __init__(self, condvar, shared_dic):
+    def __init__(self, condvar, weights):
         self.condvar = condvar
-        self.shared_dic = shared_dic
+        self.weights = weights
 
     def _setup_graph(self):
         self.vars = self._params_to_update()
@@ -273,8 +879,8 @@ class WeightSync(Callback):
 
     def _sync(self):
         logger.info("Updating weights ...")
-        dic = {v.name: v.eval() for v in self.vars}
-        self.shared_dic['params'] = dic
+        values = self.trainer.sess.run(self.vars)
+        self.weights.write({v.name: val for v, val in zip(self.vars, values)})
         self.condvar.acquire()
         self.condvar.notify_all()
         self.condvar.release()
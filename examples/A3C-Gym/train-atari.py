@@ -29,7 +29,7 @@ from tensorpack.tfutils.gradproc import MapGradient, SummaryGradient
 from tensorpack.RL import *
 from simulator import *
 import common
-from common import (play_model, Evaluator, eval_model_multithread)
+from common import (play_model, Evaluator, eval_model_multithread, discounted_returns)
 
 IMAGE_SIZE = (84, 84)
 FRAME_HISTORY = 4
@@ -41,16 +41,23 @@ LOCAL_TIME_MAX = 5
 STEP_PER_EPOCH = 6000
 EVAL_EPISODE = 50
 BATCH_SIZE = 128
-SIMULATOR_PROC = 50
+# at most. all of them are started, and hold a game, even while paused by
+# the SimulatorPool. the pool doesn't run more than the CPUs can serve anyway
+SIMULATOR_PROC = min(2 * multiprocessing.cpu_count(), 50)
+SIMULATOR_PROC_MIN = 8
 PREDICTOR_THREAD_PER_GPU = 2
 PREDICTOR_THREAD = None
 EVALUATE_PROC = min(multiprocessing.cpu_count() // 2, 20)
 
 NUM_ACTIONS = None
 ENV_NAME = None
+# stack the history frames in the master instead of in every simulator
+MASTER_FRAME_HISTORY = False
+# send states as changed tiles of this size. 12 divides the 84x84 frames
+DELTA_TILE = None
 
 
-def get_player(viz=False, train=False, dumpdir=None):
+def get_player(viz=False, train=False, dumpdir=None, history=True):
     pl = GymEnv(ENV_NAME, dumpdir=dumpdir)
 
     def func(img):
@@ -60,7 +67,8 @@ def get_player(viz=False, train=False, dumpdir=None):
     global NUM_ACTIONS
     NUM_ACTIONS = pl.get_action_space().num_actions()
 
-    pl = HistoryFramePlayer(pl, FRAME_HISTORY)
+    if history:
+        pl = HistoryFramePlayer(pl, FRAME_HISTORY)
     if not train:
         pl = PreventStuckPlayer(pl, 30, 1)
     pl = LimitLengthPlayer(pl, 40000)
@@ -73,7 +81,7 @@ common.get_player = get_player
 class MySimulatorWorker(SimulatorProcess):
 
     def _build_player(self):
-        return get_player(train=True)
+        return get_player(train=True, history=not MASTER_FRAME_HISTORY)
 
 
 class Model(ModelDesc):
@@ -144,17 +152,35 @@ class Model(ModelDesc):
 
 
 class MySimulatorMaster(SimulatorMaster, Callback):
-    def __init__(self, pipe_c2s, pipe_s2c, model):
-        super(MySimulatorMaster, self).__init__(pipe_c2s, pipe_s2c)
+    class ClientState(object):
+        def __init__(self):
+            self.memory = TrajectoryBuffer(LOCAL_TIME_MAX + 1)
+
+    def __init__(self, pipe_c2s, pipe_s2c, model, timer=None):
+        super(MySimulatorMaster, self).__init__(
+            pipe_c2s, pipe_s2c, frame_history=FRAME_HISTORY if MASTER_FRAME_HISTORY else None)
         self.M = model
-        self.queue = queue.Queue(maxsize=BATCH_SIZE * 8 * 2)
+        self.timer = timer
+        # a queue of segments of at most LOCAL_TIME_MAX transitions
+        self.queue = queue.Queue(maxsize=BATCH_SIZE * 8 * 2 // LOCAL_TIME_MAX)
 
     def _setup_graph(self):
         self.sess = self.trainer.sess
-        self.async_predictor = MultiThreadAsyncPredictor(
+        # no point in batching more states than there are simulators
+        self.async_predictor = AdaptiveBatchPredictor(
             self.trainer.get_predict_funcs(['state'], ['logitsT', 'pred_value'],
-                                           PREDICTOR_THREAD), batch_size=15)
-        self.async_predictor.run()
+                                           PREDICTOR_THREAD), max_batch_size=SIMULATOR_PROC,
+            timer=self.timer)
+        self.async_predictor.start()
+
+    def _trigger_epoch(self):
+        stats = self.async_predictor.stats()
+        for k in ['mean_batch_size', 'queue_delay_ms', 'latency_ms', 'actions_per_sec']:
+            self.trainer.add_scalar_summary('predictor/' + k, stats[k])
+        logger.info("Predictor batch sizes: " + ', '.join(
+            '{}:{}'.format(k, v) for k, v in sorted(stats['batch_size_hist'].items())))
+        for k, v in six.iteritems(self.telemetry()):
+            self.trainer.add_scalar_summary('simulator/' + k, v)
 
     def _on_state(self, state, ident):
         def cb(outputs):
@@ -162,36 +188,38 @@ class MySimulatorMaster(SimulatorMaster, Callback):
             assert np.all(np.isfinite(distrib)), distrib
             action = np.random.choice(len(distrib), p=distrib)
             client = self.clients[ident]
-            client.memory.append(TransitionExperience(state, action, None, value=value))
-            self.send_queue.put([ident, dumps(action)])
+            client.memory.append(state, action, value)
+            self.send_action(ident, action)
+        if self.timer is not None:
+            self.timer.add_env_steps()
         self.async_predictor.put_task([state], cb)
 
     def _on_episode_over(self, ident):
         self._parse_memory(0, ident, True)
 
+    def _set_last_reward(self, client, reward):
+        client.memory.set_last_reward(reward)
+
     def _on_datapoint(self, ident):
         client = self.clients[ident]
         if len(client.memory) == LOCAL_TIME_MAX + 1:
-            R = client.memory[-1].value
+            R = client.memory.value[LOCAL_TIME_MAX]
             self._parse_memory(R, ident, False)
 
     def _parse_memory(self, init_r, ident, isOver):
-        client = self.clients[ident]
-        mem = client.memory
-        if not isOver:
-            last = mem[-1]
-            mem = mem[:-1]
+        mem = self.clients[ident].memory
+        # the last transition is kept for the next segment if not over
+        n = len(mem) if isOver else len(mem) - 1
 
-        mem.reverse()
-        R = float(init_r)
-        for idx, k in enumerate(mem):
-            R = np.clip(k.reward, -1, 1) + GAMMA * R
-            self.queue.put([k.state, k.action, R])
+        rewards = np.clip(mem.reward[:n], -1, 1)
+        returns = discounted_returns(rewards, np.zeros(n), GAMMA, bootstrap=init_r)
+        if n > 0:
+            self.queue.put([mem.state[:n].copy(), mem.action[:n].copy(), returns])
 
         if not isOver:
-            client.memory = [last]
+            mem.keep_last()
         else:
-            client.memory = []
+            mem.clear()
 
 
 def get_config():
@@ -202,12 +230,13 @@ def get_config():
     PIPE_DIR = os.environ.get('TENSORPACK_PIPEDIR', '.').rstrip('/')
     namec2s = 'ipc://{}/sim-c2s-{}'.format(PIPE_DIR, name_base)
     names2c = 'ipc://{}/sim-s2c-{}'.format(PIPE_DIR, name_base)
-    procs = [MySimulatorWorker(k, namec2s, names2c) for k in range(SIMULATOR_PROC)]
-    ensure_proc_terminate(procs)
-    start_proc_mask_signal(procs)
-
-    master = MySimulatorMaster(namec2s, names2c, M)
-    dataflow = BatchData(DataFromQueue(master.queue), BATCH_SIZE)
+    # environment steps run in the simulators: only counted by the master
+    timer = common.TimeBreakdown()
+    master = MySimulatorMaster(namec2s, names2c, M, timer)
+    # the number of simulators follows the load
+    sim_pool = SimulatorPool(lambda k: MySimulatorWorker(k, namec2s, names2c, delta_tile=DELTA_TILE),
+                             master, SIMULATOR_PROC_MIN, SIMULATOR_PROC)
+    dataflow = SegmentBatchData(master.queue, BATCH_SIZE, timer)
     return TrainConfig(
         dataflow=dataflow,
         callbacks=[
@@ -218,7 +247,9 @@ def get_config():
                                       [(80, 2), (100, 3), (120, 4), (140, 5)]),
             master,
             StartProcOrThread(master),
+            sim_pool,
             PeriodicCallback(Evaluator(EVAL_EPISODE, ['state'], ['logits']), 2),
+            timer,
         ],
         session_config=get_default_sess_config(0.5),
         model=M,
@@ -234,9 +265,16 @@ if __name__ == '__main__':
     parser.add_argument('--env', help='env', required=True)
     parser.add_argument('--task', help='task to perform',
                         choices=['play', 'eval', 'train'], default='train')
+    parser.add_argument('--master-history', action='store_true',
+                        help='simulators send single frames, and the master stacks them into states')
+    parser.add_argument('--delta-frames', action='store_true',
+                        help='simulators send only the tiles of a state changed since the last one. '
+                        'Useful when they are on another host')
     args = parser.parse_args()
 
     ENV_NAME = args.env
+    MASTER_FRAME_HISTORY = args.master_history
+    DELTA_TILE = 12 if args.delta_frames else None
     assert ENV_NAME
     p = get_player()
     del p    # set NUM_ACTIONS
@@ -2,16 +2,27 @@
 # -*- coding: utf-8 -*-
 # File: common.py
 # Author: Yuxin Wu <ppwwyyxxc@gmail.com>
+import os
+import json
+import atexit
+import glob
+import hashlib
 import random
 import time
+import tempfile
 import threading
+import uuid
 import multiprocessing
 import numpy as np
+import tensorflow as tf
 from tqdm import tqdm
 from six.moves import queue
 
 from tensorpack import *
-from tensorpack.predict import get_predict_func
+from tensorpack.predict import get_predict_func, OfflinePredictor
+from tensorpack.models.common import disable_layer_logging
+from tensorpack.tfutils.varmanip import SessionUpdate
+from tensorpack.RL.envbase import ProxyPlayer
 from tensorpack.utils.concurrency import *
 from tensorpack.utils.stats import *
 
@@ -19,6 +30,94 @@ global get_player
 get_player = None
 
 
+def _backward_recurrence(a, c, last):
+    """
+    Solve ``x_t = a_t + c_t * x_{t+1}`` backwards along the last axis, with
+    ``x_T = last``, in log2(T) steps which each cover the whole array.
+    After the step of shift s, ``x_t = a_t + c_t * x_{t+s}``.
+    """
+    shape = a.shape[:-1]
+    a = np.concatenate([a, np.broadcast_to(last, shape)[..., None]], axis=-1).astype('float32')
+    c = np.concatenate([c, np.zeros(shape + (1,))], axis=-1).astype('float32')
+    s = 1
+    while s < a.shape[-1]:
+        a[..., :-s] = a[..., :-s] + c[..., :-s] * a[..., s:]
+        c[..., :-s] = c[..., :-s] * c[..., s:]
+        s *= 2
+    return a[..., :-1]
+
+
+def discounted_returns(rewards, isOver, gamma, bootstrap=0):
+    """
+    Discounted returns ``R_t = r_t + gamma * (1 - isOver_t) * R_{t+1}`` of
+    every step of a batch of trajectory segments.
+
+    Args:
+        rewards (np.ndarray): B x T (or T) rewards.
+        isOver (np.ndarray): episode ends, of the same shape.
+        gamma (float):
+        bootstrap (float or np.ndarray): value of the state after the last step, of shape B (or scalar).
+
+    Returns:
+        np.ndarray: returns of the same shape as rewards.
+    """
+    rewards = np.asarray(rewards, dtype='float32')
+    notOver = 1.0 - np.asarray(isOver, dtype='float32')
+    return _backward_recurrence(rewards, gamma * notOver, np.asarray(bootstrap, dtype='float32'))
+
+
+def n_step_returns(rewards, isOver, gamma):
+    """
+    n-step returns of a batch of n-step segments, cut at episode ends.
+
+    Args:
+        rewards (np.ndarray): B x n rewards.
+        isOver (np.ndarray): B x n episode ends.
+        gamma (float):
+
+    Returns:
+        (np.ndarray, np.ndarray): the discounted sum of rewards of each segment
+        up to its episode end, and whether the segment contains an episode end.
+        The target of Q-learning is then ``R + (1 - isOver) * gamma ** n * max_a Q(s_{t+n}, a)``.
+    """
+    isOver = np.asarray(isOver, dtype='bool')
+    return discounted_returns(rewards, isOver, gamma)[..., 0], isOver.any(axis=-1)
+
+
+def lambda_returns(rewards, isOver, values, gamma, lam):
+    """
+    TD(lambda) returns
+    ``G_t = r_t + gamma * (1 - isOver_t) * ((1 - lam) * V_{t+1} + lam * G_{t+1})``.
+
+    Args:
+        rewards (np.ndarray): B x T (or T) rewards.
+        isOver (np.ndarray): episode ends, of the same shape.
+        values (np.ndarray): B x (T+1) (or T+1) predicted values. The last one bootstraps the return.
+        gamma, lam (float):
+
+    Returns:
+        np.ndarray: returns of the same shape as rewards.
+    """
+    rewards = np.asarray(rewards, dtype='float32')
+    notOver = 1.0 - np.asarray(isOver, dtype='float32')
+    values = np.asarray(values, dtype='float32')
+    a = rewards + gamma * notOver * (1 - lam) * values[..., 1:]
+    return _backward_recurrence(a, gamma * lam * notOver, values[..., -1])
+
+
+def seed_player(player, seed):
+    """
+    Make the next episodes of a player reproducible: seed the innermost
+    player, which needs a ``seed(seed)`` method, e.g. :class:`AtariPlayer`,
+    and restart the episode of it and of all the :class:`ProxyPlayer` around it.
+    """
+    inner = player
+    while isinstance(inner, ProxyPlayer):
+        inner = inner.player
+    inner.seed(seed)
+    player.restart_episode()
+
+
 def play_one_episode(player, func, verbose=False):
     def f(s):
         spc = player.get_action_space()
@@ -33,14 +132,169 @@ def play_one_episode(player, func, verbose=False):
 
 def play_model(cfg):
     player = get_player(viz=0.01)
-    predfunc = get_predict_func(cfg)
+    # cfg may also be a predictor which needs no session, e.g. NumpyDQNPredictor
+    predfunc = get_predict_func(cfg) if isinstance(cfg, PredictConfig) else cfg
     while True:
         score = play_one_episode(player, predfunc)
         print("Total:", score)
 
 
-def eval_with_funcs(predict_funcs, nr_eval):
+class _PredictResult(object):
+    """ The outputs of one call to :class:`BatchedPredictFunc`, set by its thread. """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def wait(self, timeout):
+        """ Returns: bool: whether the result is set. """
+        return self._event.wait(timeout)
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class BatchedPredictFunc(StoppableThread):
+    """
+    Collect the single-datapoint calls of several threads to a predict func,
+    and run them as one batch.
+    It is a drop-in replacement of the func for :func:`play_one_episode`.
+    """
+
+    def __init__(self, func, max_batch_size=32, max_wait=0.003):
+        """
+        Args:
+            func: a predict func which takes a list of batched input components.
+            max_batch_size (int): max number of datapoints to run together.
+            max_wait (float): seconds to wait for more datapoints after the
+                first one of a batch has arrived.
+        """
+        super(BatchedPredictFunc, self).__init__()
+        self.daemon = True
+        self._func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.q = queue.Queue()
+
+    def __call__(self, dp):
+        """
+        Args:
+            dp: list of input components, each with batch size 1.
+
+        Returns:
+            the outputs of func on dp, each with batch size 1.
+        """
+        f = _PredictResult()
+        self.q.put((dp, f))
+        while not f.wait(0.5):
+            # put after the thread had failed the pending calls
+            if not self.is_alive():
+                raise RuntimeError("stopped!")
+        return f.result()
+
+    def _get_batch(self):
+        try:
+            batch = [self.q.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.q.get(timeout=timeout) if timeout > 0 else self.q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while not self.stopped():
+            batch = self._get_batch()
+            if not batch:
+                continue
+            dps, futures = zip(*batch)
+            try:
+                inputs = [np.concatenate(x, axis=0) for x in zip(*dps)]
+                outputs = self._func(inputs)
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            for k, f in enumerate(futures):
+                f.set_result([o[k:k + 1] for o in outputs])
+        # don't leave callers waiting forever
+        while True:
+            try:
+                _, f = self.q.get_nowait()
+            except queue.Empty:
+                break
+            f.set_exception(RuntimeError("stopped!"))
+
+
+class SequentialEvalStat(object):
+    """
+    Statistics of the scores of a sequential evaluation, which stops as soon
+    as the confidence interval on the mean is narrow enough, or the time is up.
+    """
+
+    def __init__(self, ci_width=None, time_budget=None, min_episodes=5, z=1.96, min_std=None):
+        """
+        Args:
+            ci_width (float): stop when the confidence interval is narrower than this.
+            time_budget (float): stop after this many seconds.
+            min_episodes (int): never stop on ci_width before this many episodes.
+            z (float): the interval is ``mean +- z * std / sqrt(n)``. 1.96 for 95%.
+            min_std (float): a floor on the std used for the interval, so that a
+                few equal scores (e.g. a deterministic policy) don't stop the
+                evaluation at once. Defaults to ``ci_width``, which takes
+                ``(2 * z) ** 2`` (about 16) episodes when all scores are equal.
+        """
+        self.ci_width = ci_width
+        self.min_std = ci_width if min_std is None else min_std
+        self.time_budget = time_budget
+        self.min_episodes = max(min_episodes, 2)
+        self.z = z
+        self.moments = OnlineMoments()
+        self.stat = StatCounter()
+        self._start_time = time.time()
+
+    def feed(self, score):
+        self.moments.feed(score)
+        self.stat.feed(score)
+
+    @property
+    def half_width(self):
+        """ half of the width of the confidence interval, inf before 2 episodes. """
+        if self.stat.count < 2:
+            return float('inf')
+        std = max(self.moments.std, self.min_std or 0)
+        return self.z * std / np.sqrt(self.stat.count)
+
+    def should_stop(self):
+        if self.time_budget is not None and time.time() - self._start_time > self.time_budget:
+            return True
+        return self.ci_width is not None and self.stat.count >= self.min_episodes and \
+            2 * self.half_width <= self.ci_width
+
+
+def eval_with_funcs(predict_funcs, nr_eval, seq_stat=None):
+    """
+    Args:
+        seq_stat (SequentialEvalStat): if given, stop before nr_eval episodes
+            when it says so. It is fed with all scores.
+    """
     class Worker(StoppableThread):
+
         def __init__(self, func, queue):
             super(Worker, self).__init__()
             self._func = func
@@ -59,10 +313,20 @@ def eval_with_funcs(predict_funcs, nr_eval):
                     # print "Score, ", score
                 except RuntimeError:
                     return
+                except Exception as e:
+                    # let the main thread know, instead of having it wait forever
+                    self.queue_put_stoppable(self.q, e)
+                    return
                 self.queue_put_stoppable(self.q, score)
 
+    # threads sharing a func run their states together in one batch
+    batchers = {}
+    for f in predict_funcs:
+        if f not in batchers:
+            batchers[f] = BatchedPredictFunc(f, max_batch_size=len(predict_funcs))
+            batchers[f].start()
     q = queue.Queue()
-    threads = [Worker(f, q) for f in predict_funcs]
+    threads = [Worker(batchers[f], q) for f in predict_funcs]
 
     for k in threads:
         k.start()
@@ -71,18 +335,31 @@ def eval_with_funcs(predict_funcs, nr_eval):
     try:
         for _ in tqdm(range(nr_eval), **get_tqdm_kwargs()):
             r = q.get()
+            if isinstance(r, Exception):
+                raise r
             stat.feed(r)
+            if seq_stat is not None:
+                seq_stat.feed(r)
+                if seq_stat.should_stop():
+                    break
+    except:
+        logger.exception("Eval")
+    finally:
         logger.info("Waiting for all the workers to finish the last run...")
         for k in threads:
             k.stop()
-        for k in threads:
+        # workers waiting for a prediction get a RuntimeError and exit
+        for b in batchers.values():
+            b.stop()
+        for k in threads + list(batchers.values()):
             k.join()
         while q.qsize():
             r = q.get()
+            if isinstance(r, Exception):
+                continue
             stat.feed(r)
-    except:
-        logger.exception("Eval")
-    finally:
+            if seq_stat is not None:
+                seq_stat.feed(r)
         if stat.count > 0:
             return (stat.average, stat.max)
         return (0, 0)
@@ -95,22 +372,478 @@ def eval_model_multithread(cfg, nr_eval):
     logger.info("Average Score: {}; Max Score: {}".format(mean, max))
 
 
+class SharedWeights(object):
+    """
+    Float32 model weights shared by processes through a memory-mapped file,
+    with a version counter. Construct it before forking the readers.
+
+    Writes are never blocked. A reader copies the weights again if they
+    were changed during the copy (a seqlock).
+    """
+
+    def __init__(self):
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.fname = os.path.join(shm_dir, 'weights-{}'.format(uuid.uuid4().hex[:8]))
+        self._version = multiprocessing.RawValue('l', 0)   # odd while being written
+        self._buf = None
+        self._layout = None
+
+    @property
+    def version(self):
+        """ 0 if never written, increased by every write. """
+        return self._version.value
+
+    def _map(self, mode):
+        size = sum(int(np.prod(shape)) for _, shape in self._layout)
+        self._buf = np.memmap(self.fname, dtype='float32', mode=mode, shape=(max(size, 1),))
+
+    def write(self, params):
+        """
+        Args:
+            params (dict): {name: value}. Must have the same names and
+                shapes every time.
+        """
+        if self._buf is None:
+            self._layout = [(k, list(np.shape(v))) for k, v in sorted(params.items())]
+            with open(self.fname + '.json', 'w') as f:
+                json.dump(self._layout, f)
+            self._map('w+')
+            atexit.register(self.close)
+        self._version.value += 1
+        offset = 0
+        for name, shape in self._layout:
+            n = int(np.prod(shape))
+            self._buf[offset:offset + n] = np.asarray(params[name]).ravel()
+            offset += n
+        self._version.value += 1
+
+    def _split(self, data):
+        ret = {}
+        offset = 0
+        for name, shape in self._layout:
+            n = int(np.prod(shape))
+            ret[name] = data[offset:offset + n].reshape(shape)
+            offset += n
+        return ret
+
+    def apply(self, func):
+        """
+        Call ``func(params)`` with {name: value} views of the shared weights,
+        and call it again if the weights were changed meanwhile.
+        func must copy what it needs, e.g. load them into a session.
+
+        Returns:
+            int: the version of the weights given to func. 0 if nothing
+            was written yet, and func is not called.
+        """
+        while True:
+            version = self.version
+            if version == 0:
+                return 0
+            if version % 2 == 1:
+                time.sleep(0.001)
+                continue
+            if self._buf is None:
+                with open(self.fname + '.json') as f:
+                    self._layout = json.load(f)
+                self._map('r')
+            func(self._split(self._buf))
+            if self.version == version:
+                return version
+
+    def read(self):
+        """
+        Returns:
+            (int, dict): the version and a copy of {name: value} of the weights.
+            The dict is empty if nothing was written yet.
+        """
+        ret = {}
+
+        def copy(params):
+            ret.clear()
+            ret.update({k: np.array(v) for k, v in params.items()})
+        return self.apply(copy), ret
+
+    def close(self):
+        """ Remove the shared file. Called by the writer. """
+        for f in [self.fname, self.fname + '.json']:
+            if os.path.isfile(f):
+                os.unlink(f)
+
+
+class EvalCache(object):
+    """
+    Scores of evaluation episodes saved in a JSON file. They are keyed by
+    the model, the env config and the seed of each episode, so that no
+    seeded episode of a model has to be played twice. Meant for evaluating
+    fixed checkpoints: the weights of a training run change between every
+    two evaluations, so its scores would never be found again.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_files(files):
+        """ Content hash of a list of files, e.g. the levels of a game. """
+        h = hashlib.sha1()
+        for f in sorted(files):
+            with open(f, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(1 << 20), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def hash_checkpoint(path):
+        """ Content hash of the files of a checkpoint, e.g. ``train_log/model-1000``. """
+        files = [f for f in glob.glob(path + '*') if f == path or f.startswith(path + '.')]
+        assert len(files), "No checkpoint found at " + path
+        return EvalCache.hash_files(files)
+
+    @staticmethod
+    def key(model_hash, env_config):
+        """
+        Args:
+            model_hash (str): from :meth:`hash_checkpoint`.
+            env_config (dict): anything that changes the scores, e.g. the levels,
+                the seeds, frame_skip, image_shape.
+        """
+        return hashlib.sha1(json.dumps(
+            [model_hash, env_config], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.isfile(self.fname):
+            return {}
+        with open(self.fname) as f:
+            return json.load(f)
+
+    def get(self, key):
+        """
+        Returns:
+            dict: {seed: score} of the episodes played with this key.
+        """
+        with self._lock:
+            scores = self._load().get(key, {})
+        return {int(seed): score for seed, score in scores.items()}
+
+    def put(self, key, scores):
+        """ Add a {seed: score} dict to the episodes of this key. """
+        if not scores:
+            return
+        with self._lock:
+            index = self._load()
+            index.setdefault(key, {}).update({str(seed): float(v) for seed, v in scores.items()})
+            tmpname = self.fname + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmpname, self.fname)
+
+
+class EvalWorker(multiprocessing.Process):
+    """
+    A process which plays one evaluation episode per task, with its own
+    player and predictor. It loads new weights from a :class:`SharedWeights`
+    before an episode if they have changed. An episode is reproducible if
+    the task comes with a seed, which is given to the player with :func:`seed_player`.
+    """
+
+    def __init__(self, idx, pred_config, weights, task_q, result_q):
+        super(EvalWorker, self).__init__()
+        self.idx = idx
+        self.name = u'eval-{}'.format(idx)
+        self.pred_config = pred_config
+        self.weights = weights
+        self.task_q = task_q
+        self.result_q = result_q
+
+    def _build_predictor(self):
+        if not isinstance(self.pred_config, PredictConfig):
+            # a predictor which needs no session, e.g. NumpyDQNPredictor
+            return self.pred_config, self.pred_config.update
+        disable_layer_logging()
+        predictor = OfflinePredictor(self.pred_config)
+        with predictor.graph.as_default():
+            sess_updater = SessionUpdate(predictor.session, tf.trainable_variables())
+        predictor.graph.finalize()
+        return predictor, sess_updater.update
+
+    def run(self):
+        player = get_player(train=False)
+        predictor, update = self._build_predictor()
+        version = 0
+        while True:
+            task = self.task_q.get()
+            if task is None:
+                return
+            rnd, seed = task
+            if self.weights.version != version:
+                version = self.weights.apply(update)
+            if seed is not None:
+                seed_player(player, seed)
+            score = play_one_episode(player, predictor)
+            self.result_q.put((rnd, seed, score))
+
+
+class EvalPool(object):
+    """
+    Long-lived :class:`EvalWorker` processes, so that evaluation scales with
+    cores and every player has its own game.
+    Without :meth:`update`, the workers use the weights loaded by ``pred_config``.
+    """
+
+    def __init__(self, pred_config, nr_proc=None):
+        """
+        Args:
+            pred_config (PredictConfig): config to build the predictor in each worker.
+                It can also be a picklable predictor with an ``update(params)``
+                method, e.g. :class:`NumpyDQNPredictor`, which then needs no session.
+            nr_proc (int): number of workers. Defaults to half of the cores, at most 20.
+        """
+        if nr_proc is None:
+            nr_proc = min(multiprocessing.cpu_count() // 2, 20)
+        self.weights = SharedWeights()
+        self.task_q = multiprocessing.Queue()
+        self.result_q = multiprocessing.Queue()
+        self._round = 0
+        self.procs = [EvalWorker(k, pred_config, self.weights, self.task_q, self.result_q)
+                      for k in range(nr_proc)]
+        ensure_proc_terminate(self.procs)
+        # evaluate on CPU, to not take memory from the trainer
+        with change_env('CUDA_VISIBLE_DEVICES', ''):
+            start_proc_mask_signal(self.procs)
+
+    def update(self, params):
+        """ Push new weights ({name: value}) to the workers. """
+        self.weights.write(params)
+
+    def play(self, seeds):
+        """
+        Args:
+            seeds (list): seed of each episode to play. None for unseeded.
+
+        Yields:
+            (seed, score) of the episodes, in the order they finish.
+            Unplayed episodes are cancelled when the generator is closed.
+        """
+        self._round += 1
+        for seed in seeds:
+            self.task_q.put((self._round, seed))
+        try:
+            nr_done = 0
+            while nr_done < len(seeds):
+                rnd, seed, score = self.result_q.get()
+                if rnd != self._round:
+                    continue    # from a cancelled round
+                nr_done += 1
+                yield seed, score
+        finally:
+            while True:
+                try:
+                    self.task_q.get_nowait()
+                except queue.Empty:
+                    break
+
+    def eval(self, nr_eval, seq_stat=None, cache=None, cache_key=None, seed=0):
+        """
+        Play the episodes of seed ``seed, ..., seed + nr_eval - 1``.
+
+        Args:
+            seq_stat (SequentialEvalStat): if given, stop before nr_eval episodes
+                when it says so. It is fed with all scores.
+            cache (EvalCache): if given, only play the episodes not in it under
+                cache_key, and add them to it.
+
+        Returns:
+            (float, float): the mean and max score of nr_eval episodes.
+        """
+        stat = StatCounter()
+
+        def feed(score):
+            stat.feed(score)
+            if seq_stat is None:
+                return False
+            seq_stat.feed(score)
+            return seq_stat.should_stop()
+
+        cached = cache.get(cache_key) if cache is not None else {}
+        todo = []
+        stop = False
+        for seed in range(seed, seed + nr_eval):
+            if seed not in cached:
+                todo.append(seed)
+            elif not stop:
+                stop = feed(cached[seed])
+        if len(todo) < nr_eval:
+            logger.info("Found {} evaluated episodes in the cache.".format(nr_eval - len(todo)))
+
+        new_scores = {}
+        if todo and not stop:
+            scores = self.play(todo)
+            for seed, score in tqdm(scores, total=len(todo), **get_tqdm_kwargs()):
+                new_scores[seed] = score
+                if feed(score):
+                    scores.close()
+                    break
+        if cache is not None:
+            cache.put(cache_key, new_scores)
+        return stat.average, stat.max
+
+    def close(self):
+        for _ in self.procs:
+            self.task_q.put(None)
+        for p in self.procs:
+            p.join()
+        self.weights.close()
+
+
+def eval_model_multiprocess(cfg, nr_eval, nr_proc=None, cache=None, cache_key=None, seed=0):
+    pool = EvalPool(cfg, nr_proc)
+    mean, max = pool.eval(nr_eval, cache=cache, cache_key=cache_key, seed=seed)
+    pool.close()
+    logger.info("Average Score: {}; Max Score: {}".format(mean, max))
+
+
 class Evaluator(Callback):
-    def __init__(self, nr_eval, input_names, output_names):
+    def __init__(self, nr_eval, input_names, output_names, pool=None,
+                 ci_width=None, time_budget=None):
+        """
+        Args:
+            pool (EvalPool): if given, evaluate in its processes with the
+                weights of the trainer, instead of in threads of the trainer.
+            ci_width, time_budget: if any is given, nr_eval is the max number
+                of episodes, and evaluation stops early as decided by
+                :class:`SequentialEvalStat`.
+        """
         self.eval_episode = nr_eval
         self.input_names = input_names
         self.output_names = output_names
+        self.pool = pool
+        self.ci_width = ci_width
+        self.time_budget = time_budget
+        self.sequential = ci_width is not None or time_budget is not None
 
     def _setup_graph(self):
+        if self.pool is not None:
+            self.vars = tf.trainable_variables()
+            return
         NR_PROC = min(multiprocessing.cpu_count() // 2, 20)
         self.pred_funcs = [self.trainer.get_predict_func(
             self.input_names, self.output_names)] * NR_PROC
 
+    def _eval(self, seq_stat):
+        if self.pool is not None:
+            values = self.trainer.sess.run(self.vars)
+            params = {v.name: val for v, val in zip(self.vars, values)}
+            self.pool.update(params)
+            return self.pool.eval(self.eval_episode, seq_stat)
+        return eval_with_funcs(self.pred_funcs, nr_eval=self.eval_episode, seq_stat=seq_stat)
+
     def _trigger_epoch(self):
+        seq_stat = SequentialEvalStat(self.ci_width, self.time_budget) if self.sequential else None
         t = time.time()
-        mean, max = eval_with_funcs(self.pred_funcs, nr_eval=self.eval_episode)
+        mean, max = self._eval(seq_stat)
         t = time.time() - t
-        if t > 10 * 60:  # eval takes too long
+        if t > 10 * 60 and not self.sequential:  # eval takes too long
             self.eval_episode = int(self.eval_episode * 0.94)
         self.trainer.add_scalar_summary('mean_score', mean)
         self.trainer.add_scalar_summary('max_score', max)
+        if seq_stat is not None:
+            self.trainer.add_scalar_summary('eval_episodes', seq_stat.stat.count)
+            if seq_stat.stat.count >= 2:
+                self.trainer.add_scalar_summary('mean_score_ci', seq_stat.half_width)
+
+
+class TimeBreakdown(Callback):
+    """
+    Measure how the wall time of every epoch splits between the parts of an
+    RL training loop: environment steps, predictor calls, sampling or queue
+    waits, and the train op.
+
+    The train op is timed by this callback, around each ``run_step`` of the
+    trainer. A feed-free trainer dequeues its inputs in the train op: when
+    its input queue is empty before a step, the step time beyond the
+    average of the other steps is counted as ``dequeue_wait`` instead. This
+    costs one more ``sess.run`` of the queue size per step.
+    Other parts are timed by the code running them with :meth:`add`,
+    possibly in other threads. As parts may run in parallel, their
+    fractions of the wall time do not sum to 1.
+
+    Put it after the other callbacks, so that their epoch triggers are not
+    counted as wall time of the next epoch.
+    """
+
+    TRAIN_OP = 'train_op'
+    DEQUEUE_WAIT = 'dequeue_wait'
+
+    def __init__(self, fname=None):
+        """
+        Args:
+            fname (str): a file to append one JSON line per epoch to.
+                Defaults to ``logger.LOG_DIR/time-breakdown.json``.
+        """
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._mean_step = None
+        self._reset()
+
+    def _reset(self):
+        self._times = {}
+        self._nr_env_step = 0
+        self._nr_sgd_step = 0
+        self._epoch_start = time.time()
+
+    def add(self, name, seconds):
+        """ Add time spent in a part. Thread-safe. """
+        with self._lock:
+            self._times[name] = self._times.get(name, 0.) + seconds
+
+    def add_env_steps(self, n=1):
+        with self._lock:
+            self._nr_env_step += n
+
+    def _setup_graph(self):
+        queue = getattr(getattr(self.trainer, '_input_method', None), 'queue', None)
+        self._queue_size = queue.size() if queue is not None else None
+        self._run_step = self.trainer.run_step
+        self.trainer.run_step = self._timed_run_step
+
+    def _timed_run_step(self):
+        starved = self._queue_size is not None and self.trainer.sess.run(self._queue_size) == 0
+        start = time.time()
+        try:
+            return self._run_step()
+        finally:
+            t = time.time() - start
+            wait = 0.
+            if starved:
+                wait = max(t - self._mean_step, 0.) if self._mean_step is not None else 0.
+            else:
+                self._mean_step = t if self._mean_step is None else 0.95 * self._mean_step + 0.05 * t
+            self.add(self.TRAIN_OP, t - wait)
+            if wait > 0:
+                self.add(self.DEQUEUE_WAIT, wait)
+            self._nr_sgd_step += 1
+
+    def _before_train(self):
+        if self.fname is None:
+            self.fname = os.path.join(logger.LOG_DIR, 'time-breakdown.json')
+        self._reset()
+
+    def _trigger_epoch(self):
+        with self._lock:
+            wall = time.time() - self._epoch_start
+            times, nr_env, nr_sgd = self._times, self._nr_env_step, self._nr_sgd_step
+            self._reset()
+        stat = {'epoch': self.epoch_num, 'wall_time': wall,
+                'times': times,
+                'env_steps_per_sec': nr_env / wall,
+                'sgd_steps_per_sec': nr_sgd / wall}
+        for name, t in sorted(times.items()):
+            self.trainer.add_scalar_summary('time/' + name, t / wall)
+        self.trainer.add_scalar_summary('time/env_steps_per_sec', stat['env_steps_per_sec'])
+        self.trainer.add_scalar_summary('time/sgd_steps_per_sec', stat['sgd_steps_per_sec'])
+        with open(self.fname, 'a') as f:
+            f.write(json.dumps(stat) + '\n')
+        logger.info("Time breakdown: " + ', '.join(
+            '{}={:.0%}'.format(k, t / wall) for k, t in sorted(times.items())))
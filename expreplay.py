@@ -0,0 +1,940 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: expreplay.py
+# Author: Yuxin Wu <ppwwyyxxc@gmail.com>
+
+import numpy as np
+import os
+import json
+import threading
+import functools
+import time
+import zlib
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import six
+from six.moves import queue, range
+
+from tensorpack.dataflow import DataFlow
+from tensorpack.utils import logger, get_tqdm, get_rng
+from tensorpack.utils.fs import mkdir_p
+from tensorpack.utils.concurrency import LoopThread
+from tensorpack.callbacks.base import Callback, Triggerable
+
+from common import n_step_returns
+
+__all__ = ['ExpReplay', 'PrioritizedExpReplay', 'ReplayMemory', 'CompressedReplayMemory',
+           'ReplayMemorySaver', 'SumTree', 'BatchPrefetcher']
+
+Experience = namedtuple('Experience',
+                        ['state', 'action', 'reward', 'isOver'])
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+@contextmanager
+def _timed(timer, name):
+    """ time a block with a :class:`TimeBreakdown`, if any """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.add(name, time.time() - start)
+
+
+class ReplayMemory(object):
+    """
+    A ring buffer of transitions, stored column by column in preallocated arrays.
+
+    Frames are stored once and stacked into states when sampled, so the
+    memory costs ``max_size * prod(state_shape)`` bytes for states.
+    """
+
+    META_FILE = 'meta.json'
+    CHUNK_FILE = 'chunk-{:05d}.npz'
+    COLUMNS = ['state', 'action', 'reward', 'isOver']
+
+    def __init__(self, max_size, state_shape, history_len):
+        """
+        Args:
+            max_size (int): capacity of the memory.
+            state_shape (tuple): shape of one frame, as returned by the player.
+            history_len (int): number of frames to concat into one state.
+        """
+        self.max_size = int(max_size)
+        self.state_shape = tuple(state_shape)
+        self.history_len = int(history_len)
+
+        self._init_state_storage()
+        self.action = np.zeros((self.max_size,), dtype='int32')
+        self.reward = np.zeros((self.max_size,), dtype='float32')
+        self.isOver = np.zeros((self.max_size,), dtype='bool')
+
+        self._curr_size = 0
+        self._curr_pos = 0
+        # total number of transitions ever appended
+        self._nr_appended = 0
+        # (dirname, nr_appended) of the last save, to only rewrite dirty chunks
+        self._last_save = (None, 0)
+        self._hist = deque(maxlen=self.history_len - 1)
+
+    def _init_state_storage(self):
+        self.state = np.zeros((self.max_size,) + self.state_shape, dtype='uint8')
+
+    def append(self, exp):
+        """
+        Args:
+            exp (Experience):
+        """
+        pos = self._curr_pos
+        self._store_state(pos, exp.state)
+        self.action[pos] = exp.action
+        self.reward[pos] = exp.reward
+        self.isOver[pos] = exp.isOver
+        self._curr_pos = (pos + 1) % self.max_size
+        self._curr_size = min(self._curr_size + 1, self.max_size)
+        self._nr_appended += 1
+        if exp.isOver:
+            self._hist.clear()
+        else:
+            self._hist.append(exp.state)
+
+    def append_batch(self, state, action, reward, isOver):
+        """
+        Append a sequence of consecutive transitions at once.
+
+        Args:
+            state (np.ndarray): N x state_shape frames.
+            action, reward, isOver (np.ndarray): N values each.
+        """
+        n = len(action)
+        pos = (self._curr_pos + np.arange(n)) % self.max_size
+        self._store_states(pos, state)
+        self.action[pos] = action
+        self.reward[pos] = reward
+        self.isOver[pos] = isOver
+        self._curr_pos = (self._curr_pos + n) % self.max_size
+        self._curr_size = min(self._curr_size + n, self.max_size)
+        self._nr_appended += n
+        # only the tail can stay in the history
+        for k in range(max(n - self._hist.maxlen, 0), n):
+            if isOver[k]:
+                self._hist.clear()
+            else:
+                self._hist.append(state[k])
+
+    def _store_state(self, pos, state):
+        self.state[pos] = state
+
+    def _store_states(self, pos, states):
+        self.state[pos] = states
+
+    def _gather_states(self, pos):
+        return self.state[pos]
+
+    def recent_state(self):
+        """
+        Returns:
+            list: the last ``history_len - 1`` frames of the current episode,
+            zero-filled at the beginning of an episode.
+        """
+        lst = list(self._hist)
+        states = [np.zeros(self.state_shape, dtype='uint8')] * (self._hist.maxlen - len(lst))
+        states.extend(lst)
+        return states
+
+    def batch_spec(self, batch_size):
+        """
+        Returns:
+            list: (shape, dtype) of every array returned by :meth:`sample`.
+        """
+        state_shape = (batch_size,) + self.state_shape[:-1] + \
+            (self.state_shape[-1] * self.history_len,)
+        return [(state_shape, 'uint8'), ((batch_size,), 'int32'), ((batch_size,), 'float32'),
+                (state_shape, 'uint8'), ((batch_size,), 'bool')]
+
+    def sample(self, idx, nstep=1, gamma=0.99, out=None):
+        """
+        Args:
+            idx (np.ndarray): a batch of indices in
+                ``[0, len(self) - history_len - nstep)``, counting from the oldest transition.
+            nstep (int): number of steps between the state and the next state.
+            gamma (float): discount factor of the n-step return. Unused if nstep is 1.
+            out (list): arrays of :meth:`batch_spec` to write the batch into,
+                instead of allocating new ones.
+
+        Returns:
+            list: [state, action, reward, next_state, isOver] of the transitions
+            from the last frame of ``[idx, idx + history_len)`` to ``nstep`` frames later.
+            With ``nstep > 1``, reward is the discounted return of the n steps,
+            and isOver tells whether an episode ended within them.
+        """
+        k = self.history_len + nstep
+        start = (self._curr_pos if self._curr_size == self.max_size else 0) + np.asarray(idx)
+        pos = (start[:, None] + np.arange(k)) % self.max_size     # B x k
+        return self._stack(pos, nstep, gamma, out)
+
+    def _stack(self, pos, nstep, gamma, out=None):
+        frames = self._gather_states(pos)    # B x k x state_shape, a copy
+        isOver = self.isOver[pos]
+        h = self.history_len
+        k = h + nstep
+
+        # when x.isOver==True, (x+1).state is of a different episode:
+        # zero-fill every frame up to the last episode end before the current frame
+        def zero_mask(over):
+            return np.cumsum(over[:, ::-1], axis=1)[:, ::-1] > 0
+        state = frames[:, :h]
+        next_state = frames[:, nstep:]
+        if nstep > 1:
+            # frames are shared by both, but masked differently
+            state = state.copy()
+        state[:, :h - 1][zero_mask(isOver[:, :h - 1])] = 0
+        if h > 2:
+            # next_state is only used if no episode ends within the n steps
+            next_state[:, :h - 2][zero_mask(isOver[:, :k - 2])[:, nstep:]] = 0
+
+        last = pos[:, h - 1]
+        if nstep == 1:
+            reward, over = self.reward[last], isOver[:, h - 1]
+        else:
+            steps = pos[:, h - 1:k - 1]
+            reward, over = n_step_returns(self.reward[steps], isOver[:, h - 1:k - 1], gamma)
+        if out is None:
+            return [self._concat_frames(state), self.action[last], reward,
+                    self._concat_frames(next_state), over]
+        self._concat_frames(state, out[0])
+        self._concat_frames(next_state, out[3])
+        for o, v in zip(out[1:3] + out[4:], [self.action[last], reward, over]):
+            o[...] = v
+        return out
+
+    def _concat_frames(self, frames, out=None):
+        # B x h x H x W x C -> B x H x W x (h*C), same layout as concatenating on axis 2
+        if out is not None:
+            # write through a B x h x H x W x C view of out
+            view = out.reshape(out.shape[:-1] + (frames.shape[1], -1))
+            np.copyto(np.moveaxis(view, -2, 1), frames)
+            return out
+        frames = np.moveaxis(frames, 1, -2)
+        return frames.reshape(frames.shape[:-2] + (-1,))
+
+    def __len__(self):
+        return self._curr_size
+
+    def save(self, dirname, chunk_size=50000):
+        """
+        Save the memory to a directory as compressed column chunks.
+        Only the chunks changed since the last save to the same directory are written.
+
+        Args:
+            dirname (str): the directory to save to.
+            chunk_size (int): number of transitions per chunk file.
+        """
+        mkdir_p(dirname)
+        nr_chunk = (self._curr_size + chunk_size - 1) // chunk_size
+        last_dir, last_cnt = self._last_save
+        nr_new = self._nr_appended - last_cnt
+        old_meta = self._read_meta(dirname)
+        if last_dir != dirname or old_meta is None or \
+                old_meta['chunk_size'] != chunk_size or nr_new >= self._curr_size:
+            dirty = set(range(nr_chunk))
+        else:
+            new_pos = (self._curr_pos - np.arange(1, nr_new + 1)) % self.max_size
+            dirty = set((new_pos // chunk_size).tolist())
+
+        def write(chunk):
+            sl = slice(chunk * chunk_size, min((chunk + 1) * chunk_size, self._curr_size))
+            fname = os.path.join(dirname, self.CHUNK_FILE.format(chunk))
+            tmpname = fname + '.tmp.npz'
+            self._save_chunk(tmpname, sl)
+            os.rename(tmpname, fname)
+
+        # zlib releases the GIL
+        pool = ThreadPool(min(len(dirty), 8) or 1)
+        pool.map(write, sorted(dirty))
+        pool.close()
+
+        meta = {'max_size': self.max_size,
+                'state_shape': list(self.state_shape),
+                'history_len': self.history_len,
+                'curr_pos': self._curr_pos,
+                'curr_size': self._curr_size,
+                'chunk_size': chunk_size,
+                'compress': self._compress_name()}
+        tmpname = os.path.join(dirname, self.META_FILE + '.tmp')
+        with open(tmpname, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmpname, os.path.join(dirname, self.META_FILE))
+        self._last_save = (dirname, self._nr_appended)
+        logger.info("Saved {} transitions ({} chunks written) to {}.".format(
+            self._curr_size, len(dirty), dirname))
+
+    def load(self, dirname):
+        """
+        Load a memory saved by :meth:`save`. The memory has to be of the same size and shape.
+        The last transition is marked as the end of an episode, because
+        the player will not continue the episode it belongs to.
+
+        Args:
+            dirname (str):
+        """
+        meta = self._read_meta(dirname)
+        assert meta is not None, "No replay memory found in {}!".format(dirname)
+        assert meta['max_size'] == self.max_size and \
+            tuple(meta['state_shape']) == self.state_shape, \
+            "Replay memory in {} has a different size or shape!".format(dirname)
+        assert meta.get('compress') == self._compress_name(), \
+            "Replay memory in {} uses a different compression!".format(dirname)
+        chunk_size = meta['chunk_size']
+        curr_size = meta['curr_size']
+        nr_chunk = (curr_size + chunk_size - 1) // chunk_size
+
+        def read(chunk):
+            start = chunk * chunk_size
+            with np.load(os.path.join(dirname, self.CHUNK_FILE.format(chunk))) as data:
+                self._load_chunk(start, data)
+
+        pool = ThreadPool(min(nr_chunk, 8) or 1)
+        pool.map(read, range(nr_chunk))
+        pool.close()
+
+        self._curr_size = curr_size
+        self._curr_pos = meta['curr_pos']
+        if curr_size:
+            self.isOver[(self._curr_pos - 1) % self.max_size] = True
+        self._hist.clear()
+        self._nr_appended = curr_size
+        self._last_save = (dirname, self._nr_appended)
+        logger.info("Loaded {} transitions from {}.".format(curr_size, dirname))
+
+    def _compress_name(self):
+        return None
+
+    def _save_chunk(self, fname, sl):
+        np.savez_compressed(fname, **{c: getattr(self, c)[sl] for c in self.COLUMNS})
+
+    def _load_chunk(self, start, data):
+        for c in self.COLUMNS:
+            arr = data[c]
+            getattr(self, c)[start:start + len(arr)] = arr
+
+    @staticmethod
+    def _read_meta(dirname):
+        fname = os.path.join(dirname, ReplayMemory.META_FILE)
+        if not os.path.isfile(fname):
+            return None
+        with open(fname) as f:
+            return json.load(f)
+
+
+class CompressedReplayMemory(ReplayMemory):
+    """
+    A :class:`ReplayMemory` which keeps every frame compressed.
+    Frames are decompressed by a pool of threads when sampled, and the most
+    recently decoded frames are kept in a small LRU cache.
+    """
+
+    def __init__(self, max_size, state_shape, history_len,
+                 compress='zlib', nr_decode_thread=4, cache_size=2048):
+        """
+        Args:
+            compress (str): 'zlib' or 'lz4'. Falls back to 'zlib' if the lz4 module is not available.
+            nr_decode_thread (int): number of threads to decompress a batch.
+            cache_size (int): number of decoded frames to keep.
+
+            Other arguments are the same as :class:`ReplayMemory`.
+        """
+        if compress == 'lz4' and lz4frame is None:
+            logger.warn("lz4 is not available. Use zlib to compress the replay memory.")
+            compress = 'zlib'
+        assert compress in ['zlib', 'lz4'], compress
+        self.compress = compress
+        if compress == 'zlib':
+            self._encode = lambda buf: zlib.compress(buf, 1)
+            self._decode = zlib.decompress
+        else:
+            self._encode = lz4frame.compress
+            self._decode = lz4frame.decompress
+        self._cache = OrderedDict()
+        self._cache_size = int(cache_size)
+        # held to access the cache, and to overwrite a frame and its version
+        self._cache_lock = threading.Lock()
+        self._pool = ThreadPool(nr_decode_thread)
+        super(CompressedReplayMemory, self).__init__(max_size, state_shape, history_len)
+
+    def _init_state_storage(self):
+        self.state = np.empty((self.max_size,), dtype=object)
+        # incremented whenever the frame of a position is overwritten, so that
+        # a frame decoded before that is not put in the cache
+        self._version = np.zeros((self.max_size,), dtype='int64')
+
+    def _compress_name(self):
+        return self.compress
+
+    def _store_state(self, pos, state):
+        state = np.ascontiguousarray(state, dtype='uint8')
+        assert state.shape == self.state_shape, state.shape
+        blob = self._encode(state.tobytes())
+        with self._cache_lock:
+            self.state[pos] = blob
+            self._version[pos] += 1
+            self._cache.pop(pos, None)
+
+    def _store_states(self, pos, states):
+        for p, s in zip(pos, states):
+            self._store_state(p, s)
+
+    def _gather_states(self, pos):
+        uniq, inverse = np.unique(pos, return_inverse=True)
+        frames = np.empty((len(uniq),) + self.state_shape, dtype='uint8')
+        missing = []    # (index, position, blob, version)
+        with self._cache_lock:
+            for i, p in enumerate(uniq.tolist()):
+                f = self._cache.get(p)
+                if f is None:
+                    missing.append((i, p, self.state[p], self._version[p]))
+                else:
+                    self._cache[p] = self._cache.pop(p)
+                    frames[i] = f
+
+        def decode(blob):
+            return np.frombuffer(self._decode(blob), dtype='uint8')
+
+        if missing:
+            decoded = self._pool.map(decode, [m[2] for m in missing])
+            with self._cache_lock:
+                for (i, p, _, version), f in zip(missing, decoded):
+                    f = f.reshape(self.state_shape)
+                    frames[i] = f
+                    # don't cache it if the position was overwritten meanwhile
+                    if self._version[p] == version:
+                        self._cache[p] = f
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return frames[inverse.reshape(pos.shape)]
+
+    def nbytes(self):
+        """ Returns: int: the number of bytes taken by the compressed frames."""
+        return sum(len(self.state[k]) for k in range(self._curr_size))
+
+    def _save_chunk(self, fname, sl):
+        # frames are already compressed: store them as one blob and their lengths
+        blobs = self.state[sl]
+        lens = np.array([len(b) for b in blobs], dtype='int64')
+        blob = np.frombuffer(b''.join(blobs), dtype='uint8')
+        arrs = {c: getattr(self, c)[sl] for c in self.COLUMNS if c != 'state'}
+        np.savez(fname, state_blob=blob, state_len=lens, **arrs)
+
+    def _load_chunk(self, start, data):
+        for c in self.COLUMNS:
+            if c == 'state':
+                continue
+            arr = data[c]
+            getattr(self, c)[start:start + len(arr)] = arr
+        blob = data['state_blob'].tobytes()
+        offsets = np.concatenate([[0], np.cumsum(data['state_len'])])
+        with self._cache_lock:
+            for k in range(len(offsets) - 1):
+                self.state[start + k] = blob[offsets[k]:offsets[k + 1]]
+            self._version[start:start + len(offsets) - 1] += 1
+            self._cache.clear()
+
+
+class SumTree(object):
+    """
+    An array-backed binary tree where every node holds the sum of its children.
+    Supports batched O(log n) priority updates and prefix-sum lookups.
+    """
+
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity (int): number of leaves.
+        """
+        self.capacity = int(capacity)
+        self._depth = int(np.ceil(np.log2(max(self.capacity, 2))))
+        self._nr_leaf = 2 ** self._depth
+        # node k has children 2k and 2k+1. The root is node 1.
+        self.tree = np.zeros((2 * self._nr_leaf,), dtype='float64')
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx) + self._nr_leaf]
+
+    def clear(self):
+        self.tree.fill(0)
+
+    def update(self, idx, priority):
+        """
+        Args:
+            idx (np.ndarray): leaf indices. Duplicates take the last priority.
+            priority (np.ndarray or float):
+        """
+        node = np.asarray(idx, dtype='int64') + self._nr_leaf
+        self.tree[node] = priority
+        for _ in range(self._depth):
+            node = np.unique(node // 2)
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def find(self, values):
+        """
+        Args:
+            values (np.ndarray): prefix sums in ``(0, total]``.
+
+        Returns:
+            np.ndarray: for each value, the leaf whose range of prefix sums contains it.
+        """
+        values = np.array(values, dtype='float64')
+        node = np.ones(values.shape, dtype='int64')
+        for _ in range(self._depth):
+            left = 2 * node
+            left_sum = self.tree[left]
+            go_right = values > left_sum
+            values -= left_sum * go_right
+            node = left + go_right
+        return node - self._nr_leaf
+
+
+class BatchPrefetcher(object):
+    """
+    Sample batches ahead of time in background threads, into a ring of
+    preallocated buffers, so that a batch is ready whenever the trainer asks for one.
+
+    A batch returned by :meth:`get` stays valid until the next call to :meth:`get`,
+    which recycles its buffers.
+    """
+
+    def __init__(self, sample_func, spec, nr_prefetch, rngs):
+        """
+        Args:
+            sample_func: ``sample_func(rng, out)`` fills ``out``, a list of arrays, with a batch.
+            spec (list): (shape, dtype) of every array of a batch.
+            nr_prefetch (int): number of ready batches to keep in the queue.
+            rngs (list): one RandomState for every sampling thread.
+        """
+        self._sample_func = sample_func
+        self._free = queue.Queue()
+        # one more buffer for every thread to fill, and one held by the consumer
+        for _ in range(nr_prefetch + len(rngs) + 1):
+            self._free.put([np.empty(shape, dtype=dtype) for shape, dtype in spec])
+        self._ready = queue.Queue()
+        self._in_use = None
+        self._threads = [LoopThread(functools.partial(self._sample_job, rng), False)
+                         for rng in rngs]
+        self.nr_get = 0
+        self.nr_wait = 0    # number of get() which found no ready batch
+
+    def _sample_job(self, rng):
+        buf = self._free.get()
+        self._ready.put(self._sample_func(rng, buf))
+
+    def start(self):
+        for th in self._threads:
+            th.start()
+
+    def get(self):
+        """
+        Returns:
+            list: the next batch.
+        """
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+        self.nr_get += 1
+        if self._ready.empty():
+            self.nr_wait += 1
+        self._in_use = self._ready.get()
+        return self._in_use
+
+
+class ExpReplay(DataFlow, Callback):
+    """
+    Implement experience replay in the paper
+    `Human-level control through deep reinforcement learning
+    <http://www.nature.com/nature/journal/v518/n7540/full/nature14236.html>`_.
+
+    This implementation provides the interface as a :class:`DataFlow`.
+    This DataFlow is __not__ fork-safe (thus doesn't support multiprocess prefetching).
+
+    This implementation only works with Q-learning. It assumes that state is
+    batch-able, and the network takes batched inputs.
+    """
+
+    def __init__(self,
+                 predictor_io_names,
+                 player,
+                 state_shape,
+                 batch_size=32,
+                 memory_size=1e6,
+                 init_memory_size=50000,
+                 exploration=1,
+                 end_exploration=0.1,
+                 exploration_epoch_anneal=0.002,
+                 reward_clip=None,
+                 update_frequency=1,
+                 history_len=1,
+                 resume_dir=None,
+                 compress=None,
+                 nstep=1,
+                 gamma=0.99,
+                 prefetch=0,
+                 nr_sampler=1,
+                 timer=None
+                 ):
+        """
+        Args:
+            predictor_io_names (tuple of list of str): input/output names to
+                predict Q value from state.
+            player (RLEnvironment): the player.
+            state_shape (tuple): shape of one frame returned by the player.
+            history_len (int): length of history frames to concat. Zero-filled
+                initial frames.
+            update_frequency (int): number of new transitions to add to memory
+                after sampling a batch of transitions for training.
+            resume_dir (str): a directory written by :class:`ReplayMemorySaver`.
+                If it exists, the memory is loaded from it instead of being
+                populated from scratch.
+            compress (str): None, 'zlib' or 'lz4'. Keep the frames in memory
+                compressed with this codec. See :class:`CompressedReplayMemory`.
+            nstep (int): produce n-step transitions, whose reward is the
+                discounted return of ``nstep`` steps. See :meth:`ReplayMemory.sample`.
+            gamma (float): discount factor of the n-step return.
+            prefetch (int): number of batches to sample ahead of time in
+                ``nr_sampler`` background threads. See :class:`BatchPrefetcher`.
+                0 to sample in :meth:`get_data`.
+            nr_sampler (int): number of sampling threads used with ``prefetch``.
+            timer (TimeBreakdown): if given, time environment steps, predictor
+                calls and sampling with it.
+        """
+        init_memory_size = int(init_memory_size)
+
+        for k, v in locals().items():
+            if k != 'self':
+                setattr(self, k, v)
+        self.num_actions = player.get_action_space().num_actions()
+        logger.info("Number of Legal actions: {}".format(self.num_actions))
+        if compress is None:
+            self.mem = ReplayMemory(memory_size, state_shape, history_len)
+        else:
+            self.mem = CompressedReplayMemory(memory_size, state_shape, history_len, compress)
+        self.rng = get_rng(self)
+        self._init_memory_flag = threading.Event()  # tell if memory has been initialized
+        # held while the memory is modified, sampled or saved
+        self.mem_lock = threading.Lock()
+        self._predictor_io_names = predictor_io_names
+        self._prefetcher = None
+
+    def _init_memory(self):
+        if self.resume_dir is not None and \
+                ReplayMemory._read_meta(self.resume_dir) is not None:
+            self.mem.load(self.resume_dir)
+            self._load_extra_state(self.resume_dir)
+            self._init_memory_flag.set()
+            return
+        logger.info("Populating replay memory...")
+
+        # fill some for the history
+        old_exploration = self.exploration
+        self.exploration = 1
+        for k in range(self.history_len):
+            self._populate_exp()
+        self.exploration = old_exploration
+
+        with get_tqdm(total=self.init_memory_size) as pbar:
+            while len(self.mem) < self.init_memory_size:
+                self._populate_exp()
+                pbar.update()
+        self._init_memory_flag.set()
+
+    def _populate_exp(self):
+        """ populate a transition by epsilon-greedy"""
+        old_s = self.player.current_state()
+        if self.rng.rand() <= self.exploration:
+            act = self.rng.choice(range(self.num_actions))
+        else:
+            # build a history state
+            # XXX assume a state can be representated by one tensor
+            ss = self.mem.recent_state()
+            ss.append(old_s)
+            ss = np.concatenate(ss, axis=2)
+            # XXX assume batched network
+            with _timed(self.timer, 'predict'):
+                q_values = self.predictor([[ss]])[0][0]
+            act = np.argmax(q_values)
+        with _timed(self.timer, 'env'):
+            reward, isOver = self.player.action(act)
+        if self.timer is not None:
+            self.timer.add_env_steps()
+        if self.reward_clip:
+            reward = np.clip(reward, self.reward_clip[0], self.reward_clip[1])
+        with self.mem_lock:
+            self._append(Experience(old_s, act, reward, isOver))
+
+    def _append(self, exp):
+        # with mem_lock held
+        self.mem.append(exp)
+
+    def get_data(self):
+        self._init_memory_flag.wait()
+        while True:
+            if self._prefetcher is None:
+                with _timed(self.timer, 'sample'):
+                    batch = self._sample_batch(self.rng)
+            else:
+                with _timed(self.timer, 'sample_wait'):
+                    batch = self._prefetcher.get()
+            yield batch
+            self._populate_job_queue.put(1)
+
+    def _prefetch_batch(self, rng, out):
+        # in the sampling threads of the prefetcher
+        with _timed(self.timer, 'sample'):
+            return self._sample_batch(rng, out)
+
+    def _sample_batch(self, rng, out=None):
+        # the populate thread may overwrite the oldest slots at any time
+        with self.mem_lock:
+            # new s is considered useless if isOver==True
+            idx = rng.randint(
+                len(self.mem) - self.history_len - self.nstep, size=self.batch_size)
+            batch = self.mem.sample(idx, self.nstep, self.gamma, out)
+        return self._process_batch(batch)
+
+    def _batch_spec(self):
+        spec = self.mem.batch_spec(self.batch_size)
+        spec[1] = (spec[1][0], 'int8')
+        return spec
+
+    def _process_batch(self, batch):
+        state, action, reward, next_state, isOver = batch[:5]
+        return [state, action.astype('int8', copy=False), reward, next_state, isOver] + batch[5:]
+
+    def _setup_graph(self):
+        self.predictor = self.trainer.get_predict_func(*self._predictor_io_names)
+
+    # Callback-related:
+    def _before_train(self):
+        # spawn a separate thread to run policy, can speed up 1.3x
+        self._populate_job_queue = queue.Queue(maxsize=1)
+
+        def populate_job_func():
+            self._populate_job_queue.get()
+            with self.trainer.sess.as_default():
+                for _ in range(self.update_frequency):
+                    self._populate_exp()
+        self._populate_job_th = LoopThread(populate_job_func, False)
+        self._populate_job_th.start()
+
+        self._init_memory()
+
+        if self.prefetch > 0:
+            rngs = [np.random.RandomState(self.rng.randint(2**31)) for _ in range(self.nr_sampler)]
+            self._prefetcher = BatchPrefetcher(
+                self._prefetch_batch, self._batch_spec(), self.prefetch, rngs)
+            self._prefetcher.start()
+
+    def _trigger_epoch(self):
+        if self.exploration > self.end_exploration:
+            self.exploration -= self.exploration_epoch_anneal
+            logger.info("Exploration changed to {}".format(self.exploration))
+        # log player statistics
+        stats = self.player.stats
+        for k, v in six.iteritems(stats):
+            try:
+                mean, max = np.mean(v), np.max(v)
+                self.trainer.add_scalar_summary('expreplay/mean_' + k, mean)
+                self.trainer.add_scalar_summary('expreplay/max_' + k, max)
+            except:
+                pass
+        self.player.reset_stat()
+        if self._prefetcher is not None and self._prefetcher.nr_get:
+            p = self._prefetcher
+            self.trainer.add_scalar_summary('expreplay/prefetch_wait', float(p.nr_wait) / p.nr_get)
+            p.nr_get = p.nr_wait = 0
+
+    # Checkpoint-related:
+    EXTRA_STATE_FILE = 'expreplay.json'
+
+    def save(self, dirname):
+        """ Save the memory and the exploration state to a directory."""
+        with self.mem_lock:
+            self.mem.save(dirname)
+            with open(os.path.join(dirname, self.EXTRA_STATE_FILE), 'w') as f:
+                json.dump({'exploration': self.exploration}, f)
+
+    def _load_extra_state(self, dirname):
+        fname = os.path.join(dirname, self.EXTRA_STATE_FILE)
+        if os.path.isfile(fname):
+            with open(fname) as f:
+                self.exploration = json.load(f)['exploration']
+            logger.info("Exploration restored to {}".format(self.exploration))
+
+
+class ReplayMemorySaver(Triggerable):
+    """
+    Save the replay memory of an :class:`ExpReplay` every epoch, next to
+    the checkpoints written by :class:`ModelSaver`.
+    Pass the directory to ``ExpReplay(resume_dir=)`` to resume from it.
+    """
+
+    def __init__(self, expreplay, checkpoint_dir=None):
+        """
+        Args:
+            expreplay (ExpReplay):
+            checkpoint_dir (str): Defaults to ``logger.LOG_DIR/replay``.
+        """
+        self.expreplay = expreplay
+        if checkpoint_dir is None:
+            checkpoint_dir = os.path.join(logger.LOG_DIR, 'replay')
+        self.checkpoint_dir = checkpoint_dir
+
+    def _trigger(self):
+        try:
+            self.expreplay.save(self.checkpoint_dir)
+        except (OSError, IOError):   # disk error sometimes.. just ignore it
+            logger.exception("Exception in ReplayMemorySaver.trigger!")
+
+
+class PrioritizedExpReplay(ExpReplay):
+    """
+    Experience replay with proportional prioritization, in the paper
+    `Prioritized Experience Replay <https://arxiv.org/abs/1511.05952>`_.
+
+    Each datapoint has two more components after the ones of :class:`ExpReplay`:
+    the importance-sampling weights and the indices of the sampled transitions.
+    The model is expected to pass the indices through to a tensor named
+    ``sample_idx`` and to compute the absolute TD errors in a tensor named
+    ``td_error``. They are fetched every step to update the priorities.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Args:
+            alpha (float): how much prioritization is used. 0 means uniform.
+            beta (float): initial exponent of the importance-sampling correction.
+            beta_epoch_anneal (float): increase of beta after every epoch, up to 1.
+            priority_eps (float): added to the TD errors so that no transition
+                has zero probability.
+
+            Other arguments are the same as :class:`ExpReplay`.
+        """
+        self.alpha = kwargs.pop('alpha', 0.6)
+        self.beta = kwargs.pop('beta', 0.4)
+        self.beta_epoch_anneal = kwargs.pop('beta_epoch_anneal', 0.002)
+        self.priority_eps = kwargs.pop('priority_eps', 1e-3)
+        super(PrioritizedExpReplay, self).__init__(*args, **kwargs)
+        self.tree = SumTree(self.mem.max_size)
+        self._max_priority = 1.0
+
+    def _valid_range(self):
+        """ relative index range [start, end) of transitions which can be sampled,
+            i.e. having enough history and a known state n steps later. """
+        return self.history_len - 1, len(self.mem) - self.nstep
+
+    def _to_relative(self, pos):
+        mem = self.mem
+        oldest = mem._curr_pos if len(mem) == mem.max_size else 0
+        return (pos - oldest) % mem.max_size
+
+    def _to_physical(self, rel):
+        mem = self.mem
+        oldest = mem._curr_pos if len(mem) == mem.max_size else 0
+        return (oldest + rel) % mem.max_size
+
+    def _append(self, exp):
+        super(PrioritizedExpReplay, self)._append(exp)
+        start, end = self._valid_range()
+        changes = [(self._to_physical(len(self.mem) - 1), 0.)]   # next state unknown yet
+        if end - 1 >= start:
+            # the transition n steps before now has a next state
+            changes.append((self._to_physical(end - 1), self._max_priority))
+        if len(self.mem) == self.mem.max_size and start > 0:
+            # the frame before this one was overwritten: not enough history anymore
+            changes.append((self._to_physical(start - 1), 0.))
+        idx, prio = zip(*changes)
+        self.tree.update(idx, prio)
+
+    def _init_memory(self):
+        super(PrioritizedExpReplay, self)._init_memory()
+        # priorities are not saved with the memory: start from uniform
+        start, end = self._valid_range()
+        self.tree.clear()
+        if end > start:
+            self.tree.update(self._to_physical(np.arange(start, end)), self._max_priority)
+
+    def _sample_prioritized(self, rng):
+        """
+        Returns:
+            (np.ndarray, np.ndarray): physical positions and their priorities,
+            or (None, None) if no transition with a positive priority was found.
+        """
+        # stratified sampling: one transition from each of batch_size equal segments
+        total = self.tree.total
+        if total <= 0:
+            return None, None
+        segment = total / self.batch_size
+        values = (np.arange(self.batch_size) + 1 - rng.rand(self.batch_size)) * segment
+        pos = self.tree.find(np.minimum(values, total))
+        prio = self.tree.get(pos)
+        # numerical corner cases may hit a zero-priority leaf
+        bad = prio <= 0
+        if bad.all():
+            return None, None
+        if bad.any():
+            good = np.nonzero(~bad)[0]
+            pick = good[rng.randint(len(good), size=bad.sum())]
+            pos[bad], prio[bad] = pos[pick], prio[pick]
+        return pos, prio
+
+    def _sample_batch(self, rng, out=None):
+        with self.mem_lock:
+            start, end = self._valid_range()
+            pos, prio = self._sample_prioritized(rng)
+            if pos is None:
+                # nothing to sample by priority: sample uniformly, with uniform weights
+                pos = self._to_physical(rng.randint(start, end, size=self.batch_size))
+                weight = np.ones((self.batch_size,), dtype='float32')
+            else:
+                weight = ((end - start) * prio / self.tree.total) ** (-self.beta)
+                weight = (weight / weight.max()).astype('float32')
+
+            idx = self._to_relative(pos) - (self.history_len - 1)
+            if out is None:
+                batch = self.mem.sample(idx, self.nstep, self.gamma)
+                batch.extend([weight, pos])
+            else:
+                batch = self.mem.sample(idx, self.nstep, self.gamma, out[:5])
+                out[5][...], out[6][...] = weight, pos
+                batch.extend(out[5:])
+        return self._process_batch(batch)
+
+    def _batch_spec(self):
+        spec = super(PrioritizedExpReplay, self)._batch_spec()
+        return spec + [((self.batch_size,), 'float32'), ((self.batch_size,), 'int64')]
+
+    def _extra_fetches(self):
+        return ['sample_idx:0', 'td_error:0']
+
+    def _trigger_step(self, pos, td_error):
+        prio = (np.abs(td_error) + self.priority_eps) ** self.alpha
+        with self.mem_lock:
+            # skip transitions which were overwritten or became invalid since sampled
+            rel = self._to_relative(pos)
+            start, end = self._valid_range()
+            valid = (rel >= start) & (rel < end)
+            self.tree.update(pos[valid], prio[valid])
+            self._max_priority = max(self._max_priority, prio.max())
+
+    def _trigger_epoch(self):
+        super(PrioritizedExpReplay, self)._trigger_epoch()
+        if self.beta < 1:
+            self.beta = min(1., self.beta + self.beta_epoch_anneal)
+            logger.info("Importance-sampling beta changed to {}".format(self.beta))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: numpy_dqn.py
+
+"""
+The Q-network of DQN.py and the policy network of the A3C example in NumPy,
+to predict without a TensorFlow session. They must be kept in sync with
+``Model._get_DQN_prediction`` and ``Model._get_NN_prediction``.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+__all__ = ['NumpyDQNPredictor', 'NumpyA3CPredictor', 'export_params', 'export_checkpoint',
+           'read_checkpoint', 'load_npz']
+
+# (name, pooling size) of the conv layers
+CONV_LAYERS = [('conv0', 2), ('conv1', 2), ('conv2', 2), ('conv3', None)]
+FC_ALPHA = 0.01     # of the LeakyReLU after fc0
+
+
+def _strip_name(name):
+    # 'conv0/W:0' -> 'conv0/W'
+    return name[:-2] if name.endswith(':0') else name
+
+
+def _is_online_param(name):
+    # skip the target network, and the slots & counters of the optimizer
+    head = name.split('/')[0]
+    return (head.startswith('conv') or head.startswith('fc') or head == 'prelu') and \
+        '/Adam' not in name and '/Momentum' not in name
+
+
+def export_params(params, fname):
+    """
+    Save the weights of the online network to a flat ``.npz``.
+
+    Args:
+        params (dict): {name: value}, e.g. ``{v.name: v.eval()}`` of the trainable variables.
+        fname (str): the output file.
+    """
+    params = {_strip_name(k): np.asarray(v, dtype='float32')
+              for k, v in params.items() if _is_online_param(_strip_name(k))}
+    assert 'conv0/W' in params, "No network found in " + ', '.join(sorted(params))
+    with open(fname, 'wb') as f:
+        np.savez(f, **params)
+
+
+def read_checkpoint(path):
+    """
+    Args:
+        path (str): a checkpoint, e.g. ``train_log/DQN/model-10000``.
+
+    Returns:
+        dict: {name: value} of the online network in the checkpoint.
+    """
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(path)
+    names = reader.get_variable_to_shape_map().keys()
+    return {k: reader.get_tensor(k) for k in names if _is_online_param(k)}
+
+
+def export_checkpoint(path, fname):
+    """
+    Save the weights of the online network in a checkpoint to a flat ``.npz``.
+
+    Args:
+        path (str): a checkpoint, e.g. ``train_log/DQN/model-10000``.
+        fname (str): the output file.
+    """
+    export_params(read_checkpoint(path), fname)
+
+
+def load_npz(fname):
+    """
+    Returns:
+        dict: {name: value} saved by :func:`export_params`.
+    """
+    with np.load(fname) as data:
+        return {k: data[k] for k in data.files}
+
+
+def conv2d_same(x, W, b):
+    """
+    A stride-1 convolution with 'SAME' padding, as ``tf.nn.conv2d``, computed as
+    a matrix product with the im2col view of the input.
+
+    Args:
+        x (np.ndarray): NHWC.
+        W (np.ndarray): kh x kw x C x C'.
+        b (np.ndarray): C'.
+    """
+    kh, kw = W.shape[:2]
+    ph, pw = kh - 1, kw - 1
+    # TF puts the extra padding at the end
+    x = np.pad(x, ((0, 0), (ph // 2, ph - ph // 2), (pw // 2, pw - pw // 2), (0, 0)), 'constant')
+    n, h, w, c = x.shape
+    s = x.strides
+    cols = as_strided(x, shape=(n, h - kh + 1, w - kw + 1, kh, kw, c),
+                      strides=(s[0], s[1], s[2], s[1], s[2], s[3]), writeable=False)
+    return np.tensordot(cols, W, axes=3) + b
+
+
+def max_pool(x, k):
+    """ A k x k max pooling with 'VALID' padding on NHWC. """
+    n, h, w, c = x.shape
+    h, w = h // k, w // k
+    return x[:, :h * k, :w * k].reshape(n, h, k, w, k, c).max(axis=(2, 4))
+
+
+def prelu(x, alpha):
+    return 0.5 * ((1 + alpha) * x + (1 - alpha) * np.abs(x))
+
+
+class NumpyDQNPredictor(object):
+    """
+    Compute ``Qvalue`` of the DQN model with NumPy only.
+    It can be called like an :class:`OfflinePredictor` with
+    input ``state`` and output ``Qvalue``, and is cheap to create in a new process.
+    """
+
+    def __init__(self, params=None):
+        """
+        Args:
+            params (dict): {name: value} of the online Q-network, as saved by
+                :func:`export_params`. Names may end with ``:0``, and other
+                variables are ignored.
+        """
+        self.params = {}
+        if params is not None:
+            self.update(params)
+
+    @classmethod
+    def load(cls, fname):
+        return cls(load_npz(fname))
+
+    def update(self, params):
+        """ Copy new weights, e.g. from :class:`SharedWeights`. """
+        self.params = {_strip_name(k): np.array(v, dtype='float32')
+                       for k, v in params.items() if _is_online_param(_strip_name(k))}
+
+    @property
+    def dueling(self):
+        return 'fctV/W' in self.params
+
+    def _conv(self, x, name, pool):
+        p = self.params
+        x = self._conv_nl(conv2d_same(x, p[name + '/W'], p[name + '/b']), name)
+        return max_pool(x, pool) if pool is not None else x
+
+    def _conv_nl(self, x, name):
+        return prelu(x, self.params[name + '/alpha'])
+
+    def _fc0(self, x):
+        x = x.reshape(x.shape[0], -1).dot(self.params['fc0/W']) + self.params['fc0/b']
+        return self._fc0_nl(x)
+
+    def _fc0_nl(self, x):
+        return np.maximum(x, FC_ALPHA * x)
+
+    def predict(self, state):
+        """
+        Args:
+            state (np.ndarray): N x H x W x C states in [0, 255].
+
+        Returns:
+            np.ndarray: N x A Q values.
+        """
+        x = np.asarray(state, dtype='float32') * np.float32(1. / 255)
+        for name, pool in CONV_LAYERS:
+            x = self._conv(x, name, pool)
+        return self._head(self._fc0(x))
+
+    def _head(self, x):
+        p = self.params
+        if not self.dueling:
+            return x.dot(p['fct/W']) + p['fct/b']
+        V = x.dot(p['fctV/W']) + p['fctV/b']
+        As = x.dot(p['fctA/W']) + p['fctA/b']
+        return As + (V - As.mean(axis=1, keepdims=True))
+
+    def __call__(self, dp):
+        """
+        Args:
+            dp (list): [state], as the input of an :class:`OfflinePredictor`.
+
+        Returns:
+            list: [Qvalue].
+        """
+        return [self.predict(np.asarray(dp[0]))]
+
+
+class NumpyA3CPredictor(NumpyDQNPredictor):
+    """
+    Compute ``logits``, the action distribution of the A3C model, with NumPy only.
+    It has the same interface as :class:`NumpyDQNPredictor`.
+    """
+
+    def _conv_nl(self, x, name):
+        return np.maximum(x, 0)
+
+    def _fc0_nl(self, x):
+        return prelu(x, self.params['prelu/alpha'])
+
+    def _head(self, x):
+        policy = x.dot(self.params['fc-pi/W']) + self.params['fc-pi/b']
+        policy = np.exp(policy - policy.max(axis=1, keepdims=True))
+        return policy / policy.sum(axis=1, keepdims=True)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: quantize.py
+
+"""
+Post-training int8 quantization of the networks of numpy_dqn.py, for CPU actors.
+
+Weights are quantized with one scale per output channel, and the inputs of
+every layer with one scale calibrated on recorded states. The ``.npz``
+keeps int8 weights, so it is 4x smaller than the float one.
+
+NumPy has no int8 matrix product, so the integer values are multiplied in
+float32, which is exact as long as the sums stay below 2**24. The weights
+are converted to float32 once per :meth:`update`, and only this copy is
+kept in a process: the quantized layers take as much memory as the float
+ones there. Any speedup over the float predictor comes from pooling before
+the activation in :func:`qconv_pool_act`, not from the int8 arithmetic.
+"""
+
+import numpy as np
+
+from numpy_dqn import (NumpyDQNPredictor, NumpyA3CPredictor, CONV_LAYERS,
+                       conv2d_same, max_pool, load_npz)
+
+__all__ = ['quantize_per_channel', 'quantize_activation', 'qconv_pool_act',
+           'QuantizedDQNPredictor', 'QuantizedA3CPredictor',
+           'calibrate', 'greedy_agreement', 'record_states', 'load_predictor']
+
+QMAX = 127
+QUANTIZED_LAYERS = [name for name, _ in CONV_LAYERS] + ['fc0']
+
+
+def quantize_per_channel(W):
+    """
+    Symmetric int8 quantization with one scale per output channel (the last axis).
+
+    Returns:
+        (np.ndarray, np.ndarray): the int8 weights and the float32 scales,
+        so that ``W ~= Wq * scale``.
+    """
+    amax = np.abs(W).reshape(-1, W.shape[-1]).max(axis=0)
+    scale = (np.maximum(amax, 1e-8) / QMAX).astype('float32')
+    Wq = np.clip(np.round(W / scale), -QMAX, QMAX).astype('int8')
+    return Wq, scale
+
+
+def quantize_activation(x, scale, qmin=-QMAX, qmax=QMAX):
+    """
+    Returns:
+        np.ndarray: ``round(x / scale)`` clipped to ``[qmin, qmax]``, as float32 integers.
+    """
+    return np.clip(np.round(x * np.float32(1. / scale)), qmin, qmax).astype('float32')
+
+
+def qconv_pool_act(xq, x_scale, Wq, w_scale, b, pool, nl, nl_increasing=True):
+    """
+    A quantized stride-1 'SAME' convolution, followed by max pooling and an activation.
+
+    When the activation is increasing, pooling is done on the integer
+    accumulators before dequantization, so that only a quarter of them are
+    scaled and activated.
+
+    Args:
+        xq (np.ndarray): NHWC quantized input, see :func:`quantize_activation`.
+        x_scale (float): scale of the input.
+        Wq (np.ndarray): kh x kw x C x C' quantized weights, as float32.
+        w_scale (np.ndarray): C' scales of the weights.
+        b (np.ndarray): C' float bias.
+        pool (int): pooling size, or None.
+        nl: the activation.
+        nl_increasing (bool): whether nl is non-decreasing, so that it commutes with max.
+
+    Returns:
+        np.ndarray: the float output.
+    """
+    acc = conv2d_same(xq, Wq, 0)
+    if pool is not None and nl_increasing:
+        # scaling by positive numbers and adding a bias per channel commute with max
+        return nl(max_pool(acc, pool) * (x_scale * w_scale) + b)
+    x = nl(acc * (x_scale * w_scale) + b)
+    return max_pool(x, pool) if pool is not None else x
+
+
+class _QuantizedMixin(object):
+    """
+    Replace the conv layers and fc0 of a NumPy predictor by int8 ones.
+    """
+
+    def __init__(self, params=None, x_scales=None):
+        """
+        Args:
+            params (dict): float weights as for the float predictor, or the
+                quantized weights and scales written by :meth:`save`.
+            x_scales (dict): {layer: scale} of the input of every quantized layer,
+                from :func:`calibrate`. Not needed if they are in params.
+        """
+        self.x_scales = dict(x_scales or {})
+        # the input of conv0 is already 8-bit
+        self.x_scales[QUANTIZED_LAYERS[0]] = 1. / 255
+        # {layer: (quantized weights as float32, scales)}
+        self.qweights = {}
+        super(_QuantizedMixin, self).__init__(params)
+
+    def update(self, params):
+        """ Quantize new weights, keeping the calibrated scales of the inputs. """
+        super(_QuantizedMixin, self).update(params)
+        p = self.params
+        for name in QUANTIZED_LAYERS:
+            if name + '/Wq' in p:
+                Wq, scale = p.pop(name + '/Wq'), p.pop(name + '/w_scale')
+            else:
+                Wq, scale = quantize_per_channel(p.pop(name + '/W'))
+            self.qweights[name] = (Wq.astype('float32'), scale)
+            if name + '/x_scale' in p:
+                self.x_scales[name] = float(p.pop(name + '/x_scale'))
+
+    def save(self, fname):
+        """ Save the quantized weights and all scales to an ``.npz``. """
+        out = dict(self.params)
+        for name, (Wq, scale) in self.qweights.items():
+            out[name + '/Wq'] = Wq.astype('int8')
+            out[name + '/w_scale'] = scale
+            out[name + '/x_scale'] = np.float32(self.x_scales[name])
+        with open(fname, 'wb') as f:
+            np.savez(f, **out)
+
+    def _quantize_input(self, x, name):
+        if name == QUANTIZED_LAYERS[0]:
+            return quantize_activation(x, self.x_scales[name], 0, 255)
+        return quantize_activation(x, self.x_scales[name])
+
+    def _conv(self, x, name, pool):
+        Wq, w_scale = self.qweights[name]
+        alpha = self.params.get(name + '/alpha')
+        return qconv_pool_act(
+            self._quantize_input(x, name), self.x_scales[name], Wq, w_scale,
+            self.params[name + '/b'], pool, lambda y: self._conv_nl(y, name),
+            nl_increasing=alpha is None or alpha >= 0)
+
+    def _fc0(self, x):
+        Wq, w_scale = self.qweights['fc0']
+        xq = self._quantize_input(x.reshape(x.shape[0], -1), 'fc0')
+        return self._fc0_nl(xq.dot(Wq) * (self.x_scales['fc0'] * w_scale) + self.params['fc0/b'])
+
+
+class QuantizedDQNPredictor(_QuantizedMixin, NumpyDQNPredictor):
+    """ An int8 :class:`NumpyDQNPredictor`. """
+
+
+class QuantizedA3CPredictor(_QuantizedMixin, NumpyA3CPredictor):
+    """ An int8 :class:`NumpyA3CPredictor`. """
+
+
+def _batches(states, batch_size):
+    for k in range(0, len(states), batch_size):
+        yield np.asarray(states[k:k + batch_size])
+
+
+def calibrate(predictor, states, percentile=99.99, batch_size=64):
+    """
+    Calibrate the scales of the inputs of the quantized layers with a float predictor.
+
+    Args:
+        predictor (NumpyDQNPredictor): a float predictor.
+        states (np.ndarray): N x H x W x C recorded states.
+        percentile (float): the percentile of absolute values of an input
+            which maps to 127. Larger values are clipped.
+
+    Returns:
+        dict: {layer: scale} to build a quantized predictor with.
+    """
+    amax = dict((name, 0.) for name in QUANTIZED_LAYERS[1:])
+
+    def record(name, x):
+        amax[name] = max(amax[name], float(np.percentile(np.abs(x), percentile)))
+
+    for state in _batches(states, batch_size):
+        x = state.astype('float32') * np.float32(1. / 255)
+        for name, pool in CONV_LAYERS:
+            if name in amax:
+                record(name, x)
+            x = predictor._conv(x, name, pool)
+        record('fc0', x)
+    return dict((name, max(v, 1e-8) / QMAX) for name, v in amax.items())
+
+
+def greedy_agreement(pred_a, pred_b, states, batch_size=64):
+    """
+    Returns:
+        (float, float): the fraction of states on which both predictors choose
+        the same greedy action, and the max absolute difference of their outputs.
+    """
+    nr_same, max_diff = 0, 0.
+    for state in _batches(states, batch_size):
+        a, b = pred_a.predict(state), pred_b.predict(state)
+        nr_same += (a.argmax(axis=1) == b.argmax(axis=1)).sum()
+        max_diff = max(max_diff, float(np.abs(a - b).max()))
+    return float(nr_same) / len(states), max_diff
+
+
+def record_states(player, predictor, nr, exploration=0.05):
+    """
+    Record states by playing epsilon-greedy with a predictor.
+
+    Args:
+        player (RLEnvironment): a player whose states are the inputs of the predictor.
+        nr (int): number of states.
+
+    Returns:
+        np.ndarray: nr x state_shape uint8 states.
+    """
+    num_actions = player.get_action_space().num_actions()
+    states = []
+    while len(states) < nr:
+        s = player.current_state()
+        states.append(s)
+        if np.random.rand() < exploration:
+            act = np.random.choice(num_actions)
+        else:
+            act = predictor([[s]])[0][0].argmax()
+        player.action(act)
+    return np.asarray(states, dtype='uint8')
+
+
+def load_predictor(fname, arch='DQN'):
+    """
+    Load a float or quantized predictor from an ``.npz``.
+
+    Args:
+        arch (str): 'DQN' or 'A3C'.
+    """
+    params = load_npz(fname)
+    quantized = QUANTIZED_LAYERS[0] + '/Wq' in params
+    cls = {('DQN', False): NumpyDQNPredictor, ('DQN', True): QuantizedDQNPredictor,
+           ('A3C', False): NumpyA3CPredictor, ('A3C', True): QuantizedA3CPredictor}[arch, quantized]
+    return cls(params)
@@ -1,17 +1,86 @@
 #!/usr/bin/python
 # coding=utf-8
 
-import os, pygame, time, random, uuid, sys
+import os, time, random, uuid, sys, pickle, io
 import time
+from functools import partial
 from threading import Thread
 import numpy as np
 
-class myRect(pygame.Rect):
+# pygame is only needed to draw the game, see Game(render = False)
+try:
+    import pygame
+except ImportError:
+    pygame = None
+
+class Rect(object):
+    """ Integer rectangle, with the part of pygame.Rect used by the game rules """
+
+    __slots__ = ("left", "top", "width", "height")
+
+    def __init__(self, left, top, width = None, height = None):
+        """ Either Rect(left, top, width, height) or Rect(position, size) """
+        if width == None:
+            (left, top), (width, height) = left, top
+        self.left = int(left)
+        self.top = int(top)
+        self.width = int(width)
+        self.height = int(height)
+
+    @property
+    def right(self):
+        return self.left + self.width
+
+    @property
+    def bottom(self):
+        return self.top + self.height
+
+    @property
+    def topleft(self):
+        return (self.left, self.top)
+
+    @topleft.setter
+    def topleft(self, position):
+        self.left = int(position[0])
+        self.top = int(position[1])
+
+    def move(self, x, y):
+        return Rect(self.left + x, self.top + y, self.width, self.height)
+
+    def colliderect(self, rect):
+        return self.left < rect.left + rect.width and rect.left < self.left + self.width and \
+            self.top < rect.top + rect.height and rect.top < self.top + self.height
+
+    def collidelist(self, rects):
+        """ Index of the first colliding rect, or -1 """
+        for i, rect in enumerate(rects):
+            if self.colliderect(rect):
+                return i
+        return -1
+
+    def collidelistall(self, rects):
+        return [i for i, rect in enumerate(rects) if self.colliderect(rect)]
+
+class myRect(Rect):
     """ Add type property """
+
+    __slots__ = ("type",)
+
     def __init__(self, left, top, width, height, type):
-        pygame.Rect.__init__(self, left, top, width, height)
+        Rect.__init__(self, left, top, width, height)
         self.type = type
 
+def subsurface(*rect):
+    """ Part of the sprites, or None if the game is not drawn """
+    if sprites == None:
+        return None
+    return sprites.subsurface(*rect)
+
+def rotate(image, angle):
+    if image == None:
+        return None
+    return pygame.transform.rotate(image, angle)
+
 class Timer(object):
     def __init__(self):
         self.timers = []
@@ -23,7 +92,8 @@ class Timer(object):
             "repeat"        : repeat,
             "times"            : 0,
             "time"            : 0,
-            "uuid"            : uuid.uuid4()
+            "uuid"            : uuid.uuid4(),
+            "active"        : True
         }
         self.timers.append(options)
 
@@ -32,10 +102,20 @@ class Timer(object):
     def destroy(self, uuid_nr):
         for timer in self.timers:
             if timer["uuid"] == uuid_nr:
+                timer["active"] = False
                 self.timers.remove(timer)
                 return
 
-    def update(self, time_passed):
+    def update(self, time_passed, snapshot = False):
+        """ Advance all timers, and call the ones which are due.
+        The full game keeps the original loop: removing a timer delays the
+        next one by a frame, and a timer added by a callback is counted in
+        the same frame. If snapshot is True (training fidelity), go through a
+        copy instead: no timer is skipped, a destroyed timer doesn't fire,
+        and new timers start at the next update """
+        if snapshot:
+            self._updateSnapshot(time_passed)
+            return
         for timer in self.timers:
             timer["time"] += time_passed
             if timer["time"] > timer["interval"]:
@@ -50,23 +130,65 @@ class Timer(object):
                         self.timers.remove(timer)
                     except:
                         pass
+
+    def _updateSnapshot(self, time_passed):
+        for timer in self.timers[:]:
+            if not timer["active"]:
+                continue
+            timer["time"] += time_passed
+            if timer["time"] > timer["interval"]:
+                timer["time"] -= timer["interval"]
+                timer["times"] += 1
+                if timer["repeat"] > -1 and timer["times"] == timer["repeat"]:
+                    timer["active"] = False
+                    self.timers.remove(timer)
+                try:
+                    timer["callback"]()
+                except:
+                    timer["active"] = False
+                    try:
+                        self.timers.remove(timer)
+                    except:
+                        pass
                         
     
+class Pooled(object):
+    """ Keep removed instances in a free list of their class, and reuse them
+    instead of allocating new ones. Subclasses have their own "pool" list,
+    and a reset() method taking the same arguments as __init__ """
+
+    __slots__ = ()
+
+    @classmethod
+    def new(cls, *args, **kwargs):
+        """ Take an instance from the pool, or make one if it's empty """
+        if cls.pool:
+            obj = cls.pool.pop()
+            obj.reset(*args, **kwargs)
+            return obj
+        return cls(*args, **kwargs)
+
+    @classmethod
+    def release(cls, obj):
+        """ Give back an instance which is not used anywhere anymore """
+        cls.pool.append(obj)
+
 class Castle():
     """ Player's castle/fortress """
 
     (STATE_STANDING, STATE_DESTROYED, STATE_EXPLODING) = range(3)
 
-    def __init__(self):
+    def __init__(self, cosmetic = True):
 
-        global sprites
+        # if False, skip changes which are only visual. see Game(fidelity)
+        self.cosmetic = cosmetic
 
         # images
-        self.img_undamaged = sprites.subsurface(0, 15*2, 16*2, 16*2)
-        self.img_destroyed = sprites.subsurface(16*2, 15*2, 16*2, 16*2)
+        self.img_undamaged = subsurface(0, 15*2, 16*2, 16*2)
+        self.img_destroyed = subsurface(16*2, 15*2, 16*2, 16*2)
 
         # init position
-        self.rect = pygame.Rect(12*16, 24*16, 32, 32)
+        self.rect = Rect(12*16, 24*16, 32, 32)
 
         # start w/ undamaged and shiny castle
         self.rebuild()
@@ -80,6 +202,7 @@ class Castle():
         if self.state == self.STATE_EXPLODING:
             if not self.explosion.active:
                 self.state = self.STATE_DESTROYED
+                Explosion.release(self.explosion)
                 del self.explosion
             else:
                 self.explosion.draw()
@@ -93,7 +216,7 @@ class Castle():
     def destroy(self):
         """ Destroy castle """
         self.state = self.STATE_EXPLODING
-        self.explosion = Explosion(self.rect.topleft)
+        self.explosion = Explosion.new(self.rect.topleft, cosmetic = self.cosmetic)
         self.image = self.img_destroyed
         self.active = False
 
@@ -115,8 +238,6 @@ class Bonus():
 
     def __init__(self, level):
 
-        global sprites
-
         # to know where to place
         self.level = level
 
@@ -126,7 +247,7 @@ class Bonus():
         # blinking state
         self.visible = True
 
-        self.rect = pygame.Rect(random.randint(0, 416-32), random.randint(0, 416-32), 32, 32)
+        self.rect = Rect(random.randint(0, 416-32), random.randint(0, 416-32), 32, 32)
 
         self.bonus = random.choice([
             self.BONUS_GRENADE,
@@ -137,7 +258,7 @@ class Bonus():
             self.BONUS_TIMER
         ])
 
-        self.image = sprites.subsurface(16*2*self.bonus, 32*2, 16*2, 15*2)
+        self.image = subsurface(16*2*self.bonus, 32*2, 16*2, 15*2)
 
     def draw(self):
         """ draw bonus """
@@ -149,8 +270,12 @@ class Bonus():
         """ Toggle bonus visibility """
         self.visible = not self.visible
 
+    def destroy(self):
+        """ Remove bonus from the map """
+        bonuses.remove(self)
+
 
-class Bullet():
+class Bullet(Pooled):
     # direction constants
     (DIR_UP, DIR_RIGHT, DIR_DOWN, DIR_LEFT) = range(4)
 
@@ -159,45 +284,69 @@ class Bullet():
 
     (OWNER_PLAYER, OWNER_ENEMY) = range(2)
 
+    __slots__ = ("level", "direction", "damage", "owner", "owner_class", "power",
+        "image", "rect", "speed", "state", "explosion")
+
+    pool = []
+
+    # images by direction, and of the explosion. shared by all bullets
+    images = None
+    explosion_images = None
+
+    # position is player's top left corner, so we'll need to
+    # recalculate a bit: [left, top, width, height] by direction
+    rect_offsets = [[11, -8, 6, 8], [26, 11, 8, 6], [11, 26, 6, 8], [-8, 11, 8, 6]]
+
     def __init__(self, level, position, direction, damage = 100, speed = 15):
+        self.rect = Rect(0, 0, 0, 0)
+        self.reset(level, position, direction, damage, speed)
+
+    @classmethod
+    def loadImages(cls):
+        image = subsurface(75*2, 74*2, 3*2, 4*2)
+        cls.images = [
+            image,
+            rotate(image, 270),
+            rotate(image, 180),
+            rotate(image, 90)
+        ]
+        # without images, explosions still last as many frames
+        cls.explosion_images = [
+            subsurface(0, 80*2, 32*2, 32*2),
+            subsurface(32*2, 80*2, 32*2, 32*2),
+        ]
 
-        global sprites
+    def reset(self, level, position, direction, damage = 100, speed = 15):
+        if Bullet.images is None:
+            Bullet.loadImages()
 
         self.level = level
         self.direction = direction
         self.damage = damage
         self.owner = None
         self.owner_class = None
+        self.explosion = None
 
         # 1-regular everyday normal bullet
         # 2-can destroy steel
         self.power = 1
 
-        self.image = sprites.subsurface(75*2, 74*2, 3*2, 4*2)
-
-        # position is player's top left corner, so we'll need to
-        # recalculate a bit. also rotate image itself.
-        if direction == self.DIR_UP:
-            self.rect = pygame.Rect(position[0] + 11, position[1] - 8, 6, 8)
-        elif direction == self.DIR_RIGHT:
-            self.image = pygame.transform.rotate(self.image, 270)
-            self.rect = pygame.Rect(position[0] + 26, position[1] + 11, 8, 6)
-        elif direction == self.DIR_DOWN:
-            self.image = pygame.transform.rotate(self.image, 180)
-            self.rect = pygame.Rect(position[0] + 11, position[1] + 26, 6, 8)
-        elif direction == self.DIR_LEFT:
-            self.image = pygame.transform.rotate(self.image, 90)
-            self.rect = pygame.Rect(position[0] - 8 , position[1] + 11, 8, 6)
-
-        self.explosion_images = [
-            sprites.subsurface(0, 80*2, 32*2, 32*2),
-            sprites.subsurface(32*2, 80*2, 32*2, 32*2),
-        ]
+        self.image = self.images[direction]
+        left, top, width, height = self.rect_offsets[direction]
+        rect = self.rect
+        rect.left, rect.top = position[0] + left, position[1] + top
+        rect.width, rect.height = width, height
 
         self.speed = speed
 
         self.state = self.STATE_ACTIVE
 
+    @classmethod
+    def release(cls, bullet):
+        # don't keep the level and the tanks alive
+        bullet.level = bullet.owner_class = bullet.explosion = None
+        cls.pool.append(bullet)
+
     def draw(self):
         """ draw bullet """
         global screen
@@ -212,7 +361,8 @@ class Bullet():
         if self.state == self.STATE_EXPLODING:
             if not self.explosion.active:
                 self.destroy()
-                del self.explosion
+                Explosion.release(self.explosion)
+                self.explosion = None
 
         if self.state != self.STATE_ACTIVE:
             return
@@ -251,12 +401,9 @@ class Bullet():
 
         # check for collisions with walls. one bullet can destroy several (1 or 2)
         # tiles but explosion remains 1
-        rects = self.level.obstacle_rects
-        collisions = self.rect.collidelistall(rects)
-        if collisions != []:
-            for i in collisions:
-                if self.level.hitTile(rects[i].topleft, self.power, self.owner == self.OWNER_PLAYER):
-                    has_collided = True
+        for pos in self.level.obstacleTiles(self.rect):
+            if self.level.hitTile(pos, self.power, self.owner == self.OWNER_PLAYER):
+                has_collided = True
         if has_collided:
             self.explode()
             return
@@ -299,14 +446,28 @@ class Bullet():
         global screen
         if self.state != self.STATE_REMOVED:
             self.state = self.STATE_EXPLODING
-            self.explosion = Explosion([self.rect.left-13, self.rect.top-13], None, self.explosion_images)
+            self.explosion = Explosion.new([self.rect.left-13, self.rect.top-13], None, self.explosion_images,
+                self.level.cosmetic)
 
     def destroy(self):
         self.state = self.STATE_REMOVED
 
 
-class Label():
+class Label(Pooled):
+
+    __slots__ = ("position", "active", "text")
+
+    pool = []
+
+    # shared by all labels
+    font = None
+    # rendered surface of each text
+    surfaces = {}
+
     def __init__(self, position, text = "", duration = None):
+        self.reset(position, text, duration)
+
+    def reset(self, position, text = "", duration = None):
 
         self.position = position
 
@@ -314,45 +475,66 @@ class Label():
 
         self.text = text
 
-        self.font = pygame.font.SysFont("Arial", 13)
+        if Label.font is None and sprites != None:
+            Label.font = pygame.font.SysFont("Arial", 13)
 
         if duration != None:
-            gtimer.add(duration, lambda :self.destroy(), 1)
+            gtimer.add(duration, self.destroy, 1)
 
     def draw(self):
         """ draw label """
         global screen
-        screen.blit(self.font.render(self.text, False, (200,200,200)), [self.position[0]+4, self.position[1]+8])
+        surface = self.surfaces.get(self.text)
+        if surface is None:
+            surface = self.font.render(self.text, False, (200,200,200))
+            self.surfaces[self.text] = surface
+        screen.blit(surface, [self.position[0]+4, self.position[1]+8])
 
     def destroy(self):
         self.active = False
 
 
-class Explosion():
-    def __init__(self, position, interval = None, images = None):
+class Explosion(Pooled):
 
-        global sprites
+    __slots__ = ("position", "active", "images", "index", "image")
 
-        self.position = [position[0]-16, position[1]-16]
-        self.active = True
+    pool = []
 
-        if interval == None:
-            interval = 100
+    # shared by explosions without their own images
+    default_images = None
 
-        if images == None:
-            images = [
-                sprites.subsurface(0, 80*2, 32*2, 32*2),
-                sprites.subsurface(32*2, 80*2, 32*2, 32*2),
-                sprites.subsurface(64*2, 80*2, 32*2, 32*2)
-            ]
+    def __init__(self, position, interval = None, images = None, cosmetic = True):
+        self.position = [0, 0]
+        self.reset(position, interval, images, cosmetic)
 
-        images.reverse()
+    def reset(self, position, interval = None, images = None, cosmetic = True):
 
-        self.images = [] + images
+        self.position[0] = position[0]-16
+        self.position[1] = position[1]-16
+        self.active = True
 
-        self.image = self.images.pop()
+        if interval == None:
+            interval = 100
 
-        gtimer.add(interval, lambda :self.update(), len(self.images) + 1)
+        if images == None:
+            if Explosion.default_images is None:
+                Explosion.default_images = [
+                    subsurface(0, 80*2, 32*2, 32*2),
+                    subsurface(32*2, 80*2, 32*2, 32*2),
+                    subsurface(64*2, 80*2, 32*2, 32*2)
+                ]
+            images = Explosion.default_images
+
+        # images are shared: only remember which one is shown
+        self.images = images
+        self.index = 0
+        self.image = images[0]
+
+        if cosmetic:
+            gtimer.add(interval, self.update, len(images))
+        else:
+            # only the end of the explosion matters. it comes at the same time
+            gtimer.add(interval * len(images), self.destroy, 1)
 
     def draw(self):
         global screen
@@ -361,11 +543,15 @@ class Explosion():
 
     def update(self):
         """ Advace to the next image """
-        if len(self.images) > 0:
-            self.image = self.images.pop()
+        if self.index + 1 < len(self.images):
+            self.index += 1
+            self.image = self.images[self.index]
         else:
             self.active = False
 
+    def destroy(self):
+        self.active = False
+
 class Level():
 
     # tile constants
@@ -374,24 +560,33 @@ class Level():
     # tile width/height in px
     TILE_SIZE = 16
 
-    def __init__(self, level_nr = None):
+    # number of tiles in a row or column
+    MAP_SIZE = 26
+
+    # tiles which tanks cannot move over
+    OBSTACLE_TILES = (TILE_BRICK, TILE_STEEL, TILE_WATER)
+
+    def __init__(self, level_nr = None, cosmetic = True):
         """ There are total 35 different levels. If level_nr is larger than 35, loop over
-        to next according level so, for example, if level_nr ir 37, then load level 2 """
+        to next according level so, for example, if level_nr ir 37, then load level 2
 
-        global sprites
+        If cosmetic is False, changes which are only visual are skipped by the
+        level and the tanks on it. see Game(fidelity) """
+
+        self.cosmetic = cosmetic
 
         # max number of enemies simultaneously  being on map
         self.max_active_enemies = 4
 
         tile_images = [
-            pygame.Surface((8*2, 8*2)),
-            sprites.subsurface(48*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(48*2, 72*2, 8*2, 8*2),
-            sprites.subsurface(56*2, 72*2, 8*2, 8*2),
-            sprites.subsurface(64*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(64*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(72*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(64*2, 72*2, 8*2, 8*2)
+            pygame.Surface((8*2, 8*2)) if sprites != None else None,
+            subsurface(48*2, 64*2, 8*2, 8*2),
+            subsurface(48*2, 72*2, 8*2, 8*2),
+            subsurface(56*2, 72*2, 8*2, 8*2),
+            subsurface(64*2, 64*2, 8*2, 8*2),
+            subsurface(64*2, 64*2, 8*2, 8*2),
+            subsurface(72*2, 64*2, 8*2, 8*2),
+            subsurface(64*2, 72*2, 8*2, 8*2)
         ]
         self.tile_empty = tile_images[0]
         self.tile_brick = tile_images[1]
@@ -404,6 +599,9 @@ class Level():
 
         self.obstacle_rects = []
 
+        # incremented whenever tiles change
+        self.version = 0
+
         level_nr = 1 if level_nr == None else level_nr%35
         if level_nr == 0:
             level_nr = 35
@@ -416,7 +614,8 @@ class Level():
         # update these tiles
         self.updateObstacleRects()
 
-        gtimer.add(400, lambda :self.toggleWaves())
+        if self.cosmetic:
+            gtimer.add(400, self.toggleWaves)
 
     def hitTile(self, pos, power = 1, sound = False):
         """
@@ -427,26 +626,26 @@ class Level():
 
         global play_sounds, sounds
 
-        for tile in self.mapr:
-            if tile.topleft == pos:
-                if tile.type == self.TILE_BRICK:
-                    if play_sounds and sound:
-                        sounds["brick"].play()
-                        player.score += 0.1
+        tile = self.tiles.get(pos)
+        if tile != None:
+            if tile.type == self.TILE_BRICK:
+                if play_sounds and sound:
+                    sounds["brick"].play()
+                    player.score += 0.1
+                self.mapr.remove(tile)
+                self.updateObstacleRects()
+                return True
+            elif tile.type == self.TILE_STEEL:
+                if play_sounds and sound:
+                    sounds["steel"].play()
+                    player.score -= 0.1
+                if power == 2:
                     self.mapr.remove(tile)
                     self.updateObstacleRects()
-                    return True
-                elif tile.type == self.TILE_STEEL:
-                    if play_sounds and sound:
-                        sounds["steel"].play()
-                        player.score -= 0.1
-                    if power == 2:
-                        self.mapr.remove(tile)
-                        self.updateObstacleRects()
-                        player.score += 0.1
-                    return True
-                else:
-                    return False
+                    player.score += 0.1
+                return True
+            else:
+                return False
 
     def toggleWaves(self):
         """ Toggle water image """
@@ -509,15 +708,47 @@ class Level():
 
     def updateObstacleRects(self):
         """ Set self.obstacle_rects to all tiles' rects that player can destroy
-        with bullets """
+        with bullets, and index the tiles by position """
 
         global castle
 
         self.obstacle_rects = [castle.rect]
 
+        # tiles by their top left corner, and tile types by [row][column]
+        self.tiles = {}
+        self.grid = [[self.TILE_EMPTY] * self.MAP_SIZE for i in range(self.MAP_SIZE)]
+
         for tile in self.mapr:
-            if tile.type in (self.TILE_BRICK, self.TILE_STEEL, self.TILE_WATER):
+            if tile.type in self.OBSTACLE_TILES:
                 self.obstacle_rects.append(tile)
+            self.tiles[tile.topleft] = tile
+            self.grid[tile.top // self.TILE_SIZE][tile.left // self.TILE_SIZE] = tile.type
+
+        self.version += 1
+
+    def obstacleTiles(self, rect):
+        """ Top left corners of the obstacle tiles colliding with rect """
+        size = self.TILE_SIZE
+        x0 = max(rect.left // size, 0)
+        x1 = min((rect.left + rect.width - 1) // size, self.MAP_SIZE - 1)
+        y0 = max(rect.top // size, 0)
+        y1 = min((rect.top + rect.height - 1) // size, self.MAP_SIZE - 1)
+        return [(x*size, y*size) for y in range(y0, y1+1) for x in range(x0, x1+1)
+            if self.grid[y][x] in self.OBSTACLE_TILES]
+
+    def collides(self, rect):
+        """ Whether rect collides with an obstacle tile or the castle """
+        if rect.colliderect(castle.rect):
+            return True
+        size = self.TILE_SIZE
+        x0 = max(rect.left // size, 0)
+        x1 = min((rect.left + rect.width - 1) // size, self.MAP_SIZE - 1)
+        for y in range(max(rect.top // size, 0), min((rect.top + rect.height - 1) // size, self.MAP_SIZE - 1) + 1):
+            row = self.grid[y]
+            for x in range(x0, x1+1):
+                if row[x] in self.OBSTACLE_TILES:
+                    return True
+        return False
 
     def buildFortress(self, tile):
         """ Build walls around castle made from tile """
@@ -559,8 +790,6 @@ class Tank():
 
     def __init__(self, level, side, position = None, direction = None, filename = None):
 
-        global sprites
-
         # health. 0 health means dead
         self.health = 100
 
@@ -595,21 +824,22 @@ class Tank():
         self.bonus = None
 
         # navigation keys: fire, up, right, down, left
-        self.controls = [pygame.K_SPACE, pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_LEFT]
+        if pygame != None:
+            self.controls = [pygame.K_SPACE, pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_LEFT]
 
         # currently pressed buttons (navigation only)
         self.pressed = [False] * 4
 
         self.shield_images = [
-            sprites.subsurface(0, 48*2, 16*2, 16*2),
-            sprites.subsurface(16*2, 48*2, 16*2, 16*2)
+            subsurface(0, 48*2, 16*2, 16*2),
+            subsurface(16*2, 48*2, 16*2, 16*2)
         ]
         self.shield_image = self.shield_images[0]
         self.shield_index = 0
 
         self.spawn_images = [
-            sprites.subsurface(32*2, 48*2, 16*2, 16*2),
-            sprites.subsurface(48*2, 48*2, 16*2, 16*2)
+            subsurface(32*2, 48*2, 16*2, 16*2),
+            subsurface(48*2, 48*2, 16*2, 16*2)
         ]
         self.spawn_image = self.spawn_images[0]
         self.spawn_index = 0
@@ -617,9 +847,9 @@ class Tank():
         self.level = level
 
         if  position != None:
-            self.rect = pygame.Rect(position, (26, 26))
+            self.rect = Rect(position, (26, 26))
         else:
-            self.rect = pygame.Rect(0, 0, 26, 26)
+            self.rect = Rect(0, 0, 26, 26)
 
         if direction == None:
             self.direction = random.choice([self.DIR_RIGHT, self.DIR_DOWN, self.DIR_LEFT])
@@ -629,10 +859,11 @@ class Tank():
         self.state = self.STATE_SPAWNING
 
         # spawning animation
-        self.timer_uuid_spawn = gtimer.add(100, lambda :self.toggleSpawnImage())
+        if self.level.cosmetic:
+            self.timer_uuid_spawn = gtimer.add(100, self.toggleSpawnImage)
 
         # duration of spawning
-        self.timer_uuid_spawn_end = gtimer.add(1000, lambda :self.endSpawning())
+        self.timer_uuid_spawn_end = gtimer.add(1000, self.endSpawning)
 
     def endSpawning(self):
         """ End spawning
@@ -680,7 +911,7 @@ class Tank():
         """ start tanks's explosion """
         if self.state != self.STATE_DEAD:
             self.state = self.STATE_EXPLODING
-            self.explosion = Explosion(self.rect.topleft)
+            self.explosion = Explosion.new(self.rect.topleft, cosmetic = self.level.cosmetic)
 
             if self.bonus:
                 self.spawnBonus()
@@ -708,7 +939,7 @@ class Tank():
             if active_bullets >= self.max_active_bullets:
                 return False
 
-        bullet = Bullet(self.level, self.rect.topleft, self.direction)
+        bullet = Bullet.new(self.level, self.rect.topleft, self.direction)
 
         # if superpower level is at least 1
         if self.superpowers > 0:
@@ -765,6 +996,7 @@ class Tank():
         if self.state == self.STATE_EXPLODING:
             if not self.explosion.active:
                 self.state = self.STATE_DEAD
+                Explosion.release(self.explosion)
                 del self.explosion
 
     def nearest(self, num, base):
@@ -800,7 +1032,7 @@ class Tank():
         elif self.side == self.SIDE_PLAYER:
             if not self.paralised:
                 self.setParalised(True)
-                self.timer_uuid_paralise = gtimer.add(10000, lambda :self.setParalised(False), 1)
+                self.timer_uuid_paralise = gtimer.add(10000, partial(self.setParalised, False), 1)
             return True
 
     def setParalised(self, paralised = True):
@@ -821,7 +1053,7 @@ class Enemy(Tank):
 
         Tank.__init__(self, level, type, position = None, direction = None, filename = None)
 
-        global enemies, sprites
+        global enemies
 
         # if true, do not fire
         self.bullet_queued = False
@@ -848,22 +1080,22 @@ class Enemy(Tank):
                     break
 
         images = [
-            sprites.subsurface(32*2, 0, 13*2, 15*2),
-            sprites.subsurface(48*2, 0, 13*2, 15*2),
-            sprites.subsurface(64*2, 0, 13*2, 15*2),
-            sprites.subsurface(80*2, 0, 13*2, 15*2),
-            sprites.subsurface(32*2, 16*2, 13*2, 15*2),
-            sprites.subsurface(48*2, 16*2, 13*2, 15*2),
-            sprites.subsurface(64*2, 16*2, 13*2, 15*2),
-            sprites.subsurface(80*2, 16*2, 13*2, 15*2)
+            subsurface(32*2, 0, 13*2, 15*2),
+            subsurface(48*2, 0, 13*2, 15*2),
+            subsurface(64*2, 0, 13*2, 15*2),
+            subsurface(80*2, 0, 13*2, 15*2),
+            subsurface(32*2, 16*2, 13*2, 15*2),
+            subsurface(48*2, 16*2, 13*2, 15*2),
+            subsurface(64*2, 16*2, 13*2, 15*2),
+            subsurface(80*2, 16*2, 13*2, 15*2)
         ]
 
         self.image = images[self.type+0]
 
         self.image_up = self.image;
-        self.image_left = pygame.transform.rotate(self.image, 90)
-        self.image_down = pygame.transform.rotate(self.image, 180)
-        self.image_right = pygame.transform.rotate(self.image, 270)
+        self.image_left = rotate(self.image, 90)
+        self.image_down = rotate(self.image, 180)
+        self.image_right = rotate(self.image, 270)
 
         if self.bonus:
             self.image1_up = self.image_up;
@@ -873,9 +1105,9 @@ class Enemy(Tank):
 
             self.image2 = images[self.type+4]
             self.image2_up = self.image2;
-            self.image2_left = pygame.transform.rotate(self.image2, 90)
-            self.image2_down = pygame.transform.rotate(self.image2, 180)
-            self.image2_right = pygame.transform.rotate(self.image2, 270)
+            self.image2_left = rotate(self.image2, 90)
+            self.image2_down = rotate(self.image2, 180)
+            self.image2_right = rotate(self.image2, 270)
 
         self.rotate(self.direction, False)
 
@@ -889,7 +1121,7 @@ class Enemy(Tank):
         self.path = self.generatePath(self.direction)
 
         # 1000 is duration between shots
-        self.timer_uuid_fire = gtimer.add(1000, lambda :self.fire())
+        self.timer_uuid_fire = gtimer.add(1000, self.fire)
 
         # turn on flashing
         #if self.bonus:
@@ -923,7 +1155,7 @@ class Enemy(Tank):
         bonus = Bonus(self.level)
         bonuses.append(bonus)
         #gtimer.add(500, lambda :bonus.toggleVisibility())
-        gtimer.add(20000, lambda :bonuses.remove(bonus), 1)
+        gtimer.add(20000, bonus.destroy, 1)
 
 
     def getFreeSpawningPosition(self):
@@ -940,7 +1172,7 @@ class Enemy(Tank):
 
         for pos in available_positions:
 
-            enemy_rect = pygame.Rect(pos, [26, 26])
+            enemy_rect = Rect(pos, [26, 26])
 
             # collisions with other enemies
             collision = False
@@ -995,10 +1227,10 @@ class Enemy(Tank):
                 self.path = self.generatePath(self.direction, True)
                 return
 
-        new_rect = pygame.Rect(new_position, [26, 26])
+        new_rect = Rect(new_position, [26, 26])
 
         # collisions with tiles
-        if new_rect.collidelist(self.level.obstacle_rects) != -1:
+        if self.level.collides(new_rect):
             self.path = self.generatePath(self.direction, True)
             return
 
@@ -1071,22 +1303,22 @@ class Enemy(Tank):
         for direction in directions:
             if direction == self.DIR_UP and y > 1:
                 new_pos_rect = self.rect.move(0, -8)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collides(new_pos_rect):
                     new_direction = direction
                     break
             elif direction == self.DIR_RIGHT and x < 24:
                 new_pos_rect = self.rect.move(8, 0)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collides(new_pos_rect):
                     new_direction = direction
                     break
             elif direction == self.DIR_DOWN and y < 24:
                 new_pos_rect = self.rect.move(0, 8)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collides(new_pos_rect):
                     new_direction = direction
                     break
             elif direction == self.DIR_LEFT and x > 1:
                 new_pos_rect = self.rect.move(-8, 0)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collides(new_pos_rect):
                     new_direction = direction
                     break
 
@@ -1136,8 +1368,6 @@ class Player(Tank):
 
         Tank.__init__(self, level, type, position = None, direction = None, filename = None)
 
-        global sprites
-
         if filename == None:
             filename = (0, 0, 16*2, 16*2)
 
@@ -1152,11 +1382,11 @@ class Player(Tank):
         # store how many bonuses in this stage this player has collected
 
 
-        self.image = sprites.subsurface(filename)
+        self.image = subsurface(filename)
         self.image_up = self.image;
-        self.image_left = pygame.transform.rotate(self.image, 90)
-        self.image_down = pygame.transform.rotate(self.image, 180)
-        self.image_right = pygame.transform.rotate(self.image, 270)
+        self.image_left = rotate(self.image, 90)
+        self.image_down = rotate(self.image, 180)
+        self.image_right = rotate(self.image, 270)
 
         if direction == None:
             self.rotate(self.DIR_UP, False)
@@ -1171,6 +1401,7 @@ class Player(Tank):
         if self.state == self.STATE_EXPLODING:
             if not self.explosion.active:
                 self.state = self.STATE_DEAD
+                Explosion.release(self.explosion)
                 del self.explosion
 
         if self.state != self.STATE_ALIVE:
@@ -1205,10 +1436,10 @@ class Player(Tank):
                 self.score -= 0.002
                 return
 
-        player_rect = pygame.Rect(new_position, [26, 26])
+        player_rect = Rect(new_position, [26, 26])
 
         # collisions with tiles
-        if player_rect.collidelist(self.level.obstacle_rects) != -1:
+        if self.level.collides(player_rect):
             self.score -= 0.002 
             return
 
@@ -1241,6 +1472,103 @@ class Player(Tank):
         self.pressed = [False] * 4
         self.state = self.STATE_ALIVE
 
+class ArrayRenderer(object):
+    """ Draw the game state in flat colors into a numpy array, without pygame.
+    It's an observation for agents, not a picture of the game: there are no
+    explosions, shields or labels, and tanks are squares with a dark barrel
+    block on the side they face. Agents trained on it can't play on the
+    sprites drawn by pygame, and the other way around """
+
+    # by tile type. water and grass are darker than bricks and steel also in gray
+    TILE_COLORS = [[0, 0, 0], [188, 84, 0], [140, 140, 140], [32, 64, 160], [40, 120, 40], [48, 48, 48]]
+    PLAYER_COLOR = [255, 200, 0]
+    ENEMY_COLOR = [230, 230, 230]
+    SPAWN_COLOR = [96, 96, 96]
+    BULLET_COLOR = [255, 255, 255]
+    BONUS_COLOR = [0, 255, 128]
+    BARREL_COLOR = [32, 32, 32]
+
+    # [left, top, width, height] of the barrel in a 26x26 tank, by direction
+    barrel_offsets = [[9, 0, 8, 10], [16, 9, 10, 8], [9, 16, 8, 10], [0, 9, 10, 8]]
+
+    def __init__(self):
+        self.tile_colors = np.asarray(self.TILE_COLORS, dtype = "uint8")
+        self.barrel = Rect(0, 0, 0, 0)
+
+        # the tiles of level.version, with grass drawn separately on top
+        self.level = None
+        self.version = None
+        self.background = None
+        self.grass = None
+
+    def drawTiles(self, level):
+        grid = np.asarray(level.grid)
+        size = level.TILE_SIZE
+        is_grass = grid == level.TILE_GRASS
+        grid = np.where(is_grass, level.TILE_EMPTY, grid)
+        self.background = self.tile_colors[grid].repeat(size, 0).repeat(size, 1)
+        self.grass = is_grass.repeat(size, 0).repeat(size, 1)
+        self.level = level
+        self.version = level.version
+
+    def fill(self, image, rect, color):
+        image[max(rect.top, 0):max(rect.top + rect.height, 0),
+            max(rect.left, 0):max(rect.left + rect.width, 0)] = color
+
+    def draw(self, level):
+        """ Return the current frame, a 416x416x3 uint8 RGB array """
+        global player, enemies, bullets, bonuses
+
+        if level is not self.level or level.version != self.version:
+            self.drawTiles(level)
+        image = self.background.copy()
+
+        for tank in enemies + [player]:
+            if tank.state == tank.STATE_ALIVE:
+                color = self.PLAYER_COLOR if tank is player else self.ENEMY_COLOR
+            elif tank.state == tank.STATE_SPAWNING:
+                color = self.SPAWN_COLOR
+            else:
+                continue
+            self.fill(image, tank.rect, color)
+            if tank.state == tank.STATE_ALIVE:
+                left, top, width, height = self.barrel_offsets[tank.direction]
+                barrel = self.barrel
+                barrel.left, barrel.top = tank.rect.left + left, tank.rect.top + top
+                barrel.width, barrel.height = width, height
+                self.fill(image, barrel, self.BARREL_COLOR)
+
+        for bullet in bullets:
+            if bullet.state == bullet.STATE_ACTIVE:
+                self.fill(image, bullet.rect, self.BULLET_COLOR)
+
+        for bonus in bonuses:
+            if bonus.visible:
+                self.fill(image, bonus.rect, self.BONUS_COLOR)
+
+        image[self.grass] = self.tile_colors[level.TILE_GRASS]
+        return image
+
+class GamePickler(pickle.Pickler):
+    """ Pickle the entities of a game, but only a reference to the game itself,
+    whose methods are called by timers """
+
+    def __init__(self, f, game):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.game = game
+
+    def persistent_id(self, obj):
+        return "game" if obj is self.game else None
+
+class GameUnpickler(pickle.Unpickler):
+
+    def __init__(self, f, game):
+        pickle.Unpickler.__init__(self, f)
+        self.game = game
+
+    def persistent_load(self, pid):
+        return self.game
+
 class Game():
 
     # direction constants
@@ -1248,7 +1576,71 @@ class Game():
 
     TILE_SIZE = 16
 
-    def __init__(self):
+    # ms per frame when the game is not drawn, as clock.tick(50) at full speed
+    FRAME_TIME = 20
+
+    # at most this many frames are simulated before a level is ready to play
+    MAX_WARM_UP_FRAMES = 100
+
+    # attributes of the game saved in snapshots
+    SNAPSHOT_ATTRS = ("stage", "level", "timefreeze", "game_over", "running", "active")
+
+    def __init__(self, render = True, reset_cache = 0, fidelity = "full"):
+        """ If render is False, pygame is not used at all: nothing is drawn and
+        getScreenRGB() returns the flat colors of ArrayRenderer
+
+        If reset_cache is positive, reset_game() starts from one of this many
+        snapshots per level, taken once the first enemies have spawned. It
+        needs render = False, as surfaces can't be pickled
+
+        If fidelity is "training", purely visual changes and their timers are
+        skipped: blinking spawns and shields, waves, explosion frames and
+        score labels. Timers are then updated through a snapshot (see
+        Timer.update), so that the missing ones don't change when the others
+        fire: some events may happen a frame apart from the full game """
+
+        global castle
+
+        if render and reset_cache:
+            raise ValueError("The reset cache only works with render = False")
+        if fidelity not in ("full", "training"):
+            raise ValueError("Unknown fidelity: " + str(fidelity))
+
+        self.fidelity = fidelity
+        self.cosmetic = fidelity == "full"
+
+        self.render = render
+
+        # snapshots by (stage, bucket)
+        self.reset_cache = reset_cache
+        self.snapshots = {}
+
+        if render:
+            if pygame == None:
+                raise ImportError("pygame is needed to render the game")
+            self.initDisplay()
+            self.renderer = None
+        else:
+            self.clock = None
+            self.renderer = ArrayRenderer()
+
+        castle = Castle(self.cosmetic)
+
+        # if true, no new enemies will be spawn during this time
+        self.timefreeze = False
+
+        # number of player. here is defined preselected menu value
+        self.nr_of_players = 1
+        
+        player = None
+        for bullet in bullets:
+            Bullet.release(bullet)
+        del bullets[:]
+        del enemies[:]
+        del bonuses[:]
+
+    def initDisplay(self):
+        """ Open the window, load sprites, sounds and fonts """
 
         global screen, sprites, play_sounds, sounds
 
@@ -1274,6 +1666,12 @@ class Game():
         # load sprites (funky version)
         #sprites = pygame.transform.scale2x(pygame.image.load("images/sprites.gif"))
         # load sprites (pixely version)
+        if sprites == None:
+            sprites = pygame.transform.scale(pygame.image.load("images/sprites.gif"), [192, 224])
+
+        # cached as None by games which are not drawn. loaded again when needed
+        Bullet.images = Bullet.explosion_images = None
+        Explosion.default_images = None
         
         #screen.set_colorkey((0,138,104))
 
@@ -1290,22 +1688,10 @@ class Game():
         # this is used in intro screen
         self.player_image = pygame.transform.rotate(sprites.subsurface(0, 0, 13*2, 13*2), 270)
 
-        # if true, no new enemies will be spawn during this time
-        self.timefreeze = False
-
         # load custom font
         self.font = pygame.font.Font("fonts/prstart.ttf", 16)
 
 
-        # number of player. here is defined preselected menu value
-        self.nr_of_players = 1
-        
-        player = None
-        del bullets[:]
-        del enemies[:]
-        del bonuses[:]
-
-
     def triggerBonus(self, bonus, player):
         """ Execute bonus powers """
 #global bonuses added here
@@ -1321,7 +1707,7 @@ class Game():
             self.shieldPlayer(player, True, 10000)
         elif bonus.bonus == bonus.BONUS_SHOVEL:
             self.level.buildFortress(self.level.TILE_STEEL)
-            gtimer.add(10000, lambda :self.level.buildFortress(self.level.TILE_BRICK), 1)
+            gtimer.add(10000, partial(self.level.buildFortress, self.level.TILE_BRICK), 1)
         #elif bonus.bonus == bonus.BONUS_STAR:
         #    player.superpowers += 1
         #    if player.superpowers == 2:
@@ -1331,10 +1717,11 @@ class Game():
             #player.lives += 1
         elif bonus.bonus == bonus.BONUS_TIMER:
             self.toggleEnemyFreeze(True)
-            gtimer.add(10000, lambda :self.toggleEnemyFreeze(False), 1)
+            gtimer.add(10000, partial(self.toggleEnemyFreeze, False), 1)
         bonuses.remove(bonus)
 
-        labels.append(Label(bonus.rect.topleft, "500", 500))
+        if self.cosmetic:
+            labels.append(Label.new(bonus.rect.topleft, "500", 500))
 
     def shieldPlayer(self, player, shield = True, duration = None):
         """ Add/remove shield
@@ -1343,13 +1730,15 @@ class Game():
         duration: in ms. if none, do not remove shield automatically
         """
         player.shielded = shield
-        if shield:
-            player.timer_uuid_shield = gtimer.add(100, lambda :player.toggleShieldImage())
+        if not self.cosmetic:
+            pass
+        elif shield:
+            player.timer_uuid_shield = gtimer.add(100, player.toggleShieldImage)
         else:
             gtimer.destroy(player.timer_uuid_shield)
 
         if shield and duration != None:
-            gtimer.add(duration, lambda :self.shieldPlayer(player, False), 1)
+            gtimer.add(duration, partial(self.shieldPlayer, player, False), 1)
 
 
     def spawnEnemy(self):
@@ -1403,6 +1792,9 @@ class Game():
     def draw(self):
         global screen, castle, player, enemies, bullets, bonuses
 
+        if not self.render:
+            return
+
         screen.fill([0, 0, 0])
 
         self.level.draw([self.level.TILE_EMPTY, self.level.TILE_BRICK, self.level.TILE_STEEL, self.level.TILE_FROZE, self.level.TILE_WATER])
@@ -1555,6 +1947,8 @@ class Game():
         global castle, player, bullets, bonuses, play_sounds, sounds
         
         player = None
+        for bullet in bullets:
+            Bullet.release(bullet)
         del bullets[:]
         del enemies[:]
         del bonuses[:]
@@ -1563,14 +1957,14 @@ class Game():
 
         # load level
         self.stage += 1
-        self.level = Level(self.stage)
+        self.level = Level(self.stage, self.cosmetic)
         self.timefreeze = False
 
         self.reloadPlayers()
         
         
-        gtimer.add(2000, lambda :self.spawnEnemy())
-        gtimer.add(3000*60, lambda :self.gameOver(),repeat=1)
+        gtimer.add(2000, self.spawnEnemy)
+        gtimer.add(3000*60, self.gameOver,repeat=1)
         #gtimer.add(1000, lambda :self.printScore())
         # if True, start "game over" animation
         self.game_over = False
@@ -1596,10 +1990,63 @@ class Game():
     
     def reset_game(self):
         self.stage = random.randint(0,0)
+        if not self.reset_cache:
+            self.nextLevel()
+            return
+
+        key = (self.stage + 1, random.randrange(self.reset_cache))
+        if key in self.snapshots:
+            self.restore(self.snapshots[key])
+            return
         self.nextLevel()
+        self.warmUp()
+        self.snapshots[key] = self.snapshot()
+
+    def warmUp(self):
+        """ Run the level until the first enemies have spawned, then start scoring """
+        for i in range(self.MAX_WARM_UP_FRAMES):
+            if not [enemy for enemy in enemies if enemy.state == enemy.STATE_SPAWNING]:
+                break
+            self.tick()
+        player.score = 0
+
+    def snapshot(self):
+        """ Save the state of the game and of all entities
+        @return bytes """
+        state = {
+            "game": dict((name, getattr(self, name)) for name in self.SNAPSHOT_ATTRS),
+            "timers": gtimer.timers,
+            "castle": castle,
+            "player": player,
+            "enemies": enemies,
+            "bullets": bullets,
+            "bonuses": bonuses,
+            "labels": labels
+        }
+        f = io.BytesIO()
+        GamePickler(f, self).dump(state)
+        return f.getvalue()
+
+    def restore(self, snapshot):
+        """ Continue from a snapshot """
+
+        global castle, player
+
+        state = GameUnpickler(io.BytesIO(snapshot), self).load()
+        for name, value in state["game"].items():
+            setattr(self, name, value)
+        gtimer.timers[:] = state["timers"]
+        castle = state["castle"]
+        player = state["player"]
+        enemies[:] = state["enemies"]
+        bullets[:] = state["bullets"]
+        bonuses[:] = state["bonuses"]
+        labels[:] = state["labels"]
         
     def getScreenRGB(self):
         global screen
+        if self.renderer != None:
+            return self.renderer.draw(self.level)
         rgb = pygame.surfarray.array3d(screen)
         return np.rollaxis(rgb,1,0)
     
@@ -1634,7 +2081,14 @@ class Game():
             
                 
         if self.running:
-            #player.score -= 1
+            self.tick()
+
+    def tick(self):
+        """ Advance the world by one frame """
+        global castle, player, bullets, bonuses, play_sounds, sounds
+
+        #player.score -= 1
+        if self.render:
             time_passed = self.clock.tick(50)
 
             for event in pygame.event.get():
@@ -1642,52 +2096,57 @@ class Game():
                     pass
                 elif event.type == pygame.QUIT:
                     quit()
+        else:
+            time_passed = self.FRAME_TIME
 
-            player.update(time_passed)
+        player.update(time_passed)
 
-            for enemy in enemies:
-                if enemy.state == enemy.STATE_DEAD and not self.game_over and self.active:
-                    enemies.remove(enemy)
+        for enemy in enemies:
+            if enemy.state == enemy.STATE_DEAD and not self.game_over and self.active:
+                enemies.remove(enemy)
+            else:
+                enemy.update(time_passed)
+
+        if not self.game_over and self.active:
+            player.score -= 0.0001
+            if player.state == player.STATE_ALIVE:
+                if player.bonus != None and player.side == player.SIDE_PLAYER:
+                    self.triggerBonus(player.bonus, player)
+                    player.bonus = None
+            elif player.state == player.STATE_DEAD:
+                self.superpowers = 0
+                player.score -= 1
+                player.lives -= 1
+                if player.lives > 0:
+                    self.respawnPlayer(player)
                 else:
-                    enemy.update(time_passed)
-
-            if not self.game_over and self.active:
-                player.score -= 0.0001
-                if player.state == player.STATE_ALIVE:
-                    if player.bonus != None and player.side == player.SIDE_PLAYER:
-                        self.triggerBonus(player.bonus, player)
-                        player.bonus = None
-                elif player.state == player.STATE_DEAD:
-                    self.superpowers = 0
-                    player.score -= 1
-                    player.lives -= 1
-                    if player.lives > 0:
-                        self.respawnPlayer(player)
-                    else:
-                        self.gameOver()
+                    self.gameOver()
 
-            for bullet in bullets:
-                if bullet.state == bullet.STATE_REMOVED:
-                    bullets.remove(bullet)
-                else:
-                    bullet.update()
+        for bullet in bullets:
+            if bullet.state == bullet.STATE_REMOVED:
+                bullets.remove(bullet)
+                Bullet.release(bullet)
+            else:
+                bullet.update()
 
-            for bonus in bonuses:
-                if bonus.active == False:
-                    bonuses.remove(bonus)
+        for bonus in bonuses:
+            if bonus.active == False:
+                bonuses.remove(bonus)
 
-            for label in labels:
-                if not label.active:
-                    labels.remove(label)
+        for label in labels:
+            if not label.active:
+                labels.remove(label)
+                Label.release(label)
 
-            gtimer.update(time_passed)
+        gtimer.update(time_passed, snapshot = not self.cosmetic)
 
-            self.draw()
-            
-            
-            
+        self.draw()
+        
+        
+        
 gtimer = Timer()
-sprites = pygame.transform.scale(pygame.image.load("images/sprites.gif"), [192, 224])
+# loaded by the first Game which is drawn
+sprites = None
 screen = None
 player = None
 enemies = []
@@ -1696,4 +2155,4 @@ bonuses = []
 labels = []
 play_sounds = False
 sounds = {}
-castle = Castle()
+castle = None
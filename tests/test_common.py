@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_common.py
+
+import os
+import sys
+import random
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import (discounted_returns, n_step_returns, lambda_returns,  # noqa
+                    seed_player, play_one_episode)
+from tensorpack.RL import (RLEnvironment, DiscreteActionSpace, HistoryFramePlayer,  # noqa
+                           PreventStuckPlayer, LimitLengthPlayer)
+
+
+def random_segments(rng, B=20, T=37):
+    return rng.randn(B, T).astype('float32'), rng.rand(B, T) < 0.1, rng.randn(B, T + 1)
+
+
+class TestReturns(unittest.TestCase):
+    def test_discounted(self):
+        rewards, isOver, values = random_segments(np.random.RandomState(0))
+        ret = discounted_returns(rewards, isOver, 0.9, bootstrap=values[:, -1])
+        for b in range(len(rewards)):
+            R = values[b, -1]
+            for t in reversed(range(rewards.shape[1])):
+                R = rewards[b, t] + (0. if isOver[b, t] else 0.9 * R)
+                self.assertAlmostEqual(ret[b, t], R, places=4)
+        # one segment, and a scalar bootstrap
+        self.assertTrue(np.allclose(discounted_returns(rewards[0], isOver[0], 0.9, 1.),
+                                    discounted_returns(rewards[:1], isOver[:1], 0.9, 1.)[0]))
+
+    def test_lambda(self):
+        rewards, isOver, values = random_segments(np.random.RandomState(1))
+        ret = lambda_returns(rewards, isOver, values, 0.9, 0.8)
+        for b in range(len(rewards)):
+            G = values[b, -1]
+            for t in reversed(range(rewards.shape[1])):
+                G = rewards[b, t] + (0. if isOver[b, t] else 0.9 * (0.2 * values[b, t + 1] + 0.8 * G))
+                self.assertAlmostEqual(ret[b, t], G, places=4)
+        # lam=1 is the discounted return
+        self.assertTrue(np.allclose(lambda_returns(rewards, isOver, values, 0.9, 1.),
+                                    discounted_returns(rewards, isOver, 0.9, values[:, -1]), atol=1e-5))
+
+    def test_n_step(self):
+        rng = np.random.RandomState(0)
+        rewards = rng.randn(50, 5).astype('float32')
+        isOver = rng.rand(50, 5) < 0.2
+        R, over = n_step_returns(rewards, isOver, 0.9)
+        for b in range(50):
+            ret, discount = 0., 1.
+            for t in range(5):
+                ret += discount * rewards[b, t]
+                discount *= 0.9
+                if isOver[b, t]:
+                    break
+            self.assertAlmostEqual(R[b], ret, places=5)
+            self.assertEqual(over[b], isOver[b].any())
+
+    def test_one_step(self):
+        R, over = n_step_returns([[1.], [2.]], [[False], [True]], 0.9)
+        self.assertTrue(np.allclose(R, [1., 2.]))
+        self.assertEqual(over.tolist(), [False, True])
+
+
+class RandomGame(RLEnvironment):
+    """ draws from the global random module, like the tank game """
+
+    def __init__(self):
+        super(RandomGame, self).__init__()
+        self.action_space = DiscreteActionSpace(4)
+        self.restart_episode()
+
+    def seed(self, seed):
+        random.seed(seed)
+        self.action_space.rng.seed(seed)
+
+    def get_action_space(self):
+        return self.action_space
+
+    def current_state(self):
+        return np.full((2, 2, 1), self.frame, dtype='uint8')
+
+    def restart_episode(self):
+        self.frame, self.score, self.step = random.randint(0, 255), 0., 0
+
+    def finish_episode(self):
+        self.stats['score'].append(self.score)
+
+    def action(self, act):
+        self.frame = (self.frame + act * random.randint(1, 9)) % 256
+        self.score += random.random() * act
+        self.step += 1
+        isOver = self.step == 300
+        if isOver:
+            self.finish_episode()
+            self.restart_episode()
+        return self.score, isOver
+
+
+class TestSeedPlayer(unittest.TestCase):
+    def build_player(self):
+        pl = HistoryFramePlayer(RandomGame(), 4)
+        pl = PreventStuckPlayer(pl, 30, 1)
+        return LimitLengthPlayer(pl, 1000)
+
+    def play(self, player, seed):
+        # the greedy action depends on the states
+        def func(dp):
+            return [[np.bincount(dp[0][0].ravel() % 4, minlength=4)]]
+        seed_player(player, seed)
+        return play_one_episode(player, func)
+
+    def test_same_seed(self):
+        first, second = self.build_player(), self.build_player()
+        scores = [self.play(first, 3)]
+        # another episode in between, which must not change the next one
+        self.play(first, 4)
+        scores.append(self.play(first, 3))
+        scores.append(self.play(second, 3))
+        self.assertEqual(scores[0], scores[1])
+        self.assertEqual(scores[0], scores[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
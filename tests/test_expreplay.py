@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_expreplay.py
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from expreplay import (SumTree, ExpReplay, PrioritizedExpReplay, Experience,  # noqa
+                       ReplayMemory, CompressedReplayMemory)
+
+
+class FakeActionSpace(object):
+    def num_actions(self):
+        return 4
+
+
+class FakePlayer(object):
+    def get_action_space(self):
+        return FakeActionSpace()
+
+
+class CountingPlayer(FakePlayer):
+    """ the k-th state is filled with k, and its reward is k """
+
+    def __init__(self):
+        self.step = 0
+
+    def current_state(self):
+        return np.full((2, 2, 1), self.step % 251, dtype='uint8')
+
+    def action(self, act):
+        self.step += 1
+        return float(self.step - 1), False
+
+
+def fill_memory(mem, nr, rng):
+    for k in range(nr):
+        state = rng.randint(0, 255, size=mem.state_shape).astype('uint8')
+        mem.append(Experience(state, rng.randint(4), rng.rand(), rng.rand() < 0.1))
+
+
+def assert_batch_equal(test, a, b):
+    test.assertEqual(len(a), len(b))
+    for x, y in zip(a, b):
+        test.assertTrue(np.array_equal(x, y))
+
+
+class TestReplayMemory(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_compressed(self):
+        rng = np.random.RandomState(1)
+        mem = ReplayMemory(60, (8, 8, 1), 4)
+        cmem = CompressedReplayMemory(60, (8, 8, 1), 4, cache_size=10)
+        # more than max_size, so that the ring wraps around
+        for k in range(200):
+            state = (rng.rand(8, 8, 1) * 3).astype('uint8') * 80
+            exp = Experience(state, k % 5, float(k), rng.rand() < 0.1)
+            mem.append(exp)
+            cmem.append(exp)
+        idx = rng.randint(len(mem) - 5, size=32)
+        for nstep in [1, 3]:
+            assert_batch_equal(self, mem.sample(idx, nstep), cmem.sample(idx, nstep))
+            # again, from the cache
+            assert_batch_equal(self, mem.sample(idx, nstep), cmem.sample(idx, nstep))
+
+    def test_save_load(self):
+        rng = np.random.RandomState(1)
+        for cls in [ReplayMemory, CompressedReplayMemory]:
+            mem = cls(60, (8, 8, 1), 4)
+            fill_memory(mem, 100, rng)
+            dirname = os.path.join(self.dirname, cls.__name__)
+            mem.save(dirname, chunk_size=7)
+            loaded = cls(60, (8, 8, 1), 4)
+            loaded.load(dirname)
+            idx = rng.randint(len(mem) - 5, size=32)
+            assert_batch_equal(self, mem.sample(idx), loaded.sample(idx))
+
+    def test_overwrite_while_decoding(self):
+        mem = CompressedReplayMemory(20, (4, 4), 1, cache_size=10)
+        old, new = np.zeros((4, 4), dtype='uint8'), np.full((4, 4), 7, dtype='uint8')
+        mem._store_state(3, old)
+        decode = mem._decode
+
+        def decode_and_overwrite(blob):
+            # a writer overwrites the frame while it is being decoded
+            mem._decode = decode
+            mem._store_state(3, new)
+            return decode(blob)
+        mem._decode = decode_and_overwrite
+        mem._gather_states(np.array([3]))
+        # the old frame must not have been cached
+        self.assertTrue((mem._gather_states(np.array([3]))[0] == new).all())
+
+
+class TestConcurrentSampling(unittest.TestCase):
+    def check(self, replay):
+        for _ in range(100):
+            replay._populate_exp()
+        stop = threading.Event()
+
+        def populate():
+            while not stop.is_set():
+                replay._populate_exp()
+        th = threading.Thread(target=populate)
+        interval = sys.getswitchinterval()
+        # switch threads as often as possible
+        sys.setswitchinterval(1e-6)
+        th.start()
+        try:
+            rng = np.random.RandomState(0)
+            spec = replay._batch_spec()
+            for k in range(2000):
+                out = [np.empty(shape, dtype=dtype) for shape, dtype in spec] if k % 2 else None
+                state, _, reward, next_state = replay._sample_batch(rng, out)[:4]
+                # the states and rewards of a batch are from the same transitions
+                step = reward.astype('int64')
+                self.assertTrue((state[:, 0, 0, -1] == step % 251).all())
+                self.assertTrue((next_state[:, 0, 0, -1] == (step + 1) % 251).all())
+                self.assertTrue((next_state[:, 0, 0, -2] == step % 251).all())
+        finally:
+            sys.setswitchinterval(interval)
+            stop.set()
+            th.join()
+
+    def test_full_memory(self):
+        for cls in [ExpReplay, PrioritizedExpReplay]:
+            for compress in [None, 'zlib']:
+                replay = cls(None, CountingPlayer(), (2, 2, 1), batch_size=32, memory_size=20,
+                             history_len=4, exploration=1, compress=compress)
+                self.check(replay)
+
+
+class TestSumTree(unittest.TestCase):
+    def test_total(self):
+        tree = SumTree(10)
+        prio = np.random.RandomState(0).rand(10)
+        tree.update(np.arange(10), prio)
+        self.assertAlmostEqual(tree.total, prio.sum())
+
+        # duplicates take the last priority
+        tree.update([1, 1, 5], [2., 3., 0.5])
+        prio[1], prio[5] = 3., 0.5
+        self.assertAlmostEqual(tree.total, prio.sum())
+        self.assertTrue(np.allclose(tree.get([1, 5]), [3., 0.5]))
+
+    def test_find(self):
+        tree = SumTree(13)
+        prio = np.random.RandomState(0).rand(13)
+        prio[3] = 0
+        tree.update(np.arange(13), prio)
+        cumsum = np.cumsum(prio)
+        # the two sums may differ in the last bits
+        values = np.linspace(1e-9, min(tree.total, cumsum[-1]), 10000)
+        leaf = tree.find(values)
+        self.assertTrue((leaf == np.searchsorted(cumsum, values)).all())
+        # a leaf with zero priority is never found
+        self.assertFalse((leaf == 3).any())
+
+
+class TestPrioritizedSampling(unittest.TestCase):
+    def setUp(self):
+        self.replay = PrioritizedExpReplay(
+            None, FakePlayer(), (6, 6), batch_size=8, memory_size=100,
+            history_len=2)
+        self.rng = np.random.RandomState(0)
+        fill_memory(self.replay.mem, 50, self.rng)
+
+    def valid_positions(self):
+        start, end = self.replay._valid_range()
+        return self.replay._to_physical(np.arange(start, end))
+
+    def test_prioritized(self):
+        valid = self.valid_positions()
+        prio = np.zeros((len(valid),))
+        prio[::4] = 1.
+        self.replay.tree.update(valid, prio)
+        batch = self.replay._sample_batch(self.rng)
+        weight, pos = batch[5], batch[6]
+        self.assertEqual(len(pos), 8)
+        self.assertTrue(np.isin(pos, valid[::4]).all())
+        self.assertTrue(np.allclose(weight, 1.))
+
+    def test_all_bad(self):
+        # no transition has a positive priority: fall back to uniform sampling
+        self.replay.tree.clear()
+        batch = self.replay._sample_batch(self.rng)
+        weight, pos = batch[5], batch[6]
+        self.assertTrue(np.isin(pos, self.valid_positions()).all())
+        self.assertTrue(np.allclose(weight, 1.))
+
+
+if __name__ == '__main__':
+    unittest.main()
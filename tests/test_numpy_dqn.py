@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_numpy_dqn.py
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy_dqn import conv2d_same, max_pool, NumpyDQNPredictor  # noqa
+
+try:
+    import tensorflow as tf
+    import DQN
+except ImportError:
+    DQN = None
+
+
+def naive_conv2d_same(x, W, b):
+    n, h, w, _ = x.shape
+    kh, kw = W.shape[:2]
+    # 'SAME' puts the extra padding at the end
+    top, left = (kh - 1) // 2, (kw - 1) // 2
+    out = np.zeros((n, h, w, W.shape[3]))
+    for i in range(h):
+        for j in range(w):
+            for di in range(kh):
+                for dj in range(kw):
+                    y, x_ = i + di - top, j + dj - left
+                    if 0 <= y < h and 0 <= x_ < w:
+                        out[:, i, j] += x[:, y, x_].dot(W[di, dj])
+    return out + b
+
+
+class TestLayers(unittest.TestCase):
+    def test_conv2d_same(self):
+        rng = np.random.RandomState(0)
+        for k in [1, 3, 4, 5]:
+            x = rng.randn(2, 7, 6, 3)
+            W, b = rng.randn(k, k, 3, 5), rng.randn(5)
+            self.assertTrue(np.allclose(conv2d_same(x, W, b), naive_conv2d_same(x, W, b)), k)
+
+    def test_max_pool(self):
+        x = np.random.RandomState(0).randn(2, 5, 7, 3)
+        out = max_pool(x, 2)
+        self.assertEqual(out.shape, (2, 2, 3, 3))
+        self.assertEqual(out[1, 1, 2, 0], x[1, 2:4, 4:6, 0].max())
+
+
+@unittest.skipIf(DQN is None, "tensorflow or tensorpack cannot be imported")
+class TestAgainstTF(unittest.TestCase):
+    def check(self, method):
+        DQN.METHOD, DQN.NUM_ACTIONS = method, 6
+        rng = np.random.RandomState(0)
+        state = rng.randint(0, 255, size=(3,) + DQN.IMAGE_SHAPE3).astype('float32')
+        with tf.Graph().as_default():
+            image = tf.placeholder(tf.float32, (None,) + DQN.IMAGE_SHAPE3)
+            Q = DQN.Model()._get_DQN_prediction(image)
+            with tf.Session() as sess:
+                # random values for all weights, including biases and PReLU alphas
+                for v in tf.global_variables():
+                    shape = v.get_shape().as_list()
+                    sess.run(v.assign(rng.uniform(-0.1, 0.1, size=shape).astype('float32')))
+                params = {v.name: sess.run(v) for v in tf.global_variables()}
+                expected = sess.run(Q, feed_dict={image: state})
+        pred = NumpyDQNPredictor(params)
+        self.assertEqual(pred.dueling, method == 'Dueling')
+        self.assertTrue(np.allclose(pred.predict(state), expected, rtol=1e-4, atol=1e-4))
+
+    def test_dqn(self):
+        self.check('DQN')
+
+    def test_dueling(self):
+        self.check('Dueling')
+
+
+if __name__ == '__main__':
+    unittest.main()
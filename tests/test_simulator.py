@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_simulator.py
+
+import os
+import sys
+import threading
+import unittest
+import multiprocessing as mp
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'examples', 'A3C-Gym'))
+# common.py of the root, before the one of A3C-Gym
+sys.path.insert(0, ROOT)
+
+try:
+    from simulator import (pack_state, unpack_state, pack_action, unpack_action,  # noqa
+                           DeltaEncoder, DeltaDecoder, SimulatorProcessSharedWeight, WeightSync)
+    from common import SharedWeights
+except ImportError:     # needs zmq, tensorflow and tensorpack
+    DeltaEncoder = None
+
+
+class Frame(object):
+    """ what pack_state sends, as received by zmq with copy=False """
+
+    def __init__(self, data):
+        self.buffer = memoryview(data if isinstance(data, bytes) else np.ascontiguousarray(data))
+        self.bytes = self.buffer.tobytes()
+
+
+def transmit(frames):
+    return [Frame(f) for f in frames]
+
+
+def random_frames(rng, nr, shape=(24, 36, 3)):
+    """ frames where only a few tiles change from one to the next """
+    frame = rng.randint(0, 255, size=shape).astype('uint8')
+    for _ in range(nr):
+        frame = frame.copy()
+        y, x = rng.randint(shape[0] - 5), rng.randint(shape[1] - 5)
+        frame[y:y + 5, x:x + 5] = rng.randint(0, 255)
+        yield frame
+
+
+@unittest.skipIf(DeltaEncoder is None, "simulator cannot be imported")
+class TestStateMessage(unittest.TestCase):
+    def test_raw(self):
+        state = np.random.rand(4, 5, 2).astype('float32')
+        ident, s, reward, isOver, step = unpack_state(
+            transmit(pack_state(b'sim-0', state, 1.5, True, 7)))
+        self.assertEqual((ident, reward, isOver, step), (b'sim-0', 1.5, True, 7))
+        self.assertTrue(np.array_equal(s, state))
+        self.assertEqual(s.dtype, state.dtype)
+
+    def test_action(self):
+        self.assertEqual(unpack_action(pack_action(3, True)), (3, True))
+        self.assertEqual(unpack_action(pack_action(0)), (0, False))
+
+    def test_delta(self):
+        rng = np.random.RandomState(0)
+        encoder, decoders = DeltaEncoder(12, keyframe_interval=10), {}
+        states = []
+        for step, frame in enumerate(random_frames(rng, 25)):
+            _, s, _, _, _ = unpack_state(
+                transmit(pack_state(b'sim-0', frame, 0., False, step, encoder)), decoders)
+            self.assertTrue(np.array_equal(s, frame), step)
+            states.append(s)
+        # the states are not overwritten by the later ones
+        self.assertFalse(np.array_equal(states[0], states[-1]))
+
+    def test_untiled_shape(self):
+        encoder, decoder = DeltaEncoder(12), DeltaDecoder()
+        for step, frame in enumerate(random_frames(np.random.RandomState(0), 3, (25, 36))):
+            kind, tile, payload = encoder.encode(frame)
+            self.assertEqual(kind, 1)   # STATE_KEY
+            s = decoder.decode(kind, step, tile, frame.dtype, frame.shape, transmit(payload))
+            self.assertTrue(np.array_equal(s, frame))
+
+    def test_lost_state(self):
+        rng = np.random.RandomState(0)
+        encoder, decoder = DeltaEncoder(12), DeltaDecoder()
+        frames = list(random_frames(rng, 6))
+
+        def send(step, force_key=False):
+            kind, tile, payload = encoder.encode(frames[step], force_key)
+            return decoder.decode(kind, step, tile, frames[step].dtype, frames[step].shape, transmit(payload))
+        send(0)
+        send(1)
+        encoder.encode(frames[2])   # lost
+        self.assertIsNone(send(3))
+        self.assertTrue(decoder.need_keyframe)
+        # deltas are still not decodable, until the keyframe
+        self.assertIsNone(send(4))
+        self.assertTrue(np.array_equal(send(5, force_key=True), frames[5]))
+        self.assertFalse(decoder.need_keyframe)
+
+
+class FakeVar(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeTrainer(object):
+    """ a trainer whose session returns the given values for any variables """
+
+    def __init__(self):
+        self.sess = self
+        self.values = None
+
+    def run(self, fetches):
+        return self.values
+
+
+class RecordingUpdater(object):
+    """ loads the weights into a queue instead of a session """
+
+    def __init__(self, q):
+        self.q = q
+
+    def update(self, params):
+        self.q.put({k: np.array(v) for k, v in params.items()})
+
+
+if DeltaEncoder is not None:
+    class NaiveSharedWeightSimulator(SimulatorProcessSharedWeight):
+        def _build_player(self):
+            pass
+
+        def get_data(self):
+            pass
+
+
+def run_weight_thread(sim, nr_update, ready, q):
+    # what the thread started by SimulatorProcessSharedWeight._prepare does
+    sim.sess_updater = RecordingUpdater(q)
+    sim.weight_lock = threading.Lock()
+    sim.condvar.acquire()
+    ready.set()
+    for _ in range(nr_update):
+        sim.condvar.wait()
+        sim._trigger_evt()
+
+
+@unittest.skipIf(DeltaEncoder is None, "simulator cannot be imported")
+class TestSharedWeight(unittest.TestCase):
+    def test_sync(self):
+        weights, condvar = SharedWeights(), mp.Condition()
+        q, ready = mp.Queue(), mp.Event()
+        sim = NaiveSharedWeightSimulator(0, 'ipc://unused', condvar, weights, None)
+        proc = mp.Process(target=run_weight_thread, args=(sim, 2, ready, q))
+        proc.start()
+        try:
+            ready.wait()
+            sync = WeightSync(condvar, weights)
+            sync.vars = [FakeVar('fc/W:0'), FakeVar('fc/b:0')]
+            sync.trainer = FakeTrainer()
+            rng = np.random.RandomState(0)
+            for _ in range(2):
+                sync.trainer.values = [rng.rand(3, 2).astype('float32'), rng.rand(2).astype('float32')]
+                sync._sync()
+                # the worker sees the weights of this sync
+                params = q.get(timeout=30)
+                self.assertEqual(sorted(params), ['fc/W:0', 'fc/b:0'])
+                self.assertTrue(np.array_equal(params['fc/W:0'], sync.trainer.values[0]))
+                self.assertTrue(np.array_equal(params['fc/b:0'], sync.trainer.values[1]))
+            proc.join(30)
+        finally:
+            if proc.is_alive():
+                proc.terminate()
+            weights.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_tanks.py
+
+import os
+import sys
+import random
+import unittest
+import numpy as np
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import tanks  # noqa
+
+
+class TanksTestCase(unittest.TestCase):
+    def setUp(self):
+        # levels/ and images/ are relative to the root
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+
+def baseline_update(self, time_passed, snapshot=False):
+    # Timer.update of the original game
+    for timer in self.timers:
+        timer["time"] += time_passed
+        if timer["time"] > timer["interval"]:
+            timer["time"] -= timer["interval"]
+            timer["times"] += 1
+            if timer["repeat"] > -1 and timer["times"] == timer["repeat"]:
+                self.timers.remove(timer)
+            try:
+                timer["callback"]()
+            except:
+                try:
+                    self.timers.remove(timer)
+                except:
+                    pass
+
+
+class TestTimer(unittest.TestCase):
+    def test_remove_while_updating(self):
+        timer, fired = tanks.Timer(), []
+        timer.add(10, lambda: fired.append('a'), 1)
+        timer.add(10, lambda: fired.append('b'), 1)
+        timer.update(11, snapshot=True)
+        # removing 'a' after its last call doesn't skip 'b'
+        self.assertEqual(fired, ['a', 'b'])
+        self.assertEqual(timer.timers, [])
+
+    def test_add_and_destroy_in_callback(self):
+        timer, fired = tanks.Timer(), []
+        uuids = {}
+
+        def first():
+            fired.append('first')
+            timer.destroy(uuids['second'])
+            timer.add(10, lambda: fired.append('new'), 1)
+        timer.add(10, first, 1)
+        uuids['second'] = timer.add(10, lambda: fired.append('second'), 1)
+        timer.update(11, snapshot=True)
+        # the destroyed timer doesn't fire, and the new one starts at the next update
+        self.assertEqual(fired, ['first'])
+        timer.update(11, snapshot=True)
+        self.assertEqual(fired, ['first', 'new'])
+
+    def test_original_order(self):
+        timer, fired = tanks.Timer(), []
+        timer.add(10, lambda: fired.append('a'), 1)
+        timer.add(10, lambda: fired.append('b'), 1)
+        timer.update(11)
+        # without a snapshot, removing 'a' skips 'b' for an update, as in the original game
+        self.assertEqual(fired, ['a'])
+        timer.update(11)
+        self.assertEqual(fired, ['a', 'b'])
+
+
+class TestTimerBaseline(TanksTestCase):
+    def play(self, fidelity, nr=1500):
+        random.seed(0)
+        game = tanks.Game(render=False, fidelity=fidelity)
+        game.reset_game()
+        events = []
+        for k in range(nr):
+            game.act((k // 7) % 9)
+            # the timers, with how many times they fired, and the state of the game
+            events.append(([(t["interval"], t["times"], t["time"]) for t in tanks.gtimer.timers],
+                           tanks.player.rect.topleft, tanks.player.state,
+                           [(e.rect.topleft, e.state) for e in tanks.enemies],
+                           [b.state for b in tanks.bullets], tanks.player.score))
+            if game.isGameOver():
+                game.reset_game()
+        return events
+
+    def test_full_game(self):
+        events = self.play("full")
+        with mock.patch.object(tanks.Timer, 'update', baseline_update):
+            baseline = self.play("full")
+        self.assertEqual(len(events), len(baseline))
+        for k in range(len(events)):
+            self.assertEqual(events[k], baseline[k], k)
+
+
+class TestCollision(TanksTestCase):
+    def random_rects(self, rng, nr):
+        size = tanks.Level.TILE_SIZE * tanks.Level.MAP_SIZE
+        for _ in range(nr):
+            w, h = rng.randint(1, 40, size=2)
+            x, y = rng.randint(-40, size + 10, size=2)
+            yield tanks.Rect(x, y, w, h)
+
+    def test_grid_against_rects(self):
+        tanks.Game(render=False)
+        rng = np.random.RandomState(0)
+        for level_nr in range(1, 36):
+            level = tanks.Level(level_nr)
+            # the castle is not a tile
+            tiles = level.obstacle_rects[1:]
+            for rect in self.random_rects(rng, 300):
+                self.assertEqual(level.collides(rect), rect.collidelist(level.obstacle_rects) != -1)
+                self.assertEqual(sorted(level.obstacleTiles(rect)),
+                                 sorted(t.topleft for t in tiles if rect.colliderect(t)))
+
+    def test_after_hit(self):
+        tanks.Game(render=False)
+        level = tanks.Level(1)
+        brick = [t for t in level.mapr if t.type == level.TILE_BRICK][0]
+        rect = tanks.Rect(brick.left + 2, brick.top + 2, 4, 4)
+        self.assertTrue(level.collides(rect))
+        level.hitTile(brick.topleft)
+        self.assertEqual(level.collides(rect), rect.collidelist(level.obstacle_rects) != -1)
+
+
+class TestArrayRenderer(TanksTestCase):
+    def test_direction(self):
+        game = tanks.Game(render=False)
+        game.reset_game()
+        player = tanks.player
+        player.state = player.STATE_ALIVE
+        barrels = []
+        for direction in range(4):
+            player.direction = direction
+            rect = player.rect
+            image = game.getScreenRGB()[rect.top:rect.bottom, rect.left:rect.right]
+            barrels.append((image == tanks.ArrayRenderer.BARREL_COLOR).all(axis=2))
+        # the barrel is on a different side for every direction
+        for a in range(4):
+            self.assertTrue(barrels[a].any())
+            for b in range(a):
+                self.assertFalse(np.array_equal(barrels[a], barrels[b]))
+        self.assertTrue(barrels[0][0].any() and not barrels[0][-1].any())
+
+
+class TestResetCache(TanksTestCase):
+    def play(self, game, nr):
+        random.seed(1)
+        frames = []
+        for k in range(nr):
+            game.act(k % 9)
+            frames.append(game.getScreenRGB())
+        return frames
+
+    def test_restore(self):
+        game = tanks.Game(render=False, reset_cache=1)
+        random.seed(0)
+        game.reset_game()
+        self.assertEqual(len(game.snapshots), 1)
+        self.assertEqual(tanks.player.score, 0)
+        first = self.play(game, 300)
+        # from the snapshot this time, so the same actions give the same frames
+        for _ in range(2):
+            game.reset_game()
+            self.assertEqual(len(game.snapshots), 1)
+            self.assertEqual(tanks.player.score, 0)
+            frames = self.play(game, 300)
+            for k in range(len(frames)):
+                self.assertTrue(np.array_equal(frames[k], first[k]), k)
+
+    def test_needs_flat_render(self):
+        with self.assertRaises(ValueError):
+            tanks.Game(render=True, reset_cache=1)
+
+
+class TestFidelity(TanksTestCase):
+    def play(self, fidelity, seed, nr=1000):
+        random.seed(seed)
+        game = tanks.Game(render=False, fidelity=fidelity)
+        game.reset_game()
+        trajectory = []
+        for _ in range(nr):
+            game.act(random.randint(0, 8))
+            trajectory.append((tanks.player.rect.topleft, tanks.player.state,
+                               [(e.rect.topleft, e.state) for e in tanks.enemies],
+                               [b.state for b in tanks.bullets]))
+            if game.isGameOver():
+                game.reset_game()
+        return game, trajectory
+
+    def test_same_rules(self):
+        # the training game updates its timers through a snapshot, so that
+        # leaving out the cosmetic ones doesn't change when the others fire
+        update = tanks.Timer.update
+        for seed in range(3):
+            with mock.patch.object(tanks.Timer, 'update',
+                                   lambda self, t, snapshot=False: update(self, t, True)):
+                _, full = self.play("full", seed)
+            _, training = self.play("training", seed)
+            self.assertEqual(full, training)
+
+    def test_per_game(self):
+        training, _ = self.play("training", 0, 10)
+        full, _ = self.play("full", 0, 10)
+        self.assertFalse(training.level.cosmetic)
+        self.assertTrue(full.level.cosmetic)
+        training.reset_game()
+        self.assertFalse(tanks.player.level.cosmetic)
+
+
+@unittest.skipIf(tanks.pygame is None, "pygame is not installed")
+class TestImages(TanksTestCase):
+    def test_drawn_after_undrawn(self):
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        game = tanks.Game(render=False)
+        game.reset_game()
+        tanks.Bullet.new(game.level, [0, 0], 0)
+        tanks.Explosion.new([0, 0])
+        self.assertIsNone(tanks.Bullet.images[0])
+
+        game = tanks.Game(render=True)
+        game.reset_game()
+        self.assertIsNotNone(tanks.Bullet.new(game.level, [0, 0], 0).image)
+        self.assertIsNotNone(tanks.Explosion.new([0, 0]).image)
+
+
+if __name__ == '__main__':
+    unittest.main()